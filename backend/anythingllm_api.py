@@ -2,13 +2,152 @@ import os
 import requests
 import logging
 import mimetypes
+import threading
 import time
 from typing import Dict, Any, Optional
 import json
 
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+
+# ==================== Shared pooled transport ====================
+# Every AnythingLLM call (AnythingLLMAPI instances, WorkspaceManager, chat
+# routes, voice server) goes through one keep-alive requests.Session, so calls
+# reuse TCP/TLS connections instead of paying a handshake each time.
+#
+#   ANYTHINGLLM_POOL_SIZE        connections kept alive per host (default 32)
+#   ANYTHINGLLM_POOL_BLOCK       "true" → wait for a free connection when the
+#                                pool is exhausted instead of opening an
+#                                overflow connection that is discarded after use
+#   ANYTHINGLLM_RETRIES          retries for idempotent calls (GET/DELETE) on
+#                                connect errors and 502/503/504 (default 2)
+#   ANYTHINGLLM_CONNECT_TIMEOUT  connect timeout in seconds (default 3)
+
+POOL_SIZE = int(os.getenv("ANYTHINGLLM_POOL_SIZE", "32"))
+POOL_BLOCK = os.getenv("ANYTHINGLLM_POOL_BLOCK", "false").lower() == "true"
+RETRIES = int(os.getenv("ANYTHINGLLM_RETRIES", "2"))
+CONNECT_TIMEOUT = float(os.getenv("ANYTHINGLLM_CONNECT_TIMEOUT", "3"))
+
+# Read timeouts per endpoint family
+ENDPOINT_TIMEOUTS = {
+    "auth": 10,
+    "workspace": 30,       # GET workspace / documents, /update settings
+    "thread": 15,          # thread new / delete
+    "chat": 300,           # non-streaming chat
+    "stream": 120,         # stream-chat (time between bytes, not total)
+    "embeddings": 300,     # update-embeddings
+    "upload": 300,
+    "vector-search": 10,
+    "default": 30,
+}
+
+_pool_stats_lock = threading.Lock()
+_pool_stats = {"created": 0, "checkouts": 0, "waits": 0, "overflow": 0}
+
+
+def _count_pool(field: str) -> None:
+    with _pool_stats_lock:
+        _pool_stats[field] += 1
+
+
+class _MeteredPoolMixin:
+    """Counts connection checkouts / creations / pool exhaustion on a urllib3 pool."""
+
+    def _get_conn(self, timeout=None):
+        _count_pool("checkouts")
+        if self.pool is not None and self.pool.empty():
+            # Every connection is checked out — block=True waits, else overflow
+            _count_pool("waits" if self.block else "overflow")
+        return super()._get_conn(timeout)
+
+    def _new_conn(self):
+        _count_pool("created")
+        return super()._new_conn()
+
+
+class _MeteredHTTPConnectionPool(_MeteredPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class _MeteredHTTPSConnectionPool(_MeteredPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class _MeteredAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _MeteredHTTPConnectionPool,
+            "https": _MeteredHTTPSConnectionPool,
+        }
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """Process-wide pooled session (thread-safe for concurrent requests)."""
+    global _session
+    if _session is not None:
+        return _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=RETRIES,
+                connect=RETRIES,
+                read=RETRIES,
+                status=RETRIES,
+                backoff_factor=0.3,
+                status_forcelist=(502, 503, 504),
+                allowed_methods=frozenset({"GET", "HEAD", "DELETE", "OPTIONS"}),
+                raise_on_status=False,
+            )
+            adapter = _MeteredAdapter(
+                pool_connections=4,
+                pool_maxsize=POOL_SIZE,
+                pool_block=POOL_BLOCK,
+                max_retries=retry,
+            )
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+    return _session
+
+
+def anythingllm_request(method: str, url: str, endpoint: str = "default", timeout=None, **kwargs) -> requests.Response:
+    """
+    Issue an AnythingLLM HTTP call over the shared pool. Same semantics as
+    requests.request(); `endpoint` picks the read timeout from ENDPOINT_TIMEOUTS
+    unless `timeout` is given explicitly.
+    """
+    if timeout is None:
+        timeout = (CONNECT_TIMEOUT, ENDPOINT_TIMEOUTS.get(endpoint, ENDPOINT_TIMEOUTS["default"]))
+    return get_session().request(method, url, timeout=timeout, **kwargs)
+
+
+def pool_metrics() -> Dict[str, Any]:
+    """Connection pool counters since process start."""
+    with _pool_stats_lock:
+        stats = dict(_pool_stats)
+    stats["reused"] = max(0, stats["checkouts"] - stats["created"])
+    stats["pool_size"] = POOL_SIZE
+    stats["pool_block"] = POOL_BLOCK
+    return stats
+
+
+# (base_url, api_key) pairs already verified — auth is checked once per process,
+# not on every client construction.
+_verified_auth = set()
+_verified_auth_lock = threading.Lock()
+
+
 class AnythingLLMAPI:
     def __init__(self, base_url: str, api_key: str, workspace_slug: str):
-        logging.info("Starting AnythingLLM API Client")
+        logging.debug("Starting AnythingLLM API Client")
         self.base_url = base_url
         self.api_key = api_key
         self.workspace_slug = workspace_slug
@@ -16,15 +155,18 @@ class AnythingLLMAPI:
             'Authorization': f'Bearer {self.api_key}',
             'accept': 'application/json'
         }
-        self.verify_auth()
+        if (base_url, api_key) not in _verified_auth:
+            self.verify_auth()
 
     def verify_auth(self) -> Dict[str, Any]:
         """Verify authentication using the API key."""
         url = f"{self.base_url}/api/v1/auth"
         logging.info("Verifying authentication with AnythingLLM...")
-        response = self._get_request(url)
+        response = self._get_request(url, endpoint="auth")
         if response.get('status_code') == 200:
             logging.info("Authentication verified successfully.")
+            with _verified_auth_lock:
+                _verified_auth.add((self.base_url, self.api_key))
         else:
             logging.error("Authentication failed.")
         return response
@@ -56,11 +198,11 @@ class AnythingLLMAPI:
             logging.error(f"Error getting workspace documents: {e}")
             return {'error': str(e)}
 
-    def _get_request(self, url: str, headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    def _get_request(self, url: str, headers: Optional[Dict[str, str]] = None, endpoint: str = "workspace") -> Dict[str, Any]:
         """Internal method to handle GET requests."""
         try:
             combined_headers = {**self.headers, **(headers or {})}
-            response = requests.get(url, headers=combined_headers, timeout=30)
+            response = anythingllm_request("GET", url, endpoint=endpoint, headers=combined_headers)
             response.raise_for_status()
             logging.debug(f"GET request to {url} successful.")
             
@@ -83,7 +225,7 @@ class AnythingLLMAPI:
             logging.error(error_msg)
             return {'status_code': getattr(e.response, 'status_code', 500), 'error': error_msg}
 
-    def _post_request(self, url: str, payload: Optional[Dict[str, Any]] = None, files: Optional[Dict[str, Any]] = None, headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    def _post_request(self, url: str, payload: Optional[Dict[str, Any]] = None, files: Optional[Dict[str, Any]] = None, headers: Optional[Dict[str, str]] = None, endpoint: str = "default") -> Dict[str, Any]:
         """Internal method to handle POST requests."""
         try:
             combined_headers = {**self.headers, **(headers or {})}
@@ -92,9 +234,9 @@ class AnythingLLMAPI:
                 # Remove content-type header for file uploads to let requests handle it
                 if 'content-type' in combined_headers:
                     del combined_headers['content-type']
-                response = requests.post(url, headers=combined_headers, files=files, timeout=300)
+                response = anythingllm_request("POST", url, endpoint=endpoint, headers=combined_headers, files=files)
             else:
-                response = requests.post(url, headers=combined_headers, json=payload, timeout=300)
+                response = anythingllm_request("POST", url, endpoint=endpoint, headers=combined_headers, json=payload)
             
             response.raise_for_status()
             logging.debug(f"POST request to {url} successful.")
@@ -143,7 +285,8 @@ class AnythingLLMAPI:
                 files = {'file': (file_name, file, content_type)}
                 upload_response = self._post_request(
                     f"{self.base_url}/api/v1/document/upload", 
-                    files=files
+                    files=files,
+                    endpoint="upload"
                 )
                 
             if upload_response.get('status_code') != 200:
@@ -256,7 +399,7 @@ class AnythingLLMAPI:
         # logging.info(f"Headers: {self.headers}")
 
         logging.info(f"Sending message to AnythingLLM workspace '{self.workspace_slug}': {message[:100]}{'...' if len(message) > 100 else ''}")
-        response = self._post_request(url, payload=payload)
+        response = self._post_request(url, payload=payload, endpoint="chat")
         
         # 添加这些日志
         # logging.info(f"=== RESPONSE DEBUG ===")
@@ -366,12 +509,14 @@ class AnythingLLMAPI:
 
         logging.info(f"[STREAM-LLM] Sending to '{self.workspace_slug}': {message[:100]}...")
 
+        resp = None
         try:
-            resp = requests.post(
+            resp = anythingllm_request(
+                "POST",
                 url,
+                endpoint="stream",
                 headers=self.headers,
                 json=payload,
-                timeout=120,
                 stream=True,
             )
             resp.raise_for_status()
@@ -414,6 +559,11 @@ class AnythingLLMAPI:
         except Exception as e:
             logging.error(f"[STREAM-LLM] Error: {e}")
             yield {"textResponse": "", "close": True, "error": str(e)}
+        finally:
+            # Hand the connection back to the pool even when we stop at the
+            # close chunk or the consumer abandons the generator.
+            if resp is not None:
+                resp.close()
 
     def check_workspace_status(self) -> Dict[str, Any]:
         """Check workspace status for debugging purposes."""
@@ -467,7 +617,7 @@ class AnythingLLMAPI:
         logging.info(f"Adding document '{document_name}' to workspace '{self.workspace_slug}'...")
         
         try:
-            response = self._post_request(url, payload=payload)
+            response = self._post_request(url, payload=payload, endpoint="embeddings")
             
             if response.get('status_code') == 200:
                 data = response.get('data', {})
@@ -497,7 +647,7 @@ class AnythingLLMAPI:
             payload["slug"] = slug
 
         try:
-            response = self._post_request(url, payload=payload)
+            response = self._post_request(url, payload=payload, endpoint="thread")
             if response.get('status_code') == 200:
                 data = response.get('data', {}) or {}
                 thread = data.get('thread') or data
@@ -522,7 +672,7 @@ class AnythingLLMAPI:
             return {'success': False, 'error': 'Missing thread_slug'}
         url = f"{self.base_url}/api/v1/workspace/{self.workspace_slug}/thread/{thread_slug}"
         try:
-            response = requests.delete(url, headers=self.headers, timeout=15)
+            response = anythingllm_request("DELETE", url, endpoint="thread", headers=self.headers)
             if response.status_code in (200, 204, 404):
                 logging.info(f"Thread '{thread_slug}' deleted (status {response.status_code})")
                 return {'success': True, 'status_code': response.status_code}
@@ -546,7 +696,7 @@ class AnythingLLMAPI:
         logging.info(f"Removing document '{document_name}' from workspace '{self.workspace_slug}'...")
 
         try:
-            response = self._post_request(url, payload=payload)
+            response = self._post_request(url, payload=payload, endpoint="embeddings")
 
             if response.get('status_code') == 200:
                 data = response.get('data', {})
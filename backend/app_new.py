@@ -17,7 +17,12 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # 导入自定义模块
-from database import db
+from database import db, tail_read_stats
+from user_cache import get_user, invalidate_user, user_cache_stats
+from local_cache import cache_stats
+from embed_cache import cached_search
+from chat_jobs import queue_post_reply, register_handlers as register_chat_jobs
+from prompt_budget import PromptBudget
 from auth import (
     GoogleOAuth,
     JWTAuth,
@@ -36,12 +41,14 @@ from auth import (
     create_refresh_token,
 )
 from workspace_manager import workspace_manager
-from anythingllm_api import AnythingLLMAPI
+from anythingllm_api import AnythingLLMAPI, anythingllm_request, pool_metrics
 from image_gen import process_image_markers
 from lorebook_engine import build_lorebook_prefix
-from companion_service import get_active_companion
+from companion_service import get_active_companion, get_lorebook
 from timing import StepTimer
-import requests as _requests
+from enrichment import EnrichmentPipeline, step_timeout
+from sse import sse_event, SSECoalescer
+from stream_parser import ThinkStreamParser
 
 
 # ==================== Previous Conversation Context ====================
@@ -59,17 +66,17 @@ def get_previous_conversation_context(user_id, current_conv_id, db_instance, max
                 "is_active": True,
                 "_id": {"$ne": current_conv_id}
             },
+            {"_id": 1},
             sort=[("updated_at", -1)]
         )
         if not prev_conv:
             return ""
 
-        messages = prev_conv.get("messages", [])
-        if not messages:
+        # 只取最后 N 条消息
+        recent = db_instance.get_recent_messages(prev_conv["_id"], max_messages)
+        if not recent:
             return ""
 
-        # 取最后 N 条消息
-        recent = messages[-max_messages:]
         context_lines = []
         for m in recent:
             role_label = "User" if m["role"] == "user" else "Assistant"
@@ -91,9 +98,13 @@ def get_previous_conversation_context(user_id, current_conv_id, db_instance, max
         return ""
 
 
+# 热路径加载对话时带的历史条数 — 导入上下文 20 条 / thread 回放 10 条 / lorebook 扫描窗口
+HISTORY_TAIL = 20
+
+
 # ==================== AnythingLLM Thread per Conversation ====================
 
-def ensure_thread_for_conversation(api, conversation, db_instance):
+def ensure_thread_for_conversation(api, conversation, db_instance, persist=True):
     """
     Make sure the given MongoDB conversation is backed by a dedicated AnythingLLM
     thread. Different threads in the same workspace keep their chat histories
@@ -105,6 +116,10 @@ def ensure_thread_for_conversation(api, conversation, db_instance):
         chat so the user still gets a reply).
       - history_prefix: string to prepend to the user message the first time a
         pre-existing conversation is migrated onto a new thread. Empty otherwise.
+
+    persist=False leaves saving a newly created slug to the caller
+    (persist_thread_slug) — chat_stream only saves it once the turn actually
+    uses the history prefix, otherwise the replay would be lost for good.
     """
     log = logging.getLogger(__name__)
     thread_slug = conversation.get("anythingllm_thread_slug")
@@ -121,20 +136,14 @@ def ensure_thread_for_conversation(api, conversation, db_instance):
         return None, ""
 
     thread_slug = result["slug"]
-    try:
-        db_instance.db["conversations"].update_one(
-            {"_id": conversation["_id"]},
-            {"$set": {"anythingllm_thread_slug": thread_slug}}
-        )
-    except Exception as e:
-        log.warning(f"[THREAD] Persisting thread_slug failed (non-fatal): {e}")
+    if persist:
+        persist_thread_slug(db_instance, conversation, thread_slug)
 
     # Migrate: if this conversation already has messages, the new thread starts
     # empty — replay the last ~10 turns into the first message so the AI
     # continues smoothly instead of acting like it just met the user.
-    existing_msgs = conversation.get("messages") or []
-    if existing_msgs:
-        last_msgs = existing_msgs[-10:]
+    last_msgs = (conversation.get("messages") or [])[-10:]
+    if last_msgs:
         lines = []
         for m in last_msgs:
             role_label = "User" if m.get("role") == "user" else "Assistant"
@@ -154,6 +163,84 @@ def ensure_thread_for_conversation(api, conversation, db_instance):
     return thread_slug, ""
 
 
+def persist_thread_slug(db_instance, conversation, thread_slug):
+    """Save a newly created thread slug on the conversation (no-op if already saved)."""
+    if not thread_slug or conversation.get("anythingllm_thread_slug") == thread_slug:
+        return
+    try:
+        db_instance.db["conversations"].update_one(
+            {"_id": conversation["_id"]},
+            {"$set": {"anythingllm_thread_slug": thread_slug}}
+        )
+    except Exception as e:
+        logging.getLogger(__name__).warning(f"[THREAD] Persisting thread_slug failed (non-fatal): {e}")
+
+
+# ==================== Per-turn Prompt Delivery ====================
+
+def sync_prompt_for_turn(user_id, user: dict, workspace: dict, user_message: str) -> str:
+    """
+    Make sure the workspace carries the user's current model + base prompt, and
+    return the Mem0 memory block to prepend to this turn's message.
+
+    overlay (default): memory rides along as a message prefix; the workspace
+    /update POST only happens when the prompt/model fingerprint changes, so the
+    common turn has no extra AnythingLLM round-trip and concurrent tabs / the
+    voice server can't clobber each other's per-turn prompt.
+    workspace (PROMPT_DELIVERY=workspace): legacy — rewrite the full prompt with
+    memory baked in on every turn. Returns "".
+    """
+    logger = logging.getLogger(__name__)
+    mem0_on = os.environ.get("MEM0_ENABLED", "false").lower() == "true"
+
+    if workspace_manager.prompt_delivery_mode() == "overlay":
+        memory_prefix = ""
+        if mem0_on:
+            try:
+                from mem0_engine import search_relevant_memories, get_permanent_memories, build_memory_prefix
+                uid_str = str(user_id)
+                memory_prefix = build_memory_prefix(
+                    get_permanent_memories(uid_str),
+                    search_relevant_memories(uid_str, user_message),
+                )
+            except Exception as e:
+                logger.warning(f"[MEM0] Pre-chat search failed: {e}")
+        result = workspace_manager.sync_workspace_prompt(user_id, workspace, user=user)
+        if not result.get("success"):
+            logger.warning(f"[PROMPT] Workspace sync failed (non-fatal): {result.get('error')}")
+        elif result.get("pushed"):
+            logger.info(f"[PROMPT] Workspace {workspace.get('slug')} settings changed, pushed update")
+        return memory_prefix
+
+    user_model = user.get("settings", {}).get("model", "gemini")
+    if user_model not in workspace_manager.SUPPORTED_MODELS:
+        return ""
+    sync_payload = workspace_manager.model_settings(user_model)
+    if mem0_on:
+        try:
+            from mem0_engine import search_relevant_memories, get_permanent_memories, build_memory_text as mem0_build_text
+            uid_str = str(user_id)
+            permanent = get_permanent_memories(uid_str)
+            relevant = search_relevant_memories(uid_str, user_message)
+            memory_text = mem0_build_text(permanent, relevant)
+            sync_payload["openAiPrompt"] = workspace_manager.build_prompt_for_user(user_id, memory_text=memory_text, user=user)
+        except Exception as e:
+            logger.warning(f"[MEM0] Pre-chat search failed, prompt unchanged: {e}")
+    anythingllm_request(
+        "POST",
+        f"{workspace_manager.anythingllm_base_url}/api/v1/workspace/{workspace['slug']}/update",
+        headers={
+            "Authorization": f"Bearer {workspace_manager.anythingllm_api_key}",
+            "Content-Type": "application/json"
+        },
+        json=sync_payload,
+        timeout=5
+    )
+    # The workspace now holds a per-turn prompt — the overlay fingerprint is stale.
+    workspace_manager.invalidate_prompt_fingerprint(workspace["slug"])
+    return ""
+
+
 # ==================== Shared Knowledge Base (Psychology) ====================
 KB_WORKSPACE_SLUG = os.getenv("KB_WORKSPACE_SLUG", "soullink_test")
 
@@ -180,24 +267,29 @@ def query_shared_kb(user_message: str, top_k: int = 3, min_score: float = 0.25)
     if not any(kw in msg_lower for kw in psych_keywords):
         return ""
 
-    try:
+    def _vector_search(query):
         base_url = os.getenv("ANYTHINGLLM_BASE_URL", "http://localhost:3001")
         api_key = os.getenv("ANYTHINGLLM_API_KEY", "")
-        resp = _requests.post(
+        resp = anythingllm_request(
+            "POST",
             f"{base_url}/api/v1/workspace/{KB_WORKSPACE_SLUG}/vector-search",
+            endpoint="vector-search",
             headers={
                 "Authorization": f"Bearer {api_key}",
                 "Content-Type": "application/json"
             },
-            json={"query": user_message, "topN": top_k},
-            timeout=10
+            json={"query": query, "topN": top_k},
         )
         if resp.status_code != 200:
             logger.warning(f"[KB] Vector search HTTP {resp.status_code}")
-            return ""
+            return None
+        return resp.json().get("results", [])
 
-        data = resp.json()
-        results = data.get("results", [])
+    try:
+        # 共享知识库基本不变：相同 / 近似重复的消息复用上次的检索结果（embed_cache.py）
+        results = cached_search(f"kb:{KB_WORKSPACE_SLUG}:{top_k}", user_message, _vector_search)
+        if results is None:
+            return ""
 
         # Filter by relevance score and build context
         context_parts = []
@@ -256,6 +348,9 @@ CORS(app, resources={r"/*": {"origins": ALLOWED_ORIGINS}},
 from guest_routes import guest_bp
 app.register_blueprint(guest_bp)
 
+# 后台任务队列：本进程执行记忆提取 / 清理 / 标题任务（含重启前遗留的任务）
+register_chat_jobs()
+
 
 # ==================== 健康检查 ====================
 
@@ -613,8 +708,6 @@ def migrate_guest():
 
     Body: { "conversations": [{ "id": "...", "title": "...", "messages": [...] }] }
     """
-    import threading as _thr
-
     user_id = get_current_user_id()
     data = request.get_json()
     if not data:
@@ -648,18 +741,13 @@ def migrate_guest():
             id_map[guest_id] = str(conv_id)
             migrated += 1
 
-            # Async: trigger Mem0 memory extraction
+            # Async: queue Mem0 memory extraction
             if os.getenv("MEM0_ENABLED", "false").lower() == "true":
                 try:
-                    from mem0_engine import process_memory
                     for i in range(0, len(messages) - 1, 2):
                         if (messages[i].get("role") == "user" and
                                 messages[i + 1].get("role") == "assistant"):
-                            _thr.Thread(
-                                target=process_memory,
-                                args=(user_id, messages[i]["content"], messages[i + 1]["content"]),
-                                daemon=True,
-                            ).start()
+                            queue_post_reply(user_id, messages[i]["content"], messages[i + 1]["content"])
                 except Exception as mem_err:
                     logger.warning(f"[MIGRATE] Memory extraction failed: {mem_err}")
 
@@ -747,6 +835,7 @@ def update_profile():
         {"_id": user_id},
         {"$set": updates}
     )
+    invalidate_user(user_id)
 
     if result.modified_count > 0:
         # 如果昵称改变了，同步更新 AnythingLLM 的 system prompt
@@ -875,6 +964,7 @@ def upload_background():
             {"_id": user_id},
             {"$set": {"settings.custom_background_url": url}}
         )
+        invalidate_user(user_id)
 
         logger.info(f"[BG] Uploaded custom background for user {user_id}: {url[:80]}")
         return jsonify({"success": True, "url": url})
@@ -908,6 +998,7 @@ def delete_background():
             {"_id": user_id},
             {"$unset": {"settings.custom_background_url": ""}}
         )
+        invalidate_user(user_id)
         return jsonify({"success": True})
     except Exception as e:
         logger.error(f"[BG] Delete error: {e}")
@@ -1063,9 +1154,10 @@ def delete_user_memory(memory_id):
         return jsonify({"error": "Memory system not enabled"}), 400
 
     try:
-        from mem0_engine import _get_mem0
+        from mem0_engine import _get_mem0, bump_memory_version
         m = _get_mem0()
         m.delete(memory_id)
+        bump_memory_version(get_current_user_id())
         return jsonify({"success": True, "deleted": memory_id})
     except Exception as e:
         logger.error(f"[MEMORIES] Error deleting memory {memory_id}: {e}")
@@ -1094,7 +1186,7 @@ def update_user_memory(memory_id):
         return jsonify({"error": "No updatable fields provided"}), 400
 
     try:
-        from mem0_engine import _get_mem0, _calculate_expiry
+        from mem0_engine import _get_mem0, _calculate_expiry, bump_memory_version
         m = _get_mem0()
 
         # Fetch current record so we can preserve unchanged metadata fields
@@ -1117,6 +1209,7 @@ def update_user_memory(memory_id):
             "edited": True,
         }
         m.update(memory_id, data=fact, metadata=metadata)
+        bump_memory_version(get_current_user_id())
         return jsonify({
             "success": True,
             "memory": {"id": memory_id, "fact": fact, "tier": tier},
@@ -1146,12 +1239,14 @@ def create_user_memory():
         return jsonify({"error": f"tier must be one of {_ALLOWED_TIERS}"}), 400
 
     try:
-        from mem0_engine import _get_mem0, _calculate_expiry, get_permanent_memories, MAX_PERMANENT
+        from mem0_engine import (
+            _get_mem0, _calculate_expiry, tier_counts, bump_memory_version, MAX_PERMANENT,
+        )
         m = _get_mem0()
 
         # Permanent cap: downgrade instead of rejecting so the fact still gets stored.
         if tier == "permanent":
-            if len(get_permanent_memories(uid_str)) >= MAX_PERMANENT:
+            if tier_counts(uid_str).get("permanent", 0) >= MAX_PERMANENT:
                 tier = "long_term"
 
         metadata = {
@@ -1165,6 +1260,7 @@ def create_user_memory():
         except TypeError:
             # Older mem0 signature fallback
             result = m.add(messages=[{"role": "user", "content": fact}], user_id=uid_str, metadata=metadata, infer=False)
+        bump_memory_version(uid_str)
 
         new_id = None
         events = result if isinstance(result, list) else (result or {}).get("results", [])
@@ -1290,6 +1386,7 @@ def update_settings():
         {"_id": user_id},
         {"$set": updates}
     )
+    invalidate_user(user_id)
 
     # 如果伴侣风格改变了，重新生成 persona 并更新 system prompt
     if "companion_subtype" in data or "companion_gender" in data or "companion_relationship" in data:
@@ -1297,7 +1394,7 @@ def update_settings():
         try:
             from personality_engine import generate_personality_profile, COMPANION_SUBTYPES
             # 从数据库重新读取最新用户数据（不用缓存的 request.current_user）
-            user = db.db["users"].find_one({"_id": user_id})
+            user = get_user(user_id)
             subtype = data.get("companion_subtype") or user.get("settings", {}).get("companion_subtype", "female_gentle")
             gender = data.get("companion_gender") or user.get("settings", {}).get("companion_gender", "female")
             language = user.get("settings", {}).get("language", "en")
@@ -1319,6 +1416,7 @@ def update_settings():
                         {"_id": user_id},
                         {"$set": {"personality_test.personality_profile": new_profile}}
                     )
+                    invalidate_user(user_id)
                     logger.info(f"[STYLE] New persona saved, length={len(new_profile)}")
                 else:
                     logger.info(f"[STYLE] No personality test completed, skipping persona regen")
@@ -1518,38 +1616,10 @@ def chat():
     workspace = workspace_result["workspace"]
     workspace_slug = workspace["slug"]
 
-    # Sync model + prompt (with Mem0 semantic memory if enabled)
+    # Sync model + prompt; Mem0 memory comes back as a message prefix (overlay mode)
+    memory_prefix = ""
     try:
-        user_model = user.get("settings", {}).get("model", "gemini")
-        if user_model in workspace_manager.SUPPORTED_MODELS:
-            model_config = workspace_manager.SUPPORTED_MODELS[user_model]
-            model_temp = 1.0 if user_model == "grok" else 0.9 if user_model == "gpt4o" else 0.7
-            import requests as req
-            sync_payload = {
-                "chatProvider": model_config["chatProvider"],
-                "chatModel": model_config["chatModel"],
-                "openAiTemp": model_temp,
-            }
-            if os.environ.get("MEM0_ENABLED", "false").lower() == "true":
-                try:
-                    from mem0_engine import search_relevant_memories, get_permanent_memories, build_memory_text as mem0_build_text
-                    uid_str = str(user_id)
-                    permanent = get_permanent_memories(uid_str)
-                    relevant = search_relevant_memories(uid_str, user_message)
-                    memory_text = mem0_build_text(permanent, relevant)
-                    fresh_prompt = workspace_manager.build_prompt_for_user(user_id, memory_text=memory_text)
-                    sync_payload["openAiPrompt"] = fresh_prompt
-                except Exception as e:
-                    logger.warning(f"[MEM0] Pre-chat search failed: {e}")
-            req.post(
-                f"{workspace_manager.anythingllm_base_url}/api/v1/workspace/{workspace_slug}/update",
-                headers={
-                    "Authorization": f"Bearer {workspace_manager.anythingllm_api_key}",
-                    "Content-Type": "application/json"
-                },
-                json=sync_payload,
-                timeout=5
-            )
+        memory_prefix = sync_prompt_for_turn(user_id, user, workspace, user_message)
     except Exception as e:
         logger.warning(f"Model sync check failed (non-fatal): {e}")
 
@@ -1557,14 +1627,14 @@ def chat():
     if conversation_id:
         try:
             conv_id = ObjectId(conversation_id)
-            conversation = db.get_conversation(conv_id, user_id)
+            conversation = db.get_conversation_tail(conv_id, user_id, HISTORY_TAIL)
             if not conversation:
                 # 对话不存在，创建新的
                 conversation = db.create_conversation(user_id)
         except Exception:
             conversation = db.create_conversation(user_id)
     else:
-        conversation = db.get_active_conversation(user_id)
+        conversation = db.get_active_conversation(user_id, tail=HISTORY_TAIL)
 
     # 记录是否是新对话的第一条消息（用于后续自动生成标题）
     is_first_message = conversation.get("metadata", {}).get("total_messages", 0) == 0
@@ -1615,20 +1685,19 @@ def chat():
         # Per-conversation AnythingLLM thread isolation (fixes concurrent-session merging).
         thread_slug, thread_history_prefix = ensure_thread_for_conversation(api, conversation, db)
 
-        # 获取最近的对话历史作为上下文
-        recent_messages = conversation.get("messages", [])[-10:]  # 最近10条消息
+        # 可选上下文块统一走 token 预算（prompt_budget.py），系统提示不计入预算
+        message_to_send = user_message
+        budget = PromptBudget()
+        hints = ""
 
         # 联网搜索增强：判断是否需要实时信息，自动搜索并注入结果
         try:
             from web_search import enhance_message_with_search
             enhanced_msg, did_search = enhance_message_with_search(user_message)
             if did_search:
-                message_to_send = enhanced_msg
-            else:
-                message_to_send = user_message
+                budget.add("search", enhanced_msg[len(user_message):])
         except Exception as e:
             logger.warning(f"[SEARCH] Enhancement failed, using original: {e}")
-            message_to_send = user_message
 
         # Voice hint so AI knows this was spoken, not typed
         if msg_type == "voice":
@@ -1640,7 +1709,7 @@ def chat():
             if kb_on:
                 kb_context = query_shared_kb(user_message)
                 if kb_context:
-                    message_to_send = message_to_send + kb_context
+                    budget.add("kb", kb_context)
         except Exception:
             pass
 
@@ -1658,7 +1727,7 @@ def chat():
         if not is_asking_name:
             for p in rename_hint_patterns:
                 if re.search(p, user_message, re.IGNORECASE):
-                    message_to_send = message_to_send + "\n\n[System: 如果你接受了改名，记得在回复最末尾加上 [RENAME:新名字] 标记]"
+                    hints += "\n\n[System: 如果你接受了改名，记得在回复最末尾加上 [RENAME:新名字] 标记]"
                     logger.info(f"[RENAME] Detected possible rename intent, adding hint to message")
                     break
 
@@ -1672,11 +1741,11 @@ def chat():
                     role_label = "User" if m["role"] == "user" else "Assistant"
                     context_lines.append(f"{role_label}: {m['content'][:500]}")
                 context_block = "\n".join(context_lines)
-                message_to_send = (
+                budget.add("import_context", (
                     f"[以下是我们之前在其他平台的对话记录，请基于这些上下文继续和我对话，"
                     f"保持之前的语气和话题]\n{context_block}\n"
-                    f"[对话记录结束，请继续]\n\n{message_to_send}"
-                )
+                    f"[对话记录结束，请继续]\n\n"
+                ))
                 logger.info(f"[IMPORT] Injected {len(imported_msgs)} imported messages as context")
             # 标记已激活，后续消息不再注入
             db.db["conversations"].update_one(
@@ -1688,25 +1757,32 @@ def chat():
         if is_first_message:
             prev_context = get_previous_conversation_context(user_id, conversation["_id"], db)
             if prev_context:
-                message_to_send = prev_context + message_to_send
+                budget.add("prev_context", prev_context)
                 logger.info("[CONTEXT] Injected previous conversation context into new chat")
 
         # Thread history replay for conversations that existed before threads were
         # introduced (first message on a freshly-created thread).
-        if thread_history_prefix:
-            message_to_send = thread_history_prefix + message_to_send
+        budget.add("history", thread_history_prefix)
+        budget.add("memory", memory_prefix)
+        budget.reserve(message_to_send + hints)
 
         # Lorebook injection — keyword-triggered character-knowledge block
         # prefixed onto the user message. No-op when companion has no entries,
         # so existing users see identical behavior.
         try:
             companion = get_active_companion(user_id, user_doc=user)
-            lore_prefix = build_lorebook_prefix(user_message, conversation, companion)
-            if lore_prefix:
-                message_to_send = lore_prefix + message_to_send
+            lore_prefix = build_lorebook_prefix(
+                user_message, conversation, companion,
+                budget_tokens=budget.allowance("lorebook"),
+            )
+            budget.add("lorebook", lore_prefix)
         except Exception as e:
             logger.warning(f"[LOREBOOK] /api/chat injection failed (non-fatal): {e}")
 
+        message_to_send = budget.assemble(message_to_send, hints)
+        if budget.trimmed():
+            logger.info(f"[BUDGET] Trimmed prompt context: {budget.summary()}")
+
         # 发送消息
         logger.info(f"Sending message: {message_to_send[:80]}...")
         response = api.send_message(
@@ -1947,6 +2023,7 @@ def chat():
                     {"_id": user_id},
                     {"$set": {"settings.companion_name": companion_name_changed}}
                 )
+                invalidate_user(user_id)
                 workspace_manager.update_system_prompt(
                     user_id, user["name"], companion_name=companion_name_changed
                 )
@@ -1988,6 +2065,7 @@ def chat():
                                     {"_id": user_id},
                                     {"$set": {"settings.voice_style": voice_style}}
                                 )
+                                invalidate_user(user_id)
                                 logger.info(f"[VOICE] Cached voice_style='{voice_style}' for user {user_id}")
                             except Exception:
                                 pass
@@ -2046,71 +2124,14 @@ def chat():
                 for img in generated_images
             ]
 
-        # 异步提取记忆（不阻塞响应），并写 memory_events 供前端轮询
-        import threading
-        conv_id_for_memory = conversation["_id"]
-        def _async_memory_extraction(uid, umsg, areply, conv_id):
-            try:
-                if os.environ.get("MEM0_ENABLED", "false").lower() == "true":
-                    from mem0_engine import process_memory, cleanup_expired_memories
-                    receipt = process_memory(uid, umsg, areply) or {}
-                    # Persist receipt so the UI can show "已记住：..." under the AI bubble.
-                    # Only write when there's something meaningful to show.
-                    if receipt.get("added") or receipt.get("updated"):
-                        try:
-                            from datetime import datetime as _dt
-                            db.db["memory_events"].insert_one({
-                                "user_id": uid,
-                                "conversation_id": conv_id,
-                                "added": receipt.get("added", []),
-                                "updated": receipt.get("updated", []),
-                                "created_at": _dt.utcnow(),
-                            })
-                        except Exception as e:
-                            logger.warning(f"[MEM0] Failed to persist receipt: {e}")
-                    import random
-                    if random.random() < 0.05:
-                        cleanup_expired_memories(str(uid))
-                else:
-                    from memory_engine import process_memory
-                    process_memory(uid, umsg, areply)
-            except Exception as e:
-                logger.warning(f"[MEMORY] Async extraction error: {e}")
-        threading.Thread(
-            target=_async_memory_extraction,
-            args=(user_id, user_message, reply, conv_id_for_memory),
-            daemon=True
-        ).start()
-
-        # 异步生成对话标题（仅第一条消息时触发）
-        if is_first_message:
-            def _async_generate_title(conv_id, uid, umsg, areply):
-                try:
-                    from memory_engine import _call_gemini
-                    prompt = (
-                        "Generate a very short conversation title (max 6 words) based on this chat. "
-                        "If the message is in Chinese, return Chinese title. If in English, return English title. "
-                        "Return ONLY the title text, nothing else. No quotes, no punctuation at the end.\n\n"
-                        f"User: {umsg[:200]}\nAssistant: {areply[:200]}"
-                    )
-                    title = _call_gemini(prompt)
-                    if title and len(title) < 50:
-                        # 清理标题（去掉引号、多余空白等）
-                        title = title.strip().strip('"\'').strip()
-                        if title:
-                            from datetime import datetime as dt
-                            db.db["conversations"].update_one(
-                                {"_id": conv_id, "user_id": uid},
-                                {"$set": {"title": title, "updated_at": dt.utcnow()}}
-                            )
-                            logger.info(f"[TITLE] Auto-generated title: {title}")
-                except Exception as e:
-                    logger.warning(f"[TITLE] Async title generation error: {e}")
-            threading.Thread(
-                target=_async_generate_title,
-                args=(conversation["_id"], user_id, user_message, reply),
-                daemon=True
-            ).start()
+        # 异步提取记忆（不阻塞响应），并写 memory_events 供前端轮询；标题仅第一条消息时生成
+        # → 持久化后台任务队列（chat_jobs.py / job_queue.py）
+        queue_post_reply(
+            user_id, user_message, reply,
+            conversation_id=conversation["_id"],
+            is_first_message=is_first_message,
+            record_receipt=True,
+        )
 
         return jsonify(result)
 
@@ -2150,114 +2171,11 @@ def chat_stream():
         user_audio_duration = data.get("audio_duration")
         _timer.mark("auth_parse")
 
-        # Pre-load workspace
-        workspace_result = workspace_manager.get_or_create_workspace(user_id)
-        if not workspace_result["success"]:
-            return jsonify({"error": "Failed to get workspace"}), 500
-        workspace = workspace_result["workspace"]
-        workspace_slug = workspace["slug"]
-        _timer.mark("workspace")
-
-        # Sync model + prompt (with Mem0 semantic memory if enabled)
-        try:
-            user_model = user.get("settings", {}).get("model", "gemini")
-            if user_model in workspace_manager.SUPPORTED_MODELS:
-                model_config = workspace_manager.SUPPORTED_MODELS[user_model]
-                model_temp = 1.0 if user_model == "grok" else 0.9 if user_model == "gpt4o" else 0.7
-                import requests as req
-                sync_payload = {
-                    "chatProvider": model_config["chatProvider"],
-                    "chatModel": model_config["chatModel"],
-                    "openAiTemp": model_temp,
-                }
-                # Mem0: 语义搜索记忆 → 实时注入 prompt
-                if os.environ.get("MEM0_ENABLED", "false").lower() == "true":
-                    try:
-                        from mem0_engine import search_relevant_memories, get_permanent_memories, build_memory_text as mem0_build_text
-                        uid_str = str(user_id)
-                        permanent = get_permanent_memories(uid_str)
-                        relevant = search_relevant_memories(uid_str, user_message)
-                        memory_text = mem0_build_text(permanent, relevant)
-                        fresh_prompt = workspace_manager.build_prompt_for_user(user_id, memory_text=memory_text)
-                        sync_payload["openAiPrompt"] = fresh_prompt
-                    except Exception as e:
-                        logger.warning(f"[MEM0] Pre-chat search failed, prompt unchanged: {e}")
-                req.post(
-                    f"{workspace_manager.anythingllm_base_url}/api/v1/workspace/{workspace_slug}/update",
-                    headers={
-                        "Authorization": f"Bearer {workspace_manager.anythingllm_api_key}",
-                        "Content-Type": "application/json"
-                    },
-                    json=sync_payload,
-                    timeout=5
-                )
-        except Exception:
-            pass
-        _timer.mark("prompt_sync")
-
-        # Get or create conversation
-        conversation = None
-        if conversation_id:
-            try:
-                conversation = db.get_conversation(ObjectId(conversation_id), user_id)
-            except Exception:
-                pass
-        if not conversation:
-            # No valid conversation_id provided — create a brand new conversation
-            # instead of reusing the most recent one (which causes messages to
-            # leak into old threads).
-            conversation = db.create_conversation(user_id)
-
-        is_first_message = conversation.get("metadata", {}).get("total_messages", 0) == 0
-        _timer.mark("conv_load")
-
-        # Save user message（图片附件上传 Cloudinary 持久化）
-        attachment_meta = None
-        if attachments:
-            attachment_meta = []
-            for a in attachments:
-                meta = {"name": a.get("name", "file"), "mime": a.get("mime", ""),
-                        "isImage": a.get("mime", "").startswith("image/")}
-                if meta["isImage"] and a.get("contentString"):
-                    try:
-                        from image_gen import upload_to_cloudinary
-                        b64 = a["contentString"].split(",", 1)[-1] if "," in a["contentString"] else a["contentString"]
-                        url = upload_to_cloudinary(b64, str(user_id))
-                        if url:
-                            meta["url"] = url
-                    except Exception as e:
-                        logger.warning(f"[CHAT-STREAM] User image upload failed: {e}")
-                attachment_meta.append(meta)
-        db.add_message_to_conversation(
-            conversation["_id"], user_id, "user", user_message,
-            attachments=attachment_meta,
-            msg_type=msg_type if msg_type != "text" else None,
-            audio_url=user_audio_url,
-            audio_duration=float(user_audio_duration) if user_audio_duration else None
-        )
-
-        # Web search enhancement
-        message_to_send = user_message
-        try:
-            from web_search import enhance_message_with_search
-            enhanced, did_search = enhance_message_with_search(user_message)
-            if did_search:
-                message_to_send = enhanced
-        except Exception:
-            pass
-
-        # KB enhancement: query shared psychology knowledge base
-        try:
-            kb_on = user.get("settings", {}).get("kb_enabled", False)
-            if kb_on:
-                kb_context = query_shared_kb(user_message)
-                if kb_context:
-                    message_to_send = message_to_send + kb_context
-        except Exception:
-            pass
-
-        # Rename hint injection
+        # System hints depend only on the request; computed up front so the
+        # lorebook step can size itself against the reserve. Optional context
+        # blocks go through one token budget (prompt_budget.py).
         import re
+        hints = ""
         ask_name_patterns = r'你叫什么|你叫啥|你的名字是|what.s your name|what do (they|you) call you'
         is_asking_name = re.search(ask_name_patterns, user_message, re.IGNORECASE)
         rename_hint_patterns = [
@@ -2268,7 +2186,7 @@ def chat_stream():
         if not is_asking_name:
             for p in rename_hint_patterns:
                 if re.search(p, user_message, re.IGNORECASE):
-                    message_to_send = message_to_send + "\n\n[System: 如果你接受了改名，记得在回复最末尾加上 [RENAME:新名字] 标记]"
+                    hints += "\n\n[System: 如果你接受了改名，记得在回复最末尾加上 [RENAME:新名字] 标记]"
                     break
 
         # Image edit hint — only injected when user uploaded an image
@@ -2277,7 +2195,7 @@ def chat_stream():
             for a in attachments
         )
         if _has_user_image:
-            message_to_send = message_to_send + (
+            hints += (
                 "\n\n[System: The user attached an image. If they want you to MODIFY/EDIT the image "
                 "(change background, hair, outfit, style, add/remove elements, etc.), "
                 "add [IMAGE_EDIT: English editing instruction] at the end of your reply. "
@@ -2287,6 +2205,139 @@ def chat_stream():
                 "The tag will be auto-removed — users won't see it.]"
             )
 
+        budget = PromptBudget()
+        budget.reserve(user_message + hints)
+
+        # ---- Enrichment steps (enrichment.py): independent ones run concurrently,
+        # optional ones fall back to their default on timeout / error ----
+
+        def _workspace():
+            result = workspace_manager.get_or_create_workspace(user_id)
+            if not result["success"]:
+                raise RuntimeError("Failed to get workspace")
+            return result["workspace"]
+
+        def _conversation():
+            conversation = None
+            if conversation_id:
+                try:
+                    conversation = db.get_conversation_tail(ObjectId(conversation_id), user_id, HISTORY_TAIL)
+                except Exception:
+                    pass
+            if not conversation:
+                # No valid conversation_id provided — create a brand new conversation
+                # instead of reusing the most recent one (which causes messages to
+                # leak into old threads).
+                conversation = db.create_conversation(user_id)
+            return conversation
+
+        def _uploads():
+            # 图片附件上传 Cloudinary 持久化 — attachment index → URL
+            urls = {}
+            for i, a in enumerate(attachments or []):
+                if a.get("mime", "").startswith("image/") and a.get("contentString"):
+                    try:
+                        from image_gen import upload_to_cloudinary
+                        b64 = a["contentString"].split(",", 1)[-1] if "," in a["contentString"] else a["contentString"]
+                        url = upload_to_cloudinary(b64, str(user_id))
+                        if url:
+                            urls[i] = url
+                    except Exception as e:
+                        logger.warning(f"[CHAT-STREAM] User image upload failed: {e}")
+            return urls
+
+        def _save_user_message(conversation, uploads):
+            attachment_meta = None
+            if attachments:
+                attachment_meta = []
+                for i, a in enumerate(attachments):
+                    meta = {"name": a.get("name", "file"), "mime": a.get("mime", ""),
+                            "isImage": a.get("mime", "").startswith("image/")}
+                    if i in uploads:
+                        meta["url"] = uploads[i]
+                    attachment_meta.append(meta)
+            db.add_message_to_conversation(
+                conversation["_id"], user_id, "user", user_message,
+                attachments=attachment_meta,
+                msg_type=msg_type if msg_type != "text" else None,
+                audio_url=user_audio_url,
+                audio_duration=float(user_audio_duration) if user_audio_duration else None
+            )
+
+        def _prompt_sync(workspace):
+            # Sync model + prompt; Mem0 memory comes back as a message prefix (overlay mode)
+            return sync_prompt_for_turn(user_id, user, workspace, user_message)
+
+        def _search():
+            from web_search import enhance_message_with_search
+            enhanced, did_search = enhance_message_with_search(user_message)
+            return enhanced[len(user_message):] if did_search else ""
+
+        def _kb():
+            # KB enhancement: query shared psychology knowledge base
+            if not user.get("settings", {}).get("kb_enabled", False):
+                return ""
+            return query_shared_kb(user_message)
+
+        def _prev_context(conversation):
+            # Previous conversation context (only on first message of a new conversation)
+            if conversation.get("metadata", {}).get("total_messages", 0) != 0:
+                return ""
+            return get_previous_conversation_context(user_id, conversation["_id"], db)
+
+        def _thread(workspace, conversation):
+            # Per-conversation AnythingLLM thread — isolates concurrent browser tabs
+            # so streams from different conversations can't bleed into each other.
+            # Default (None, "") falls back to workspace-level chat. A new slug is
+            # saved below only if this turn uses it — after a timeout the late
+            # thread (and its history replay) is dropped and the next turn retries.
+            thread_api = AnythingLLMAPI(
+                base_url=workspace_manager.anythingllm_base_url,
+                api_key=workspace_manager.anythingllm_api_key,
+                workspace_slug=workspace["slug"]
+            )
+            return ensure_thread_for_conversation(thread_api, conversation, db, persist=False)
+
+        def _companion():
+            return get_active_companion(user_id, user_doc=user)
+
+        def _lorebook(conversation, companion, prompt_sync):
+            # Lorebook injection — see comment in /api/chat for rationale. Selection
+            # fills whatever the budget leaves after memory.
+            return build_lorebook_prefix(
+                user_message, conversation, companion,
+                budget_tokens=budget.allowance("lorebook", pending={"memory": prompt_sync}),
+            )
+
+        pipe = EnrichmentPipeline("chat_stream", timer=_timer)
+        pipe.add("workspace", _workspace, required=True)
+        pipe.add("conversation", _conversation, required=True)
+        pipe.add("uploads", _uploads, timeout=step_timeout("uploads", 15.0), default={})
+        pipe.add("save_user_message", _save_user_message, after=("conversation", "uploads"), required=True)
+        pipe.add("prompt_sync", _prompt_sync, after=("workspace",),
+                 timeout=step_timeout("prompt_sync", 8.0), default="")
+        pipe.add("search", _search, timeout=step_timeout("search", 3.5), default="")
+        pipe.add("kb", _kb, timeout=step_timeout("kb", 3.0), default="")
+        pipe.add("prev_context", _prev_context, after=("conversation",),
+                 timeout=step_timeout("prev_context", 2.0), default="")
+        pipe.add("thread", _thread, after=("workspace", "conversation"),
+                 timeout=step_timeout("thread", 10.0), default=(None, ""))
+        pipe.add("companion", _companion, timeout=step_timeout("companion", 3.0), default=None)
+        pipe.add("lorebook", _lorebook, after=("conversation", "companion", "prompt_sync"),
+                 timeout=step_timeout("lorebook", 2.0), default="")
+        enriched = pipe.run()
+
+        workspace = enriched["workspace"]
+        workspace_slug = workspace["slug"]
+        conversation = enriched["conversation"]
+        is_first_message = conversation.get("metadata", {}).get("total_messages", 0) == 0
+        thread_slug, thread_history_prefix = enriched["thread"]
+        if pipe.status.get("thread") == "ok":
+            persist_thread_slug(db, conversation, thread_slug)
+
+        budget.add("search", enriched["search"])
+        budget.add("kb", enriched["kb"])
+
         # Import context injection
         conv_meta = conversation.get("metadata", {})
         if conv_meta.get("imported_from") and not conv_meta.get("import_session_activated"):
@@ -2297,22 +2348,19 @@ def chat_stream():
                     role_label = "User" if m["role"] == "user" else "Assistant"
                     context_lines.append(f"{role_label}: {m['content'][:500]}")
                 context_block = "\n".join(context_lines)
-                message_to_send = (
+                budget.add("import_context", (
                     f"[以下是我们之前在其他平台的对话记录，请基于这些上下文继续和我对话，"
                     f"保持之前的语气和话题]\n{context_block}\n"
-                    f"[对话记录结束，请继续]\n\n{message_to_send}"
-                )
+                    f"[对话记录结束，请继续]\n\n"
+                ))
             db.db["conversations"].update_one(
                 {"_id": conversation["_id"]},
                 {"$set": {"metadata.import_session_activated": True}}
             )
 
-        # Previous conversation context injection (only on first message of a new conversation)
-        if is_first_message:
-            prev_context = get_previous_conversation_context(user_id, conversation["_id"], db)
-            if prev_context:
-                message_to_send = prev_context + message_to_send
-                logger.info("[CONTEXT] Injected previous conversation context into new chat")
+        if enriched["prev_context"]:
+            budget.add("prev_context", enriched["prev_context"])
+            logger.info("[CONTEXT] Injected previous conversation context into new chat")
 
         # Save user image base64 for potential IMAGE_EDIT processing
         _user_image_b64 = None
@@ -2323,32 +2371,13 @@ def chat_stream():
                     _user_image_b64 = cs.split(",", 1)[-1] if "," in cs else cs
                     break
 
-        # Per-conversation AnythingLLM thread — isolates concurrent browser tabs
-        # so streams from different conversations can't bleed into each other.
-        try:
-            _thread_api = AnythingLLMAPI(
-                base_url=workspace_manager.anythingllm_base_url,
-                api_key=workspace_manager.anythingllm_api_key,
-                workspace_slug=workspace_slug
-            )
-            thread_slug, thread_history_prefix = ensure_thread_for_conversation(_thread_api, conversation, db)
-        except Exception as e:
-            logger.warning(f"[THREAD] Setup failed, falling back to workspace-level chat: {e}")
-            thread_slug, thread_history_prefix = None, ""
-        _timer.mark("thread")
+        budget.add("history", thread_history_prefix)
+        budget.add("memory", enriched["prompt_sync"])
+        budget.add("lorebook", enriched["lorebook"])
 
-        if thread_history_prefix:
-            message_to_send = thread_history_prefix + message_to_send
-
-        # Lorebook injection — see comment in /api/chat for rationale.
-        try:
-            companion = get_active_companion(user_id, user_doc=user)
-            lore_prefix = build_lorebook_prefix(user_message, conversation, companion)
-            if lore_prefix:
-                message_to_send = lore_prefix + message_to_send
-        except Exception as e:
-            logger.warning(f"[LOREBOOK] /api/chat/stream injection failed (non-fatal): {e}")
-        _timer.mark("lorebook")
+        message_to_send = budget.assemble(user_message, hints)
+        if budget.trimmed():
+            logger.info(f"[BUDGET] Trimmed prompt context: {budget.summary()}")
 
         # Pre-load all variables needed inside generator
         conv_id = conversation["_id"]
@@ -2357,16 +2386,15 @@ def chat_stream():
         anythingllm_key = workspace_manager.anythingllm_api_key
 
         # Only emit per-step breakdown for the first message — that's where
-        # latency is felt; subsequent messages add log noise without insight.
-        if is_first_message:
+        # latency is felt — or when an enrichment step fell back to its default.
+        if is_first_message or pipe.degraded():
             _timer.summary()
 
     except Exception as e:
         logger.error(f"Chat stream setup error: {e}", exc_info=True)
         return jsonify({"error": str(e)}), 500
 
-    def _sse_event(event: str, data_dict: dict) -> str:
-        return f"event: {event}\ndata: {json.dumps(data_dict, ensure_ascii=False)}\n\n"
+    _sse_event = sse_event
 
     def generate():
         import re as _re
@@ -2382,12 +2410,24 @@ def chat_stream():
             workspace_slug=workspace_slug
         )
 
+        # Text tokens are batched into frames (first token goes out immediately)
+        _text = SSECoalescer()
+
         full_reply = ""
-        in_thinking = False
-        thinking_content = ""
-        initial_buffer = ""
-        initial_phase = True  # Buffer initial tokens to detect <think> tags
-        _tag_detect_buf = ""  # Rolling buffer for mid-stream <think> detection
+        # Splits thinking / reply text / [IMAGE:] [RENAME:] [EMOTION:] markers as tokens arrive
+        _parser = ThinkStreamParser()
+
+        def _emit(events):
+            for kind, value in events:
+                if kind == "text":
+                    frame = _text.add(value)
+                    if frame:
+                        yield frame
+                elif kind == "thinking" and show_thinking:
+                    frame = _text.flush()
+                    if frame:
+                        yield frame
+                    yield _sse_event("thinking", {"content": value})
 
         # Stream LLM in background thread, send keepalive while waiting
         chunk_queue = queue.Queue()
@@ -2411,15 +2451,20 @@ def chat_stream():
         try:
           while True:
             try:
-                msg_type, payload = chunk_queue.get(timeout=3)
+                msg_type, payload = chunk_queue.get(timeout=_text.timeout(3))
             except queue.Empty:
-                # No data in 3s — send keepalive to prevent connection drop
-                yield ": keepalive\n\n"
+                # Coalescing window elapsed — send what's pending; otherwise
+                # no data in 3s — send keepalive to prevent connection drop
+                _frame = _text.flush()
+                yield _frame if _frame else ": keepalive\n\n"
                 continue
 
             if msg_type == "done":
                 break
             elif msg_type == "error":
+                _frame = _text.flush()
+                if _frame:
+                    yield _frame
                 if not full_reply:
                     yield _sse_event("error", {"message": f"LLM error: {str(payload)}"})
                 break
@@ -2427,6 +2472,9 @@ def chat_stream():
             chunk = payload
             if chunk.get("error"):
                 err_msg = chunk["error"] if isinstance(chunk["error"], str) else "LLM error"
+                _frame = _text.flush()
+                if _frame:
+                    yield _frame
                 yield _sse_event("error", {"message": err_msg})
                 return
 
@@ -2435,113 +2483,7 @@ def chat_stream():
                 continue
 
             full_reply += token
-
-            # --- Initial phase: buffer to detect <think> tags ---
-            if initial_phase:
-                initial_buffer += token
-                lower_buf = initial_buffer.lower()
-                stripped_lower = lower_buf.lstrip()
-                if "<think>" in lower_buf or "<thought>" in lower_buf:
-                    in_thinking = True
-                    initial_phase = False
-                    for tag in ["<think>", "<thought>"]:
-                        idx = lower_buf.find(tag)
-                        if idx >= 0:
-                            before_tag = initial_buffer[:idx].strip()
-                            if before_tag:
-                                for ch in before_tag:
-                                    yield _sse_event("text", {"token": ch})
-                            after_tag = initial_buffer[idx + len(tag):]
-                            if after_tag:
-                                thinking_content += after_tag
-                            break
-                    continue
-                # Gemini-style thinking (e.g. "思考：...", "Thinking: ...")
-                _gemini_think = _re.match(
-                    r'^\s*(?:思考|Thinking|思考过程|Let me think|我(?:先)?(?:想想|思考一下|分析一下))[\s：:]+',
-                    initial_buffer, _re.IGNORECASE
-                )
-                if _gemini_think:
-                    in_thinking = True
-                    initial_phase = False
-                    thinking_content = initial_buffer[_gemini_think.end():]
-                    continue
-                # Bare "think " / "THOUGHT " prefix (e.g. "think The user wants...")
-                _think_prefix = _re.match(
-                    r'^\s*(?:THOUGHT|think)\s+',
-                    initial_buffer, _re.IGNORECASE
-                )
-                if _think_prefix and len(initial_buffer) > 15:
-                    in_thinking = True
-                    initial_phase = False
-                    thinking_content = initial_buffer[_think_prefix.end():]
-                    continue
-                # Flush as text when confident it's not thinking
-                should_flush = False
-                if len(initial_buffer) > 60:
-                    should_flush = True
-                elif len(initial_buffer) > 5:
-                    if not stripped_lower.startswith('<') and not _re.match(
-                        r'(?:思考|think|let\s)', stripped_lower, _re.IGNORECASE
-                    ):
-                        should_flush = True
-                if should_flush:
-                    initial_phase = False
-                    for ch in initial_buffer:
-                        yield _sse_event("text", {"token": ch})
-                continue
-
-            # --- Thinking mode ---
-            if in_thinking:
-                combined = thinking_content + token
-                lower_combined = combined.lower()
-                for close_tag in ["</think>", "</thought>"]:
-                    close_idx = lower_combined.find(close_tag)
-                    if close_idx >= 0:
-                        thinking_content = combined[:close_idx].strip()
-                        in_thinking = False
-                        if thinking_content and show_thinking:
-                            yield _sse_event("thinking", {"content": thinking_content})
-                        after_close = combined[close_idx + len(close_tag):]
-                        if after_close.strip():
-                            yield _sse_event("text", {"token": after_close})
-                        break
-                else:
-                    thinking_content += token
-                continue
-
-            # --- Normal streaming ---
-            # Mid-stream <think> detection (tag split across tokens)
-            _tag_detect_buf += token
-            if len(_tag_detect_buf) > 20:
-                _tag_detect_buf = _tag_detect_buf[-20:]
-            _lower_tdb = _tag_detect_buf.lower()
-            _found_mid_tag = False
-            for _mtag in ["<think>", "<thought>"]:
-                if _mtag in _lower_tdb:
-                    in_thinking = True
-                    _tidx = _lower_tdb.find(_mtag)
-                    _after = _tag_detect_buf[_tidx + len(_mtag):]
-                    if _after:
-                        thinking_content = _after
-                    _tag_detect_buf = ""
-                    _found_mid_tag = True
-                    break
-            # Also detect Grok reasoning pattern: "\nAssistant:" mid-stream
-            if not _found_mid_tag:
-                for _grok_marker in ["\nassistant:", "\nassistant\uff1a"]:
-                    if _grok_marker in _lower_tdb:
-                        in_thinking = True
-                        _tidx = _lower_tdb.find(_grok_marker)
-                        _after = _tag_detect_buf[_tidx + len(_grok_marker):]
-                        if _after:
-                            thinking_content = _after
-                        _tag_detect_buf = ""
-                        _found_mid_tag = True
-                        break
-            if _found_mid_tag:
-                continue
-            yield _sse_event("text", {"token": token})
+            yield from _emit(_parser.feed(token))
 
         except Exception as e:
             logger.error(f"[CHAT-STREAM] LLM error: {e}")
@@ -2549,81 +2491,21 @@ def chat_stream():
                 yield _sse_event("error", {"message": f"LLM error: {str(e)}"})
                 return
 
-        # --- Post-processing: clean full reply ---
-        reply = full_reply
-
-        # Strip thinking tags from full reply (in case our streaming logic missed some)
-        think_match = _re.search(r'<(?:think|thought)>(.*?)</(?:think|thought)>', reply, _re.DOTALL)
-        if think_match:
-            if not thinking_content:
-                thinking_content = think_match.group(1).strip()
-            reply = _re.sub(r'<(?:think|thought)>.*?</(?:think|thought)>', '', reply, flags=_re.DOTALL).strip()
-
-        # Handle THOUGHT/think prefix (no tags)
-        if not thinking_content and _re.match(r'^(?:THOUGHT|think)\s', reply, _re.IGNORECASE):
-            raw = _re.sub(r'^(?:THOUGHT|think)\s+', '', reply, flags=_re.IGNORECASE).strip()
-            _found_delim = False
-            for m in _re.finditer(r'\n([\u4e00-\u9fff（\uff08*「【《""])', raw):
-                candidate = raw[m.start(1):].strip()
-                if len(candidate) >= 10:
-                    thinking_content = raw[:m.start(1)].rstrip()
-                    reply = candidate
-                    _found_delim = True
-                    break
-            if not _found_delim:
-                # No Chinese delimiter — entire content after "think" is thinking
-                thinking_content = raw
-                reply = ""
-
-        # Handle Gemini "思考：..." prefix
-        if not thinking_content:
-            gemini_think_match = _re.match(
-                r'^(?:思考|Thinking|思考过程|Let me think|我(?:先)?(?:想想|思考一下|分析一下))[\s：:：]+(.+?)(?:\n\n|\n(?=[^\n]))',
-                reply, _re.DOTALL
-            )
-            if gemini_think_match:
-                thinking_content = gemini_think_match.group(1).strip()
-                reply = reply[gemini_think_match.end():].strip()
-
-        # Handle Grok reasoning leak: "Assistant:" meta-reasoning or Chinese analysis headers
-        # Grok sometimes appends internal reasoning as plain text after the roleplay response
-        # Always check regardless of existing thinking_content — Grok may leak even after <think> tags
-        grok_match = _re.search(r'\n\s*Assistant\s*[:：]', reply)
-        if not grok_match:
-            # Pattern 2: Standalone Chinese analysis headers at line start
-            grok_match = _re.search(
-                r'\n\s*(?:角色保持|亲密规则|情节推进|回复内容|场景设定|注意事项|互动建议|下一步)\s*[:：]',
-                reply
-            )
-        if grok_match:
-            candidate_reply = reply[:grok_match.start()].strip()
-            candidate_think = reply[grok_match.start():].strip()
-            if candidate_reply and len(candidate_reply) >= 10:
-                if thinking_content:
-                    thinking_content += "\n\n" + candidate_think
-                else:
-                    thinking_content = candidate_think
-                reply = candidate_reply
-                logger.info(f"[CHAT-STREAM] Stripped Grok reasoning ({len(candidate_think)} chars)")
-
-        # Strip IMAGE/IMAGE_EDIT tags from thinking content (prevent leak in thinking display)
-        if thinking_content:
-            thinking_content = _re.sub(r'\[IMAGE(?:_EDIT)?:\s*.+?\]', '', thinking_content, flags=_re.DOTALL).strip()
+        yield from _emit(_parser.finish())
+        _frame = _text.flush()
+        if _frame:
+            yield _frame
+        logger.debug(f"[CHAT-STREAM] SSE framing: {_text.tokens} tokens in {_text.frames} frames ({_text.bytes_sent} bytes)")
 
-        # Fallback: if reply empty but thinking has content
-        if not reply and thinking_content:
-            paragraphs = [p.strip() for p in thinking_content.split('\n\n') if p.strip()]
-            if paragraphs:
-                reply = paragraphs[-1]
-                if len(paragraphs) > 1:
-                    thinking_content = '\n\n'.join(paragraphs[:-1])
-                else:
-                    thinking_content = ""
+        # Reply / thinking / markers were separated while streaming
+        _parsed = _parser.result
+        reply = _parsed.reply
+        thinking_content = _parsed.thinking
 
         # Process image markers (threaded + keepalive to prevent SSE timeout)
         generated_images = []
-        from image_gen import extract_image_markers, check_daily_limit
-        reply, _img_prompts = extract_image_markers(reply)
+        from image_gen import check_daily_limit
+        _img_prompts = _parsed.images
         if _img_prompts:
             if not check_daily_limit(user_id, db):
                 logger.info(f"[CHAT-STREAM] Image daily limit reached for user {user_id}, notifying frontend")
@@ -2656,10 +2538,8 @@ def chat_stream():
 
         # Process [IMAGE_EDIT:] markers — edit user's uploaded image via BFL Kontext
         edited_images = []
-        _edit_match = _re.search(r'\[IMAGE_EDIT:\s*(.+?)\]', reply, _re.DOTALL)
-        if _edit_match and _user_image_b64:
-            _edit_prompt = _edit_match.group(1).strip()
-            reply = _re.sub(r'\s*\[IMAGE_EDIT:\s*.+?\]', '', reply, flags=_re.DOTALL).strip()
+        _edit_prompt = _parsed.image_edit
+        if _edit_prompt and _user_image_b64:
             logger.info(f"[IMAGE_EDIT] Detected edit tag, prompt: {_edit_prompt[:80]}")
             yield _sse_event("image_editing", {"prompt": _edit_prompt[:80]})
 
@@ -2686,18 +2566,11 @@ def chat_stream():
                     yield ": keepalive\n\n"
             if _edit_result[0]:
                 edited_images.append(_edit_result[0])
-        elif _edit_match:
-            # AI output IMAGE_EDIT tag but no user image — just strip it
-            reply = _re.sub(r'\s*\[IMAGE_EDIT:\s*.+?\]', '', reply, flags=_re.DOTALL).strip()
 
         # Rename detection
         companion_name_changed = None
-        rename_match = _re.search(r'\[RENAME:(.{1,20}?)\]', reply)
-        if rename_match:
-            new_name = rename_match.group(1).strip()
-            if new_name:
-                companion_name_changed = new_name
-                reply = _re.sub(r'\s*\[RENAME:.{1,20}?\]', '', reply).strip()
+        if _parsed.rename:
+            companion_name_changed = _parsed.rename
         else:
             rename_patterns = [
                 r'(?:以后|从现在起)?(?:叫你|叫做|改名|名字叫|就叫|改叫|你叫)\s*[「「"\'【]?(.{1,15}?)[」」"\'】]?(?:\s*[吧了啊呢好哦嘛吗]|$)',
@@ -2719,6 +2592,7 @@ def chat_stream():
                     {"_id": user_id},
                     {"$set": {"settings.companion_name": companion_name_changed}}
                 )
+                invalidate_user(user_id)
                 workspace_manager.update_system_prompt(
                     user_id, user["name"], companion_name=companion_name_changed
                 )
@@ -2749,13 +2623,7 @@ def chat_stream():
         except Exception as e:
             logger.warning(f"[CHAT-STREAM] DB save error: {e}")
 
-        # Extract emotion tag from reply before sending done event
-        import re as _re
-        _emotion_match = _re.search(r'\[EMOTION:(\w+)\]', reply)
-        _detected_emotion = None
-        if _emotion_match:
-            _detected_emotion = _emotion_match.group(1).strip().lower()
-            reply = _re.sub(r'\s*\[EMOTION:\w+\]', '', reply).strip()
+        _detected_emotion = _parsed.emotion
 
         # Emit done event
         done_data = {
@@ -2783,44 +2651,9 @@ def chat_stream():
             done_data["images"] = all_done_images
         yield _sse_event("done", done_data)
 
-        # Async tasks: memory + title
-        def _async_tasks():
-            try:
-                if os.environ.get("MEM0_ENABLED", "false").lower() == "true":
-                    from mem0_engine import process_memory, cleanup_expired_memories
-                    process_memory(user_id, user_message, reply)
-                    import random
-                    if random.random() < 0.05:
-                        cleanup_expired_memories(str(user_id))
-                else:
-                    from memory_engine import process_memory
-                    process_memory(user_id, user_message, reply)
-            except Exception as e:
-                logger.warning(f"[CHAT-STREAM] Memory error: {e}")
-        threading.Thread(target=_async_tasks, daemon=True).start()
-
-        if is_first_message:
-            def _async_title():
-                try:
-                    from memory_engine import _call_gemini
-                    prompt = (
-                        "Generate a very short conversation title (max 6 words) based on this chat. "
-                        "If the message is in Chinese, return Chinese title. If in English, return English title. "
-                        "Return ONLY the title text, nothing else. No quotes, no punctuation at the end.\n\n"
-                        f"User: {user_message[:200]}\nAssistant: {reply[:200]}"
-                    )
-                    title = _call_gemini(prompt)
-                    if title and len(title) < 50:
-                        title = title.strip().strip('"\'').strip()
-                        if title:
-                            from datetime import datetime as dt
-                            db.db["conversations"].update_one(
-                                {"_id": conv_id, "user_id": user_id},
-                                {"$set": {"title": title, "updated_at": dt.utcnow()}}
-                            )
-                except Exception:
-                    pass
-            threading.Thread(target=_async_title, daemon=True).start()
+        # Background jobs: memory + title (durable queue, chat_jobs.py)
+        queue_post_reply(user_id, user_message, reply, conversation_id=conv_id,
+                         is_first_message=is_first_message)
 
     resp = Response(generate(), content_type="text/event-stream; charset=utf-8")
     resp.headers['Cache-Control'] = 'no-cache, no-transform'
@@ -2908,11 +2741,11 @@ def voice_chat_stream():
         try:
             if conv_id_str:
                 conv_oid = ObjectId(conv_id_str)
-                conversation = db.get_conversation(conv_oid, user_id)
+                conversation = db.get_conversation_tail(conv_oid, user_id, HISTORY_TAIL)
                 if not conversation:
                     conversation = db.create_conversation(user_id)
             else:
-                conversation = db.get_active_conversation(user_id)
+                conversation = db.get_active_conversation(user_id, tail=HISTORY_TAIL)
 
             # ⚡ PERF: Upload audio in background thread to avoid blocking pipeline (~0.5s saved)
             import threading as _thr
@@ -3141,43 +2974,8 @@ def voice_chat_stream():
         except Exception as e:
             logger.warning(f"[STREAM] DB save error: {e}")
 
-        try:
-            def _async_tasks():
-                try:
-                    if os.environ.get("MEM0_ENABLED", "false").lower() == "true":
-                        from mem0_engine import process_memory, cleanup_expired_memories
-                        process_memory(user_id, transcript, reply)
-                        import random
-                        if random.random() < 0.05:
-                            cleanup_expired_memories(str(user_id))
-                    else:
-                        from memory_engine import process_memory
-                        process_memory(user_id, transcript, reply)
-                except Exception:
-                    pass
-                if is_first_message:
-                    try:
-                        from memory_engine import _call_gemini
-                        prompt = (
-                            "Generate a very short conversation title (max 6 words). "
-                            "Chinese message → Chinese title. English → English title. "
-                            "Return ONLY the title.\n\n"
-                            f"User: {transcript[:200]}\nAssistant: {reply[:200]}"
-                        )
-                        title = _call_gemini(prompt)
-                        if title and len(title) < 50:
-                            title = title.strip().strip('"\'').strip()
-                            if title:
-                                from datetime import datetime as dt
-                                db.db["conversations"].update_one(
-                                    {"_id": conversation["_id"], "user_id": user_id},
-                                    {"$set": {"title": title, "updated_at": dt.utcnow()}}
-                                )
-                    except Exception:
-                        pass
-            threading.Thread(target=_async_tasks, daemon=True).start()
-        except Exception:
-            pass
+        queue_post_reply(user_id, transcript, reply, conversation_id=conversation["_id"],
+                         is_first_message=is_first_message)
 
         yield _sse_event("done", {})
 
@@ -3210,7 +3008,7 @@ def list_conversations():
                 "title": conv.get("title", "新对话"),
                 "updated_at": conv.get("updated_at").isoformat() if conv.get("updated_at") else None,
                 "message_count": conv.get("metadata", {}).get("total_messages", 0),
-                "preview": conv.get("messages", [{}])[-1].get("content", "")[:50] if conv.get("messages") else "",
+                "preview": _conversation_preview(conv),
                 "imported_from": conv.get("metadata", {}).get("imported_from")
             }
             for conv in conversations
@@ -3218,10 +3016,18 @@ def list_conversations():
     })
 
 
+def _conversation_preview(conv):
+    """列表预览：metadata.last_message_preview；未迁移的旧对话取内嵌的最后一条"""
+    preview = conv.get("metadata", {}).get("last_message_preview")
+    if preview is None and conv.get("messages"):
+        preview = conv["messages"][-1].get("content", "")
+    return (preview or "")[:50]
+
+
 @app.route("/api/conversations/<conv_id>", methods=["GET"])
 @login_required
 def get_conversation(conv_id):
-    """获取特定对话的详情"""
+    """获取特定对话的详情（可选 ?limit=N 只返回最近 N 条，更早的用 /messages?before= 翻页）"""
     user_id = get_current_user_id()
 
     try:
@@ -3232,15 +3038,58 @@ def get_conversation(conv_id):
     if not conversation:
         return jsonify({"error": "Conversation not found"}), 404
 
+    limit = request.args.get("limit", type=int)
+    if limit:
+        messages = db.get_messages(conversation["_id"], limit=limit + 1)
+        has_more = len(messages) > limit
+        messages = messages[1:] if has_more else messages
+    else:
+        messages = list(db.iter_conversation_messages(conversation["_id"]))
+        has_more = False
+
     return jsonify({
         "id": str(conversation["_id"]),
         "title": conversation.get("title", "新对话"),
-        "messages": conversation.get("messages", []),
+        "messages": messages,
+        "has_more": has_more,
         "created_at": conversation.get("created_at").isoformat() if conversation.get("created_at") else None,
         "updated_at": conversation.get("updated_at").isoformat() if conversation.get("updated_at") else None
     })
 
 
+@app.route("/api/conversations/<conv_id>/messages", methods=["GET"])
+@login_required
+def list_conversation_messages(conv_id):
+    """
+    分页获取对话消息（按时间正序）。
+    查询参数:
+      before: 可选，seq 游标 — 只返回 seq < before 的消息；为空则取最新一页
+      limit: 每页条数，默认 50，最大 200
+    返回 next_before：下一页（更早）的游标，没有更多时为 null
+    """
+    user_id = get_current_user_id()
+    try:
+        conv_oid = ObjectId(conv_id)
+    except Exception:
+        return jsonify({"error": "Invalid conversation ID"}), 400
+
+    if not db.get_conversation(conv_oid, user_id):
+        return jsonify({"error": "Conversation not found"}), 404
+
+    before = request.args.get("before", type=int)
+    limit = max(1, min(request.args.get("limit", 50, type=int), 200))
+    messages = db.get_messages(conv_oid, before=before, limit=limit + 1)
+    has_more = len(messages) > limit
+    if has_more:
+        messages = messages[1:]
+
+    return jsonify({
+        "messages": messages,
+        "has_more": has_more,
+        "next_before": messages[0]["seq"] if has_more and messages else None,
+    })
+
+
 def _eager_create_thread(user_id, conversation_id):
     """
     Pre-create the AnythingLLM thread for a freshly-made conversation so the
@@ -3249,7 +3098,7 @@ def _eager_create_thread(user_id, conversation_id):
     thread inline as before.
     """
     try:
-        conv = db.db["conversations"].find_one({"_id": conversation_id})
+        conv = db.get_conversation_tail(conversation_id, user_id, 10)
         if not conv or conv.get("anythingllm_thread_slug"):
             return
         ws_result = workspace_manager.get_or_create_workspace(user_id)
@@ -3400,9 +3249,10 @@ def export_all_conversations():
     user = get_current_user()
     fmt = request.args.get("format", "json").lower()
 
-    # 1. 获取所有对话（含完整 messages）
+    # 1. 获取所有对话（消息在下面按对话逐个从 messages 集合读）
     convs = list(db.db["conversations"].find(
-        {"user_id": user_id, "is_active": True}
+        {"user_id": user_id, "is_active": True},
+        {"messages": 0}
     ).sort("updated_at", -1))
 
     # 2. 获取角色信息
@@ -3446,7 +3296,7 @@ def export_all_conversations():
         for conv in convs:
             title = conv.get("title", "Untitled")
             lines.append(f"--- {title} ---")
-            for msg in conv.get("messages", []):
+            for msg in db.iter_conversation_messages(conv["_id"]):
                 ts = msg.get("timestamp", "")
                 if hasattr(ts, "strftime"):
                     ts = ts.strftime("%Y-%m-%d %H:%M")
@@ -3496,7 +3346,7 @@ def export_all_conversations():
                 "created_at": conv.get("created_at", "").isoformat() if hasattr(conv.get("created_at", ""), "isoformat") else str(conv.get("created_at", "")),
                 "messages": [],
             }
-            for msg in conv.get("messages", []):
+            for msg in db.iter_conversation_messages(conv["_id"]):
                 ts = msg.get("timestamp", "")
                 if hasattr(ts, "isoformat"):
                     ts = ts.isoformat()
@@ -3832,6 +3682,7 @@ def personality_test_submit():
         {"_id": user_id},
         {"$set": {"personality_test": personality_test}}
     )
+    invalidate_user(user_id)
 
     # 更新 system prompt
     try:
@@ -3877,42 +3728,67 @@ def require_admin(f):
     return decorated
 
 
-@app.route("/api/admin/sync-all", methods=["POST"])
-@require_admin
-def admin_sync_all():
-    """一键同步所有用户的 system prompt + 知识库文档"""
+def _start_sync_job(kind: str):
+    """后台启动（或续跑）批量同步任务，立即返回任务进度；同类任务在跑时返回该任务"""
+    from sync_engine import start_job
     try:
-        result = workspace_manager.sync_all()
-        return jsonify(result)
+        params = {}
+        body = request.get_json(silent=True) or {}
+        if "regenerate_persona" in body:
+            params["regenerate_persona"] = bool(body["regenerate_persona"])
+        if "force" in body:
+            # 忽略 workspace 指纹，全部重新下发（AnythingLLM 侧被手动改过时用）
+            params["force"] = bool(body["force"])
+        job = start_job(kind, params)
+        return jsonify({"success": True, "job": job}), 202
     except Exception as e:
-        logger.error(f"Admin sync-all failed: {e}")
+        logger.error(f"Admin sync {kind} failed to start: {e}")
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/api/admin/sync-all", methods=["POST"])
+@require_admin
+def admin_sync_all():
+    """一键同步所有用户的 system prompt + 知识库文档（异步，轮询 /api/admin/sync-jobs/<id>）"""
+    return _start_sync_job("all")
+
+
 @app.route("/api/admin/sync-prompts", methods=["POST"])
 @require_admin
 def admin_sync_prompts():
-    """只同步所有用户的 system prompt"""
-    try:
-        result = workspace_manager.sync_all_system_prompts()
-        return jsonify(result)
-    except Exception as e:
-        logger.error(f"Admin sync-prompts failed: {e}")
-        return jsonify({"error": str(e)}), 500
+    """只同步所有用户的 system prompt（异步）"""
+    return _start_sync_job("prompts")
 
 
 @app.route("/api/admin/sync-documents", methods=["POST"])
 @require_admin
 def admin_sync_documents():
-    """只同步所有用户的知识库文档"""
+    """只同步所有用户的知识库文档（异步）"""
+    return _start_sync_job("documents")
+
+
+@app.route("/api/admin/sync-jobs", methods=["GET"])
+@require_admin
+def admin_list_sync_jobs():
+    """最近的批量同步任务"""
+    from sync_engine import list_jobs
     try:
-        result = workspace_manager.sync_documents_for_all_users()
-        return jsonify(result)
+        return jsonify({"jobs": list_jobs()})
     except Exception as e:
-        logger.error(f"Admin sync-documents failed: {e}")
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/api/admin/sync-jobs/<job_id>", methods=["GET"])
+@require_admin
+def admin_get_sync_job(job_id):
+    """批量同步任务进度"""
+    from sync_engine import get_job
+    job = get_job(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify({"job": job})
+
+
 @app.route("/api/admin/stats", methods=["GET"])
 @require_admin
 def admin_stats():
@@ -3923,12 +3799,26 @@ def admin_stats():
         feedback_count = db.db["feedbacks"].count_documents({})
         waitlist_count = db.db["waitlist"].count_documents({})
         contact_count = db.db["contacts"].count_documents({})
+        from redis_client import fingerprint_stats
+        from web_search import search_gate_stats
+        from mem0_engine import memory_cache_stats
+        from embed_cache import embed_cache_stats
+        from job_queue import queue_stats
         return jsonify({
             "users": user_count,
             "workspaces": workspace_count,
             "feedbacks": feedback_count,
             "waitlist": waitlist_count,
-            "contacts": contact_count
+            "contacts": contact_count,
+            "prompt_fingerprints": fingerprint_stats(),
+            "anythingllm_pool": pool_metrics(),
+            "conversation_tail": tail_read_stats(),
+            "user_cache": user_cache_stats(),
+            "local_caches": cache_stats(),
+            "search_gate": search_gate_stats(),
+            "memory_snapshots": memory_cache_stats(),
+            "embedding_cache": embed_cache_stats(),
+            "job_queue": queue_stats(),
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -4222,9 +4112,10 @@ def confirm_persona():
                 "$unset": unset_fields
             }
         )
+        invalidate_user(user_id)
 
         # 更新 system prompt（会自动从 user.settings.custom_persona 读取）
-        user = db.db["users"].find_one({"_id": user_id})
+        user = get_user(user_id)
         user_name = user.get("name", "Friend") if user else "Friend"
         result = workspace_manager.update_system_prompt(user_id, user_name)
 
@@ -4291,6 +4182,7 @@ def _migrate_lore_fields(user_id, settings):
             }
         }
     )
+    invalidate_user(user_id)
     logger.info(f"[LORE] Migrated old lore fields for user {user_id}, docs={len(migrated_docs)}")
 
 
@@ -4352,12 +4244,12 @@ def import_lore():
         from datetime import datetime
 
         # 懒迁移旧字段
-        user = db.db["users"].find_one({"_id": user_id})
+        user = get_user(user_id)
         settings = (user or {}).get("settings", {})
         _migrate_lore_fields(user_id, settings)
 
         # 重新读取（迁移后可能变化）
-        user = db.db["users"].find_one({"_id": user_id})
+        user = get_user(user_id)
         existing_docs = (user or {}).get("settings", {}).get("custom_lore_docs", [])
 
         # 检查数量上限
@@ -4417,6 +4309,7 @@ def import_lore():
                 {"_id": user_id},
                 {"$push": {"settings.custom_lore_docs": new_doc_entry}}
             )
+            invalidate_user(user_id)
             logger.info(f"[LORE] Knowledge base doc added for user {user_id}: {doc_name} (location: {doc_location})")
             return jsonify({
                 "success": True,
@@ -4455,25 +4348,22 @@ def clear_persona():
                 "settings.image_appearance": "",
             }}
         )
+        invalidate_user(user_id)
 
         # Wipe the active companion's extracted lorebook entries — they were
         # derived from the now-deleted persona text and would otherwise leak
         # the old character into the personality-test fallback persona.
         try:
-            from companion_service import get_active_companion
-            from datetime import datetime as _dt
+            from companion_service import get_active_companion, clear_lorebook
             comp = get_active_companion(user_id)
             if comp:
-                db.db["companions"].update_one(
-                    {"_id": comp["_id"], "user_id": user_id},
-                    {"$set": {"lorebook_entries": [], "updated_at": _dt.utcnow()}},
-                )
+                clear_lorebook(comp["_id"], user_id)
                 logger.info(f"[PERSONA] Cleared lorebook entries on companion {comp['_id']}")
         except Exception as e:
             logger.warning(f"[PERSONA] Lorebook clear failed (non-fatal): {e}")
 
         # 更新 system prompt（会回退到性格测试 persona 或默认）
-        user = db.db["users"].find_one({"_id": user_id})
+        user = get_user(user_id)
         user_name = user.get("name", "Friend") if user else "Friend"
         result = workspace_manager.update_system_prompt(user_id, user_name)
 
@@ -4569,6 +4459,7 @@ def _record_expression_generation(user_id):
         {"_id": user_id},
         {"$set": {"settings.expression_generation_log": kept}},
     )
+    invalidate_user(user_id)
 
 
 @app.route("/api/characters/generate-expressions", methods=["POST"])
@@ -4596,7 +4487,7 @@ def generate_expressions():
     style = data.get("style", "anime")
 
     if not appearance:
-        user = db.db["users"].find_one({"_id": user_id})
+        user = get_user(user_id)
         if user and user.get("settings"):
             appearance = user["settings"].get("image_appearance", "")
         if not appearance:
@@ -4698,6 +4589,7 @@ def generate_expressions():
                         },
                     },
                 )
+                invalidate_user(user_id)
                 db.db["expression_jobs"].update_one(
                     {"_id": job_id},
                     {"$set": {"status": "done", "result": result, "step": 4, "progress": "Complete!"}},
@@ -4853,7 +4745,7 @@ def regenerate_emotion():
         return jsonify({"error": "已有生成任务进行中，请稍候"}), 409
 
     # Get existing expression data
-    user = db.db["users"].find_one({"_id": user_id})
+    user = get_user(user_id)
     if not user:
         return jsonify({"error": "User not found"}), 404
 
@@ -4934,8 +4826,9 @@ def regenerate_emotion():
                     {"_id": user_id},
                     {"$set": {f"settings.character_expressions.webpUrls.{emotion}": new_url}},
                 )
+                invalidate_user(user_id)
                 # Return the full updated expressions in the job result
-                updated_user = db.db["users"].find_one({"_id": user_id})
+                updated_user = get_user(user_id)
                 updated_expressions = updated_user.get("settings", {}).get("character_expressions", {})
                 db.db["expression_jobs"].update_one(
                     {"_id": job_id},
@@ -4970,7 +4863,7 @@ def regenerate_emotion():
 def expression_history():
     """List saved expression history for current user."""
     user_id = get_current_user_id()
-    user = db.db["users"].find_one({"_id": user_id}) or {}
+    user = get_user(user_id) or {}
     settings = user.get("settings", {})
     history = settings.get("character_expressions_history", [])
     current = settings.get("character_expressions", {})
@@ -4988,6 +4881,7 @@ def expression_history():
             {"_id": user_id},
             {"$set": {"settings.character_expressions_history": [seeded]}},
         )
+        invalidate_user(user_id)
         history = [seeded]
 
     return jsonify({"history": history, "current": current})
@@ -5004,7 +4898,7 @@ def restore_expression():
     if not entry_id:
         return jsonify({"error": "Missing id"}), 400
 
-    user = db.db["users"].find_one({"_id": user_id})
+    user = get_user(user_id)
     if not user:
         return jsonify({"error": "User not found"}), 404
 
@@ -5021,6 +4915,7 @@ def restore_expression():
             "settings.character_display_mode": "micro",
         }},
     )
+    invalidate_user(user_id)
     logger.info(f"[EXPR_GEN] Restored expression {entry_id} for user {user_id}")
     return jsonify({"success": True, "expressions": entry["data"]})
 
@@ -5040,6 +4935,7 @@ def delete_expression_history():
         {"_id": user_id},
         {"$pull": {"settings.character_expressions_history": {"id": entry_id}}},
     )
+    invalidate_user(user_id)
     logger.info(f"[EXPR_GEN] Deleted history entry {entry_id} for user {user_id}")
     return jsonify({"success": True})
 
@@ -5053,13 +4949,13 @@ def clear_lore():
     doc_id = data.get("doc_id")  # 可选：指定删除哪个文档
 
     try:
-        user = db.db["users"].find_one({"_id": user_id})
+        user = get_user(user_id)
         settings = (user or {}).get("settings", {})
 
         # 懒迁移旧字段
         _migrate_lore_fields(user_id, settings)
         # 重新读取
-        user = db.db["users"].find_one({"_id": user_id})
+        user = get_user(user_id)
         docs = (user or {}).get("settings", {}).get("custom_lore_docs", [])
 
         # 获取 workspace slug
@@ -5091,6 +4987,7 @@ def clear_lore():
                 {"_id": user_id},
                 {"$pull": {"settings.custom_lore_docs": {"id": doc_id}}}
             )
+            invalidate_user(user_id)
             logger.info(f"[LORE] Removed doc {doc_id} for user {user_id}")
         else:
             # 删除全部文档
@@ -5105,6 +5002,7 @@ def clear_lore():
                 {"_id": user_id},
                 {"$set": {"settings.custom_lore_docs": []}}
             )
+            invalidate_user(user_id)
             logger.info(f"[LORE] Cleared all {len(docs)} docs for user {user_id}")
 
         return jsonify({"success": True})
@@ -5128,7 +5026,7 @@ def custom_status():
     _migrate_lore_fields(user_id, settings)
     # 重新读取（迁移后可能变化）
     if "custom_lore_status" in settings and "custom_lore_docs" not in settings:
-        user = db.db["users"].find_one({"_id": user_id})
+        user = get_user(user_id)
         settings = (user or {}).get("settings", {})
 
     return jsonify({
@@ -5262,6 +5160,7 @@ def voice_tts():
                             {"_id": user_id},
                             {"$set": {"settings.voice_style": voice_style}}
                         )
+                        invalidate_user(user_id)
                     except Exception:
                         pass
 
@@ -5605,7 +5504,7 @@ def _serialize_companion(comp: dict) -> dict:
             "canon_wiki_url": card.get("canon_wiki_url", "") or "",
             "extracted_at": _iso(card.get("extracted_at")) if card.get("extracted_at") else None,
         },
-        "lorebook_entries": comp.get("lorebook_entries", []) or [],
+        "lorebook_entries": get_lorebook(comp)[0],
         "extraction_status": comp.get("extraction_status", "pending"),
         "extraction_error": comp.get("extraction_error"),
         "lorebook_extracted_at": _iso(comp.get("lorebook_extracted_at")) if comp.get("lorebook_extracted_at") else None,
@@ -5643,14 +5542,14 @@ def get_active_companion_route():
 @app.route("/api/companions/<companion_id>/lorebook", methods=["GET"])
 @login_required
 def list_lorebook_entries_route(companion_id):
-    from companion_service import get_companion_by_id
+    from companion_service import get_companion_by_id, get_lorebook
     user_id = get_current_user_id()
     comp = get_companion_by_id(companion_id, user_id)
     if not comp:
         return jsonify({"error": "Companion not found"}), 404
     return jsonify({
         "success": True,
-        "entries": comp.get("lorebook_entries", []) or [],
+        "entries": get_lorebook(comp)[0],
         "extraction_status": comp.get("extraction_status", "pending"),
         "extraction_error": comp.get("extraction_error"),
     })
@@ -5670,12 +5569,15 @@ def companion_extraction_status_route(companion_id):
     if not comp:
         return jsonify({"error": "Companion not found"}), 404
     card = comp.get("character_card") or {}
-    entries = comp.get("lorebook_entries") or []
+    if comp.get("lorebook_migrated"):
+        entry_count = comp.get("lorebook_count", 0)
+    else:
+        entry_count = len(get_lorebook(comp)[0])
     return jsonify({
         "success": True,
         "status": comp.get("extraction_status", "pending"),
         "error": comp.get("extraction_error"),
-        "lorebook_entry_count": len(entries),
+        "lorebook_entry_count": entry_count,
         "card_ready": bool(card.get("identity") and card.get("voice_traits")),
         "card_dialog_count": len(card.get("example_dialogs") or []),
         "extracted_at": (
@@ -5807,20 +5709,26 @@ def prompt_debug_route():
     conv_id_str = ""
     if conversation_id:
         try:
-            conv = db.get_conversation(ObjectId(conversation_id), user_id)
+            conv = db.get_conversation_tail(ObjectId(conversation_id), user_id, SCAN_WINDOW_TURNS)
             if conv:
-                history_msgs = conv.get("messages", []) or []
-                history_texts = [(m.get("content") or "") for m in history_msgs[-SCAN_WINDOW_TURNS:]]
+                history_texts = [(m.get("content") or "") for m in conv["messages"]]
                 conv_id_str = str(conv["_id"])
                 state = get_state(conv_id_str)
         except Exception:
             pass
 
     companion = get_active_companion(user_id, user_doc=user)
-    entries = (companion or {}).get("lorebook_entries") or []
+    entries, fingerprint = get_lorebook(companion, enabled_only=True)
+
+    vector_index = None
+    if companion and companion.get("lorebook_vectors_version"):
+        from lorebook_vectors import load_index
+        vector_index = load_index(companion)
 
     selected, used_tokens, _new_state = select_lorebook(
         message, history_texts, entries, state=state,
+        fingerprint=fingerprint,
+        vector_index=vector_index,
     )
     block = format_lorebook_block(selected)
 
@@ -5843,6 +5751,7 @@ def prompt_debug_route():
                 "strategy": e.get("strategy", "constant" if e.get("constant") else "selective"),
                 "tokens": estimate_tokens(e.get("content", "")),
                 "matched_via": e.get("_match_reason", "?"),
+                "vector_score": e.get("_vector_score"),
             }
             for e in selected
         ],
@@ -17,6 +17,7 @@ from flask import request, jsonify, current_app
 from bson import ObjectId
 
 from database import db
+from user_cache import get_user, invalidate_user
 
 
 # ==================== 密码处理 ====================
@@ -207,7 +208,7 @@ def login_required(f):
         # 获取用户信息
         user_id = payload.get("user_id")
         try:
-            user = db.get_user_by_id(ObjectId(user_id))
+            user = get_user(ObjectId(user_id))
         except Exception:
             return jsonify({"error": "Invalid user ID"}), 401
 
@@ -317,6 +318,7 @@ def handle_google_login(google_user_info: Dict[str, Any], user_agent: str = "")
                 {"_id": existing_user["_id"]},
                 {"$set": merge_fields}
             )
+            invalidate_user(existing_user["_id"])
             db.update_user_login(existing_user["_id"])
             user = db.get_user_by_id(existing_user["_id"])
             is_new_user = False
@@ -395,6 +397,7 @@ def handle_email_register(email: str, password: str, name: Optional[str] = None)
                 "updated_at": datetime.utcnow()
             }}
         )
+        invalidate_user(existing_user["_id"])
         send_verification_email(email, code, user_name)
         return {
             "success": True,
@@ -421,6 +424,7 @@ def handle_email_register(email: str, password: str, name: Optional[str] = None)
             "verification_code_sent_at": datetime.utcnow()
         }}
     )
+    invalidate_user(user["_id"])
 
     # 发送验证邮件
     send_verification_email(email, code, user_name)
@@ -448,6 +452,7 @@ def _register_test_account(email: str, password: str, name: Optional[str] = None
         except Exception as e:
             print(f"[TEST] Failed to delete workspace for {email}: {e}")
         db.db["users"].delete_one({"_id": existing["_id"]})
+        invalidate_user(existing["_id"])
         db.db["workspaces"].delete_many({"user_id": existing["_id"]})
 
     user = db.create_user(
@@ -461,6 +466,7 @@ def _register_test_account(email: str, password: str, name: Optional[str] = None
         {"_id": user["_id"]},
         {"$set": {"email_verified": True}}
     )
+    invalidate_user(user["_id"])
 
     token = JWTAuth.create_token(str(user["_id"]), email)
     refresh_token = create_refresh_token(user["_id"])
@@ -601,6 +607,7 @@ def handle_email_login(email: str, password: str, user_agent: str = "", ip: str
                     "verification_code_sent_at": datetime.utcnow()
                 }}
             )
+            invalidate_user(user["_id"])
             send_verification_email(email, code, user.get("name", ""))
 
         return {
@@ -671,6 +678,7 @@ def handle_verify_email(email: str, code: str, user_agent: str = "") -> Dict[str
             "updated_at": datetime.utcnow()
         }}
     )
+    invalidate_user(user["_id"])
 
     # 发放 JWT token + refresh token
     token = JWTAuth.create_token(str(user["_id"]), email)
@@ -719,6 +727,7 @@ def handle_resend_code(email: str) -> Dict[str, Any]:
             "verification_code_sent_at": datetime.utcnow()
         }}
     )
+    invalidate_user(user["_id"])
 
     send_verification_email(email, code, user.get("name", ""))
 
@@ -752,6 +761,7 @@ def handle_forgot_password(email: str) -> Dict[str, Any]:
             "reset_code_sent_at": datetime.utcnow()
         }}
     )
+    invalidate_user(user["_id"])
 
     send_password_reset_email(email, code, user.get("name", ""))
 
@@ -802,6 +812,7 @@ def handle_reset_password(email: str, code: str, new_password: str, user_agent:
         {"_id": user["_id"]},
         {"$set": update_fields}
     )
+    invalidate_user(user["_id"])
 
     # Security: revoke all existing sessions
     revoke_all_user_tokens(user["_id"])
@@ -0,0 +1,212 @@
+"""
+Dev tool — lorebook keyword matching: compiled keyword index (Aho-Corasick +
+token set, lorebook_engine.compile_lorebook) vs the previous per-entry,
+per-key _key_matches scan.
+
+Builds a synthetic HammerAI-sized lorebook (default 1000 entries, CJK and
+English keys of mixed length, multi-word phrases, secondary keys) and random
+3-turn scan windows that mention some of its keys. For every window both
+matchers must report the same entries with the same matched primary /
+secondary keys (token-vs-substring rules included — with jieba installed,
+short keys only fire as whole tokens). Then reports per-message time for the
+matching stage, the full select_lorebook call, and the one-off compile cost.
+
+Usage:
+  cd backend
+  python3 bench_lorebook.py
+  python3 bench_lorebook.py --entries 3000 --windows 500 --seed 7
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from lorebook_engine import (  # noqa: E402
+    SCAN_WINDOW_TURNS,
+    CompiledLorebook,
+    _JIEBA_OK,
+    _key_matches,
+    _token_cache,
+    _tokenize,
+    _window_tokens,
+    compile_lorebook,
+    lorebook_fingerprint,
+    select_lorebook,
+)
+
+CJK_CHARS = (
+    "风雨雪月星辰海山林花剑刀琴书茶酒城宫殿王后骑士龙凤猫狗狐狸魔法学院神殿森林"
+    "江湖门派长老弟子师父掌门秘籍灵石丹药妖兽阵法仙界凡人天道雷劫飞升洞府"
+)
+SYLLABLES = ["ka", "ri", "so", "mel", "dra", "van", "thor", "lin", "es", "tor", "quin", "ar", "ve", "lo", "nyx"]
+EN_WORDS = [
+    "sword", "castle", "dragon", "queen", "knight", "forest", "tavern", "moon", "oath",
+    "ember", "harbor", "winter", "silver", "shadow", "garden", "library", "archer", "relic",
+    "cat", "ink", "tea", "ash", "sky", "fox",
+]
+FILLER = [
+    "今天好累啊，", "你在做什么呢？", "我刚刚回到家，", "外面下雨了。", "想听你讲故事，",
+    "I was thinking about you. ", "Tell me more. ", "that sounds fun, ", "really? ",
+]
+
+
+def _name(rng):
+    """Invented proper noun — most lorebook keys are names nobody else uses."""
+    return "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+
+
+def _cjk_word(rng, n):
+    return "".join(rng.choice(CJK_CHARS) for _ in range(n))
+
+
+def _key(rng):
+    r = rng.random()
+    if r < 0.4:
+        return _cjk_word(rng, rng.randint(2, 4))
+    if r < 0.7:
+        w = _name(rng)
+        return w.capitalize() if rng.random() < 0.5 else w
+    if r < 0.8:
+        return rng.choice(EN_WORDS)
+    if r < 0.9:
+        return f"{_name(rng)} {rng.choice(EN_WORDS)}"
+    return f"{rng.choice(EN_WORDS)}{rng.randint(1, 99)}"
+
+
+def make_lorebook(rng, n):
+    entries = []
+    for i in range(n):
+        entries.append({
+            "id": f"e{i}",
+            "title": f"entry {i}",
+            "keys": [_key(rng) for _ in range(rng.randint(1, 6))],
+            "secondary_keys": [_key(rng) for _ in range(rng.randint(0, 3))] if rng.random() < 0.3 else [],
+            "selective_logic": rng.choice(["and_any", "and_all", "not_any", "not_all"]),
+            "content": "设定内容 " * rng.randint(5, 40),
+            "strategy": "constant" if rng.random() < 0.01 else "selective",
+            "insertion_order": rng.randint(0, 100),
+        })
+    return entries
+
+
+def make_turn(rng, entries):
+    """One chat message mentioning up to three random keys."""
+    parts = [rng.choice(FILLER) for _ in range(rng.randint(3, 10))]
+    for _ in range(rng.randint(0, 3)):
+        e = rng.choice(entries)
+        parts.insert(rng.randrange(len(parts) + 1), rng.choice(e["keys"]))
+    if rng.random() < 0.3:
+        parts.append(_cjk_word(rng, rng.randint(2, 5)))
+    return "".join(parts)
+
+
+def make_window(rng, entries):
+    """(user_message, history_texts) mentioning a few random keys."""
+    turns = [make_turn(rng, entries) for _ in range(SCAN_WINDOW_TURNS + 1)]
+    return turns[-1], turns[:-1]
+
+
+def scan_inputs(user_message, history_texts):
+    """Same window / tokens select_lorebook builds."""
+    parts = [user_message] + history_texts[-SCAN_WINDOW_TURNS:]
+    text = "\n".join(p for p in parts if p)
+    return text.lower(), _window_tokens(parts)
+
+
+def legacy_hits(entries, scan_lower, tokens):
+    hits = []
+    for i, e in enumerate(entries):
+        primary = [k for k in (e.get("keys") or []) if k]
+        mp = [k for k in primary if _key_matches(k, scan_lower, tokens)]
+        if mp:
+            secondary = [k for k in (e.get("secondary_keys") or []) if k]
+            hits.append((i, mp, [k for k in secondary if _key_matches(k, scan_lower, tokens)]))
+    return hits
+
+
+def compiled_hits(entries, scan_lower, tokens, fingerprint=None):
+    lorebook = compile_lorebook(entries, fingerprint)
+    matched = lorebook.matched_keys(scan_lower, tokens)
+    hits = []
+    for i in lorebook.candidates(matched):
+        e = entries[i]
+        mp = [k for k in (e.get("keys") or []) if k and k.lower() in matched]
+        secondary = [k for k in (e.get("secondary_keys") or []) if k]
+        hits.append((i, mp, [k for k in secondary if k.lower() in matched]))
+    return hits
+
+
+def per_call_us(fn, items, passes=1):
+    start = time.perf_counter()
+    for _ in range(passes):
+        for item in items:
+            fn(*item)
+    return (time.perf_counter() - start) * 1e6 / (passes * len(items))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=1000, help="Lorebook size (default 1000)")
+    parser.add_argument("--windows", type=int, default=200, help="Random 3-turn windows (default 200)")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    entries = make_lorebook(rng, args.entries)
+    windows = [make_window(rng, entries) for _ in range(args.windows)]
+    inputs = [scan_inputs(m, h) for m, h in windows]
+    n_keys = sum(len(e["keys"]) + len(e["secondary_keys"]) for e in entries)
+    avg_chars = statistics.mean(len(s) for s, _ in inputs)
+    print(f"lorebook: {len(entries)} entries, {n_keys} keys; {len(windows)} windows, "
+          f"avg {avg_chars:.0f} chars; jieba={'on' if _JIEBA_OK else 'off (substring fallback)'}")
+
+    mismatches = 0
+    fired = 0
+    for scan_lower, tokens in inputs:
+        want = legacy_hits(entries, scan_lower, tokens)
+        got = compiled_hits(entries, scan_lower, tokens)
+        fired += len(want)
+        if got != want:
+            mismatches += 1
+            if mismatches <= 3:
+                print(f"MISMATCH window={scan_lower[:80]!r}\n  legacy={want[:5]}\n  compiled={got[:5]}")
+    print(f"equivalence: {mismatches} mismatching window(s), {fired / len(inputs):.1f} entries hit per window")
+
+    start = time.perf_counter()
+    CompiledLorebook(entries)
+    compile_ms = (time.perf_counter() - start) * 1e3
+    fp = lorebook_fingerprint(entries)
+    fp_us = per_call_us(lambda: lorebook_fingerprint(entries), [()], passes=50)
+
+    legacy_us = per_call_us(lambda s, t: legacy_hits(entries, s, t), inputs)
+    compiled_us = per_call_us(lambda s, t: compiled_hits(entries, s, t, fp), inputs, passes=5)
+    select_us = per_call_us(
+        lambda m, h: select_lorebook(m, h, entries, state=None, rng=random.Random(0), fingerprint=fp),
+        windows, passes=5)
+
+    print("per message:")
+    print(f"  legacy per-key scan            {legacy_us:10.1f} µs")
+    print(f"  compiled index (cached)        {compiled_us:10.1f} µs   {legacy_us / compiled_us:6.1f}x")
+    print(f"  + rehash without cached fp    {fp_us:10.1f} µs")
+    print(f"  select_lorebook end-to-end     {select_us:10.1f} µs")
+    print(f"one-off compile per lorebook version: {compile_ms:.1f} ms")
+
+    # Consecutive turns of one conversation: each message is in the window for
+    # SCAN_WINDOW_TURNS + 1 turns, but only needs segmenting once.
+    conv = [make_turn(rng, entries) for _ in range(args.windows)]
+    turns = [(conv[t], conv[max(0, t - SCAN_WINDOW_TURNS):t]) for t in range(len(conv))]
+    joined_us = per_call_us(lambda m, h: _tokenize("\n".join([m] + h)), turns)
+    _token_cache.clear()
+    cached_us = per_call_us(lambda m, h: _window_tokens([m] + h), turns)
+    print(f"tokenize scan window per turn: joined {joined_us:.1f} µs, "
+          f"per-message cache {cached_us:.1f} µs ({joined_us / cached_us:.1f}x)")
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""
+Dev tool — lorebook selection replay: latency percentiles + deterministic hit sets.
+
+Generates synthetic companions (default 10 / 100 / 1000 entries; mixed CJK and
+English keys, secondary keys + selective logic, constant / sticky / cooldown /
+delay / probability settings) and replays multi-turn conversations through
+select_lorebook + format_lorebook_block exactly as build_lorebook_prefix does
+on the chat path, carrying the per-conversation state between turns in memory
+instead of Redis. Each conversation gets its own seeded RNG, so the probability
+gate — and therefore every hit set — is reproducible.
+
+Reports per lorebook size: p50 / p99 / max selection time, mean tokens used
+and entries fired per turn, and a digest over all hit sets. --hits writes the
+hit sets (one line per turn: size, conversation, turn, fired ids with reason)
+so two runs can be diffed; --compare checks a run against such a file and
+exits non-zero on any difference — run it before and after an optimization.
+
+Conversations come from --replay (JSONL, one conversation per line:
+{"messages": ["text", ...]} or {"messages": [{"role": "user", "content": ...}, ...]};
+only user turns are selected on, every message enters the scan window) or are
+synthesized (--conversations per size, --turns each, mentioning random keys of
+the lorebook).
+With --vectors, vectorized entries are also matched through an in-memory
+hashing-embedder index (lorebook_vectors.build_index).
+
+Usage:
+  cd backend
+  python3 bench_lorebook_replay.py
+  python3 bench_lorebook_replay.py --sizes 10,100,1000,3000 --conversations 50 --turns 40
+  python3 bench_lorebook_replay.py --hits /tmp/hits_before.txt
+  python3 bench_lorebook_replay.py --compare /tmp/hits_before.txt
+  python3 bench_lorebook_replay.py --replay recorded.jsonl --sizes 100
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_lorebook import _key, make_turn  # noqa: E402
+from lorebook_engine import (  # noqa: E402
+    SCAN_WINDOW_TURNS,
+    _JIEBA_OK,
+    compile_lorebook,
+    format_lorebook_block,
+    lorebook_fingerprint,
+    select_lorebook,
+)
+
+
+def make_companion(rng, n):
+    """Lorebook of n entries with the full range of activation settings."""
+    entries = []
+    for i in range(n):
+        r = rng.random()
+        strategy = "constant" if r < 0.02 else "vectorized" if r < 0.07 else "selective"
+        entries.append({
+            "id": f"e{i}",
+            "title": f"entry {i}",
+            "keys": [_key(rng) for _ in range(rng.randint(1, 5))],
+            "secondary_keys": [_key(rng) for _ in range(rng.randint(1, 3))] if rng.random() < 0.25 else [],
+            "selective_logic": rng.choice(["and_any", "and_all", "not_any", "not_all"]),
+            "content": "设定内容，" * rng.randint(5, 60),
+            "strategy": strategy,
+            "insertion_order": rng.randint(0, 200),
+            "probability": 100 if rng.random() < 0.7 else rng.choice([25, 50, 75, 90]),
+            "sticky": rng.choice([0, 0, 0, 1, 2, 3]),
+            "cooldown": rng.choice([0, 0, 0, 1, 2, 4]),
+            "delay": rng.choice([0, 0, 0, 0, 2, 5]),
+            "enabled": rng.random() > 0.03,
+        })
+    return entries
+
+
+def synthetic_conversations(rng, entries, count, turns):
+    """Alternating user / assistant messages that mention the lorebook's keys."""
+    return [[make_turn(rng, entries) for _ in range(turns * 2)] for _ in range(count)]
+
+
+def load_conversations(path):
+    """[(messages, user_turn_indexes)] from JSONL."""
+    convs = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            msgs = json.loads(line).get("messages") or []
+            texts, user_idx = [], []
+            for i, m in enumerate(msgs):
+                if isinstance(m, dict):
+                    texts.append(m.get("content") or "")
+                    if m.get("role", "user") == "user":
+                        user_idx.append(i)
+                else:
+                    texts.append(str(m))
+                    if i % 2 == 0:
+                        user_idx.append(i)
+            convs.append((texts, user_idx))
+    return convs
+
+
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return 0.0
+    k = min(len(sorted_vals) - 1, max(0, int(round(p / 100 * (len(sorted_vals) - 1)))))
+    return sorted_vals[k]
+
+
+def replay(entries, conversations, seed, label, vector_index=None):
+    """Returns (timings_us, tokens_used, fired_counts, hit_lines)."""
+    fingerprint = lorebook_fingerprint(entries)
+    compile_lorebook(entries, fingerprint)         # steady state — compile cost reported separately
+    timings, tokens, fired, lines = [], [], [], []
+    for ci, (messages, user_idx) in enumerate(conversations):
+        rng = random.Random(f"{seed}:{label}:{ci}")
+        state = {"turn": 0, "hits": {}}
+        for ti, mi in enumerate(user_idx):
+            history = messages[max(0, mi - SCAN_WINDOW_TURNS):mi]
+            start = time.perf_counter()
+            selected, used, state = select_lorebook(
+                messages[mi], history, entries, state=state, rng=rng,
+                fingerprint=fingerprint, vector_index=vector_index,
+            )
+            format_lorebook_block(selected)
+            timings.append((time.perf_counter() - start) * 1e6)
+            tokens.append(used)
+            fired.append(len(selected))
+            hit = " ".join(f"{e['id']}:{e.get('_match_reason', '?')[0]}" for e in selected)
+            lines.append(f"{label}\t{ci}\t{ti}\t{used}\t{hit}")
+    return timings, tokens, fired, lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10,100,1000", help="Lorebook sizes (default 10,100,1000)")
+    parser.add_argument("--conversations", type=int, default=20, help="Synthetic conversations per size (default 20)")
+    parser.add_argument("--turns", type=int, default=30, help="User turns per synthetic conversation (default 30)")
+    parser.add_argument("--replay", help="JSONL of recorded conversations (replaces synthetic ones)")
+    parser.add_argument("--vectors", action="store_true", help="Also match vectorized entries (hashing embedder)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--hits", help="Write hit sets to this file")
+    parser.add_argument("--compare", help="Compare hit sets with a file written by --hits")
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    recorded = load_conversations(args.replay) if args.replay else None
+    print(f"jieba={'on' if _JIEBA_OK else 'off (substring fallback)'}  seed={args.seed}  "
+          f"conversations={'recorded ' + str(len(recorded)) if recorded else args.conversations}")
+    print(f"  {'entries':>7} {'turns':>6} {'p50 µs':>9} {'p99 µs':>9} {'max µs':>9} "
+          f"{'tokens':>7} {'fired':>6} {'compile ms':>10}")
+
+    all_lines = []
+    for size in sizes:
+        rng = random.Random(f"{args.seed}:{size}")
+        entries = make_companion(rng, size)
+        if recorded:
+            conversations = recorded
+        else:
+            conversations = [
+                (msgs, list(range(0, len(msgs), 2)))
+                for msgs in synthetic_conversations(rng, entries, args.conversations, args.turns)
+            ]
+        vector_index = None
+        if args.vectors:
+            from lorebook_vectors import build_index
+            vector_index = build_index(entries)
+
+        start = time.perf_counter()
+        compile_lorebook(entries, f"cold:{args.seed}:{size}:{time.time_ns()}")
+        compile_ms = (time.perf_counter() - start) * 1e3
+
+        timings, tokens, fired, lines = replay(entries, conversations, args.seed, str(size), vector_index)
+        all_lines.extend(lines)
+        t = sorted(timings)
+        print(f"  {size:>7} {len(t):>6} {percentile(t, 50):9.1f} {percentile(t, 99):9.1f} {t[-1]:9.1f} "
+              f"{sum(tokens) / len(tokens):7.0f} {sum(fired) / len(fired):6.2f} {compile_ms:10.1f}")
+
+    digest = hashlib.blake2b("\n".join(all_lines).encode("utf-8"), digest_size=8).hexdigest()
+    print(f"hit-set digest: {digest}  ({len(all_lines)} turns)")
+
+    if args.hits:
+        with open(args.hits, "w", encoding="utf-8") as f:
+            f.write("\n".join(all_lines) + "\n")
+        print(f"hit sets written to {args.hits}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = [l.rstrip("\n") for l in f if l.strip()]
+        diffs = [(a, b) for a, b in zip(baseline, all_lines) if a != b]
+        if len(baseline) != len(all_lines):
+            print(f"COMPARE: turn count differs ({len(baseline)} baseline vs {len(all_lines)} now)")
+        for a, b in diffs[:10]:
+            print(f"COMPARE diff\n  baseline: {a}\n  now:      {b}")
+        print(f"compare: {len(diffs)} differing turn(s) vs {args.compare}")
+        sys.exit(1 if diffs or len(baseline) != len(all_lines) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+"""
+Dev tool — checks for batched memory extraction (memory_engine.process_memory_batch,
+chat_jobs debounce).
+
+1. Write-path equivalence (offline, always runs). Random memory documents
+   (some entries expired, some layers full) and random extraction results
+   (new facts, duplicates, updates of existing facts, overflow → eviction) go
+   through cleanup_expired + merge_memories. The resulting memory must equal
+   the stored document after applying memory_update_ops ($pull / $set with
+   arrayFilters / $push / $inc) to the original. Compared per layer as fact
+   multisets plus extraction_count. Ops are applied by a small in-process
+   evaluator, or against a real MongoDB with --mongo URI (scratch database
+   `soullink_bench`, dropped afterwards).
+
+2. LLM calls per active user (offline). Simulated chat sessions (bursts of
+   messages seconds apart, minutes between bursts, some trivial) are counted
+   per-turn vs under the trailing debounce for each --windows value.
+
+3. --live (needs GOOGLE_GEMINI_API_KEY): the built-in scripted sessions are
+   extracted turn by turn and as one batch, each merged into an empty memory;
+   prints both fact sets so the extracted memories can be compared.
+
+Usage:
+  cd backend
+  python3 bench_memory_batch.py
+  python3 bench_memory_batch.py --cases 2000 --windows 10,15,30 --max-turns 8
+  python3 bench_memory_batch.py --mongo mongodb://localhost:27017
+  python3 bench_memory_batch.py --live
+"""
+
+import argparse
+import copy
+import os
+import random
+import re
+import sys
+from collections import Counter
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from memory_engine import (  # noqa: E402
+    LAYERS, LONG_TERM_DAYS, MAX_LONG_TERM, MAX_PERMANENT, MAX_SHORT_TERM, SHORT_TERM_DAYS,
+    _should_skip_extraction, cleanup_expired, extract_memories, extract_memories_batch,
+    memory_update_ops, merge_memories, snapshot_memory,
+)
+
+FACTS = [
+    "用户叫小林", "用户养了一只叫团子的猫", "用户在杭州做产品经理", "用户喜欢吃火锅", "用户下周要去东京出差",
+    "用户有个妹妹在读大学", "用户最近在学吉他", "用户不喝咖啡", "User works at a bakery", "User's dog is named Max",
+    "User is learning Japanese", "User has an exam on Friday", "用户生日是三月五号", "用户喜欢跑步",
+    "用户和男朋友异地", "User prefers tea over coffee", "用户老家在成都", "用户怕黑", "用户在准备考研",
+    "User plays volleyball on weekends",
+]
+
+SESSIONS = [
+    [
+        ("我刚下班，今天在公司开了一整天会", "辛苦啦，先歇会儿吧"),
+        ("对了我下周要去东京出差，有点紧张", "第一次去东京吗？需要我帮你准备什么吗"),
+        ("嗯第一次，我日语只会一点点", "没关系，常用的几句我教你"),
+        ("好呀", "那我们从打招呼开始"),
+    ],
+    [
+        ("My dog Max chewed my shoes again lol", "Oh no, Max! Which pair this time?"),
+        ("my favourite running shoes. I run every morning before work", "That's a great habit — sorry about the shoes"),
+        ("yeah I work at a bakery so I start early", "Early mornings and fresh bread, not a bad trade"),
+    ],
+    [
+        ("我换工作了，现在在杭州做产品经理", "恭喜呀！新工作感觉怎么样"),
+        ("还行，就是加班多", "别太累着自己"),
+        ("晚安", "晚安，好梦"),
+    ],
+]
+
+TRIVIAL = ["好的", "哈哈", "晚安", "嗯嗯", "ok", "谢谢"]
+
+
+# ---------- 1. write-path equivalence ----------
+
+def _rand_item(rng, fact, now, expired_layer=None):
+    if expired_layer == "short_term":
+        age = timedelta(days=SHORT_TERM_DAYS + rng.randint(1, 30))
+    elif expired_layer == "long_term":
+        age = timedelta(days=LONG_TERM_DAYS + rng.randint(1, 30))
+    else:
+        age = timedelta(days=rng.randint(0, 10), minutes=rng.randint(0, 600))
+    ts = (now - age).replace(microsecond=(now - age).microsecond // 1000 * 1000)   # BSON ms precision
+    item = {"fact": fact, "created_at": ts}
+    if rng.random() < 0.9:
+        item["updated_at"] = ts
+    return item
+
+
+def random_case(rng, now):
+    facts = rng.sample(FACTS, len(FACTS))
+    memory = {"extraction_count": rng.randint(0, 40)}
+    caps = {"permanent": MAX_PERMANENT, "long_term": MAX_LONG_TERM, "short_term": MAX_SHORT_TERM}
+    for layer in LAYERS:
+        n = rng.choice([0, 1, 2, caps[layer]]) if layer != "permanent" else rng.choice([0, 2, 3])
+        items = []
+        for _ in range(n):
+            fact = facts.pop() if facts else f"fact {rng.random():.6f}"
+            expired = layer if layer != "permanent" and rng.random() < 0.2 else None
+            items.append(_rand_item(rng, fact, now, expired))
+        memory[layer] = items
+    existing = [i["fact"] for layer in LAYERS for i in memory[layer]]
+    extracted = {"new_memories": [], "updates": []}
+    for _ in range(rng.randint(0, 4)):
+        if existing and rng.random() < 0.2:
+            fact = rng.choice(existing)                                   # duplicate
+        else:
+            fact = facts.pop() if facts else f"new {rng.random():.6f}"
+        extracted["new_memories"].append({"fact": fact, "type": rng.choice(LAYERS)})
+    for _ in range(rng.randint(0, 2)):
+        if existing:
+            extracted["updates"].append({"old_fact": rng.choice(existing), "new_fact": f"更新 {rng.random():.6f}"})
+    return {"_id": 1, "memory": memory}, extracted
+
+
+def _matches(elem, cond):
+    if "$or" in cond:
+        return any(_matches(elem, c) for c in cond["$or"])
+    return all(elem.get(k) == v for k, v in cond.items())
+
+
+def apply_ops(doc, ops):
+    """Tiny evaluator for the update shapes memory_update_ops emits."""
+    for update, array_filters in ops:
+        for path, cond in update.get("$pull", {}).items():
+            _, layer = path.split(".")
+            doc["memory"][layer] = [e for e in doc["memory"].get(layer, []) if not _matches(e, cond)]
+        filters = {}
+        for f in array_filters or []:
+            (key, value), = f.items()
+            name, field = key.split(".")
+            filters[name] = (field, value)
+        for path, value in update.get("$set", {}).items():
+            m = re.fullmatch(r"memory\.(\w+)\.\$\[(\w+)\]\.(\w+)", path)
+            layer, name, field = m.groups()
+            f_field, f_value = filters[name]
+            for e in doc["memory"].get(layer, []):
+                if e.get(f_field) == f_value:
+                    e[field] = value
+        for path, value in update.get("$push", {}).items():
+            _, layer = path.split(".")
+            doc["memory"].setdefault(layer, []).extend(copy.deepcopy(value["$each"]))
+        for path, value in update.get("$inc", {}).items():
+            _, field = path.split(".")
+            doc["memory"][field] = doc["memory"].get(field, 0) + value
+    return doc
+
+
+def _facts(memory):
+    return {layer: Counter(i["fact"] for i in memory.get(layer, [])) for layer in LAYERS}
+
+
+def check_equivalence(cases, seed, mongo_uri=None):
+    rng = random.Random(seed)
+    coll = client = None
+    if mongo_uri:
+        from pymongo import MongoClient
+        client = MongoClient(mongo_uri)
+        coll = client["soullink_bench"]["users"]
+    now = datetime.utcnow()
+    mismatches = 0
+    ops_count = Counter()
+    for case in range(cases):
+        doc, extracted = random_case(rng, now)
+        stored = copy.deepcopy(doc)
+
+        memory = copy.deepcopy(doc["memory"])
+        before = snapshot_memory(memory)
+        memory = cleanup_expired(memory)
+        memory, _ = merge_memories(memory, copy.deepcopy(extracted))
+        turns = rng.randint(1, 4)
+        memory["extraction_count"] = memory.get("extraction_count", 0) + turns
+        ops = memory_update_ops(before, memory, turns)
+        ops_count[len(ops)] += 1
+
+        if coll is not None:
+            coll.replace_one({"_id": 1}, stored, upsert=True)
+            for update, array_filters in ops:
+                coll.update_one({"_id": 1}, update, array_filters=array_filters)
+            stored = coll.find_one({"_id": 1})
+        else:
+            stored = apply_ops(stored, ops)
+
+        if (_facts(stored["memory"]) != _facts(memory)
+                or stored["memory"].get("extraction_count") != memory["extraction_count"]):
+            mismatches += 1
+            if mismatches <= 3:
+                print(f"  MISMATCH case {case}:\n    expected {_facts(memory)}\n    stored   {_facts(stored['memory'])}")
+    if client is not None:
+        client.drop_database("soullink_bench")
+    where = "MongoDB" if mongo_uri else "in-process evaluator"
+    print(f"write path: {cases} cases via {where}, {mismatches} mismatches "
+          f"(updates per extraction: {dict(sorted(ops_count.items()))})")
+    return mismatches == 0
+
+
+# ---------- 2. LLM calls per active user ----------
+
+def _sessions(users, seed):
+    rng = random.Random(seed)
+    for _ in range(users):
+        t = 0.0
+        arrivals = []
+        for _ in range(rng.randint(1, 6)):                   # bursts per session
+            for _ in range(rng.randint(1, 8)):               # messages per burst
+                t += rng.uniform(3, 20)                      # reply + read + typing
+                msg = rng.choice(TRIVIAL) if rng.random() < 0.3 else rng.choice(FACTS)
+                arrivals.append((t, msg))
+            t += rng.uniform(60, 900)                        # away
+        yield arrivals
+
+
+def _debounced_calls(arrivals, window, max_wait, max_turns):
+    """Extraction calls under enqueue_batched's trailing debounce."""
+    calls = 0
+    batch, first, last = [], None, None
+    for at, msg in arrivals + [(float("inf"), None)]:
+        if batch and (at >= min(last + window, first + max_wait) or len(batch) >= max_turns):
+            calls += 1 if any(not _should_skip_extraction(m) for m in batch) else 0
+            batch = []
+        if msg is None:
+            break
+        if not batch:
+            first = at
+        batch.append(msg)
+        last = at
+    return calls
+
+
+def simulate_calls(users, seed, windows, max_wait, max_turns):
+    sessions = list(_sessions(users, seed))
+    turns = sum(len(a) for a in sessions)
+    per_turn = sum(1 for a in sessions for _, m in a if not _should_skip_extraction(m))
+    print(f"LLM calls: {users} users, {turns} turns (3-20s apart within a burst) — per-turn {per_turn}")
+    for window in windows:
+        calls = sum(_debounced_calls(a, window, max_wait, max_turns) for a in sessions)
+        print(f"  debounce {window:4g}s (max wait {max_wait:g}s, max {max_turns} turns): "
+              f"{calls:6d} calls → {per_turn / max(1, calls):.1f}× fewer")
+
+
+# ---------- 3. live comparison ----------
+
+def live_compare():
+    for i, session in enumerate(SESSIONS, 1):
+        seq = {layer: [] for layer in LAYERS}
+        calls = 0
+        for user_msg, reply in session:
+            if _should_skip_extraction(user_msg):
+                continue
+            calls += 1
+            extracted = extract_memories(user_msg, reply, seq)
+            if extracted:
+                seq, _ = merge_memories(seq, extracted)
+        batch = {layer: [] for layer in LAYERS}
+        turns = [t for t in session if not _should_skip_extraction(t[0])]
+        extracted = extract_memories_batch(turns, batch) if turns else None
+        if extracted:
+            batch, _ = merge_memories(batch, extracted)
+        print(f"\nsession {i}: per-turn ({calls} calls) vs batched (1 call)")
+        for layer in LAYERS:
+            a = sorted(x["fact"] for x in seq[layer])
+            b = sorted(x["fact"] for x in batch[layer])
+            if a or b:
+                print(f"  {layer:10s} per-turn: {a}\n  {'':10s} batched:  {b}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cases", type=int, default=500, help="Random write-path cases (default 500)")
+    parser.add_argument("--users", type=int, default=1000, help="Simulated active users (default 1000)")
+    parser.add_argument("--windows", default="5,10,15,30", help="Debounce windows to simulate, seconds")
+    parser.add_argument("--max-wait", type=float, default=float(os.getenv("MEMORY_BATCH_MAX_WAIT_SECONDS", "60")))
+    parser.add_argument("--max-turns", type=int, default=int(os.getenv("MEMORY_BATCH_MAX_TURNS", "8")))
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--mongo", help="Apply the updates on this MongoDB instead of the in-process evaluator")
+    parser.add_argument("--live", action="store_true", help="Compare per-turn vs batched extraction with Gemini")
+    args = parser.parse_args()
+
+    ok = check_equivalence(args.cases, args.seed, args.mongo)
+    simulate_calls(args.users, args.seed, [float(w) for w in args.windows.split(",")], args.max_wait, args.max_turns)
+    if args.live:
+        live_compare()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+"""
+Dev tool — offline evaluation of the local web-search pre-classifier
+(web_search.search_signals) that decides whether a message is worth a Gemini
+search-decision call at all.
+
+Each labeled message says whether it needs a real-time web search (the
+question _gemini_classify answers). The gate may only *skip* messages, so:
+
+  skip rate — share of all messages that skip Gemini (the TTFT win: each skip
+              saves one ~1s classify round trip)
+  recall    — share of search-needing messages that still reach Gemini
+              (misses here are searches that silently stop happening)
+  false skips are listed so new signals can be added for them.
+
+Messages come from --data (JSONL, one per line: {"text": "...", "search": true})
+— e.g. production messages labeled with the logged Gemini decision — or, by
+default, from the built-in samples below (companion-chat shapes: feelings,
+role-play, small talk, plus weather / news / prices / dates / live events /
+explicit lookups, in Chinese and English). Also reports per-message gate time.
+
+SAMPLES were written together with the signals, so 100% recall there says
+little. HELD_OUT was written afterwards and is never used to tune the
+signals; its recall (well below 100%) is the honest estimate, and the reason
+WEB_SEARCH_GATE defaults to off. --min-recall applies to SAMPLES / --data.
+
+Usage:
+  cd backend
+  python3 bench_search_gate.py
+  python3 bench_search_gate.py --data labeled.jsonl --show-skips
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from web_search import search_signals  # noqa: E402
+
+# (text, needs search)
+SAMPLES = [
+    # ---- needs search ----
+    ("今天天气怎么样？", True),
+    ("明天上海会下雨吗", True),
+    ("北京现在多少度", True),
+    ("这周末东京天气如何，要带伞吗", True),
+    ("What's the weather like in Riverside today?", True),
+    ("is it going to snow in Chicago tomorrow", True),
+    ("最近有什么新闻吗", True),
+    ("今天有什么热搜", True),
+    ("美国大选结果出来了吗", True),
+    ("Did anything big happen in the news today?", True),
+    ("who won the election", True),
+    ("昨晚湖人比赛比分多少", True),
+    ("世界杯决赛谁赢了", True),
+    ("Who won the NBA finals this year?", True),
+    ("what was the score of the Lakers game last night", True),
+    ("比特币现在多少钱", True),
+    ("今天美元兑人民币汇率是多少", True),
+    ("特斯拉股价涨了吗", True),
+    ("What's the current price of bitcoin?", True),
+    ("how much is an iPhone 16 Pro right now", True),
+    ("最近油价是多少", True),
+    ("今天几号？", True),
+    ("今天星期几呀", True),
+    ("现在几点了", True),
+    ("What day is it today?", True),
+    ("what's today's date", True),
+    ("春节放假安排是怎样的", True),
+    ("离2026年世界杯还有多久", True),
+    ("泰勒斯威夫特最近有新专辑吗", True),
+    ("沙丘3什么时候上映", True),
+    ("Is the new Zelda game released yet?", True),
+    ("when does the new season of Stranger Things premiere", True),
+    ("帮我查一下明天去成都的航班", True),
+    ("附近有什么好吃的餐厅还开门吗", True),
+    ("Is Costco open now?", True),
+    ("what time does the Apple store close tonight", True),
+    ("帮我搜一下最近的演唱会", True),
+    ("can you look up the opening hours of the Louvre", True),
+    ("google the latest iPhone specs for me", True),
+    ("现在的美国总统是谁", True),
+    ("Who is the current prime minister of the UK?", True),
+    ("日本刚刚是不是地震了", True),
+    ("最新版的ChatGPT有什么功能", True),
+    ("今年的诺贝尔文学奖得主是谁", True),
+    ("What's happening in Ukraine right now?", True),
+    ("高考成绩什么时候出", True),
+    ("这周电影票房排行榜第一是哪部", True),
+    ("Are there any flights delayed at JFK today?", True),
+    ("路况怎么样，三环堵车吗", True),
+    ("黄金价格最近涨了还是跌了", True),
+    ("今天有什么大事", True),                       # from review: false skips of the first signals
+    ("湖人赢了吗", True),
+    ("How are the Knicks doing this season?", True),
+    # ---- no search ----
+    ("我好想你", False),
+    ("今天好累啊", False),
+    ("你在干嘛呢", False),
+    ("晚安，明天见", False),
+    ("抱抱我", False),
+    ("我今天被老板骂了，好难过", False),
+    ("你喜欢我吗", False),
+    ("我们去海边散步吧", False),
+    ("*轻轻靠在你肩膀上* 今天好开心", False),
+    ("你还记得我们第一次见面吗", False),
+    ("讲个故事给我听吧", False),
+    ("我最近失眠很严重", False),
+    ("你觉得我应该辞职吗", False),
+    ("哈哈哈哈你好可爱", False),
+    ("我刚吃完饭，吃了火锅", False),
+    ("你叫什么名字", False),
+    ("以后我叫你小雪好不好", False),
+    ("我妈妈又催我结婚了", False),
+    ("周末想和你一起看电影", False),
+    ("我好像有点喜欢上我同事了", False),
+    ("你会一直陪着我吗", False),
+    ("外面风好大", False),
+    ("我养了一只猫，叫团子", False),
+    ("今天考试考砸了", False),
+    ("给我唱首歌吧", False),
+    ("早上好呀", False),
+    ("你生气了吗", False),
+    ("我想学做饭，从哪里开始比较好", False),
+    ("帮我想一个生日礼物的点子", False),
+    ("如果你是人类，你想做什么", False),
+    ("I miss you so much", False),
+    ("good night, sweet dreams", False),
+    ("I had such a rough day at work", False),
+    ("tell me something nice", False),
+    ("*hugs you tightly* don't leave", False),
+    ("do you love me?", False),
+    ("I can't sleep again", False),
+    ("what should I cook for dinner?", False),
+    ("let's play a word game", False),
+    ("you're so sweet lol", False),
+    ("I think I'm falling for someone", False),
+    ("can you help me write a poem about the sea", False),
+    ("my cat knocked over my coffee again", False),
+    ("I'm so nervous about my interview", False),
+    ("what do you like to do for fun?", False),
+    ("remember when we talked about Paris?", False),
+    ("I just finished a 10k run!", False),
+    ("how do I tell my friend I'm upset with her", False),
+    ("explain photosynthesis like I'm five", False),
+    ("why is the sky blue?", False),
+]
+
+
+# Written after the signals; do not add patterns for these — add new rows instead.
+HELD_OUT = [
+    # ---- needs search ----
+    ("梅西还在踢球吗", True),
+    ("勇士昨天输了没", True),
+    ("did the Yankees win last night", True),
+    ("苹果开发布会了吗", True),
+    ("周杰伦出新歌了没有", True),
+    ("iPhone 17 出了吗", True),
+    ("A股今天怎么样", True),
+    ("纳斯达克涨了没", True),
+    ("is the stock market up today", True),
+    ("上海今天冷不冷", True),
+    ("外面会不会下冰雹啊，广州这边", True),
+    ("should I bring an umbrella in Seattle tomorrow", True),
+    ("is it hot in Phoenix right now", True),
+    ("那个台风到哪了", True),
+    ("最近流感严重吗", True),
+    ("现在疫情怎么样了", True),
+    ("what's trending on twitter", True),
+    ("微博上在吵什么", True),
+    ("马斯克又干啥了", True),
+    ("what did Trump say today", True),
+    ("OpenAI 最近发了什么模型", True),
+    ("has GPT-5 come out", True),
+    ("哪个球队是今年的NBA总冠军", True),
+    ("F1 这站谁拿了杆位", True),
+    ("who's leading the Premier League", True),
+    ("星巴克几点关门", True),
+    ("故宫周一开放吗", True),
+    ("is the DMV open on Saturdays", True),
+    ("国庆高速免费吗今年", True),
+    ("下周一是法定假日吗", True),
+    ("when is Thanksgiving this year", True),
+    ("黄金现在能买吗，贵不贵", True),
+    ("how much does a Tesla Model 3 cost now", True),
+    ("以太坊涨了吗", True),
+    ("what's the exchange rate for yen", True),
+    ("今天限行尾号是多少", True),
+    ("明天的高铁票还有吗", True),
+    # ---- no search ----
+    ("你今天心情怎么样", False),
+    ("我赢了一局游戏！", False),
+    ("我们输了也没关系", False),
+    ("这个季节最适合吃螃蟹了", False),
+    ("你觉得我穿这件好看吗", False),
+    ("how are you doing today?", False),
+    ("I won my chess game!", False),
+    ("let's watch a movie together tonight", False),
+    ("我明天要去面试，好紧张", False),
+    ("我做了个噩梦", False),
+    ("what's your favorite season?", False),
+    ("*牵起你的手* 走吧", False),
+    ("你会做饭吗", False),
+    ("我想去旅行", False),
+    ("tell me a joke", False),
+    ("I'm bored", False),
+    ("我室友好吵", False),
+    ("we should go hiking sometime", False),
+    ("好想吃冰淇淋", False),
+    ("can you be my girlfriend", False),
+]
+
+
+def load_data(path):
+    rows = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            obj = json.loads(line)
+            rows.append((obj.get("text") or obj.get("message") or "", bool(obj.get("search"))))
+    return rows
+
+
+def evaluate(rows, show_skips=False) -> float:
+    positives = sum(1 for _, label in rows if label)
+    negatives = len(rows) - positives
+    skipped_neg, passed_pos, false_skips, false_passes = [], 0, [], []
+    for text, label in rows:
+        signals = search_signals(text)
+        if label:
+            if signals:
+                passed_pos += 1
+            else:
+                false_skips.append(text)
+        elif signals:
+            false_passes.append((text, signals))
+        else:
+            skipped_neg.append(text)
+
+    start = time.perf_counter()
+    rounds = max(1, 20000 // max(1, len(rows)))
+    for _ in range(rounds):
+        for text, _ in rows:
+            search_signals(text)
+    gate_us = (time.perf_counter() - start) * 1e6 / (rounds * len(rows))
+
+    skipped = len(skipped_neg) + len(false_skips)
+    recall = passed_pos / positives if positives else 1.0
+    print(f"messages: {len(rows)} ({positives} need search, {negatives} don't)")
+    print(f"skip rate:        {skipped / len(rows):6.1%}  ({skipped} Gemini calls saved)")
+    print(f"  of non-search:  {len(skipped_neg) / negatives if negatives else 0:6.1%}")
+    print(f"recall:           {recall:6.1%}  ({passed_pos}/{positives} search messages reach Gemini)")
+    print(f"gate time:        {gate_us:6.1f} µs / message")
+
+    if false_skips:
+        print(f"\nFALSE SKIPS ({len(false_skips)}) — need search but skipped:")
+        for text in false_skips:
+            print(f"  {text}")
+    if false_passes:
+        print(f"\nsent to Gemini without needing search ({len(false_passes)}):")
+        for text, signals in false_passes:
+            print(f"  [{','.join(signals)}] {text}")
+    if show_skips:
+        print(f"\nskipped ({len(skipped_neg)}):")
+        for text in skipped_neg:
+            print(f"  {text}")
+    return recall
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", help="Labeled JSONL ({\"text\": ..., \"search\": bool} per line)")
+    parser.add_argument("--show-skips", action="store_true", help="Also list correctly skipped messages")
+    parser.add_argument("--min-recall", type=float, default=1.0,
+                        help="Exit non-zero when recall is below this (default 1.0)")
+    args = parser.parse_args()
+
+    if args.data:
+        recall = evaluate(load_data(args.data), args.show_skips)
+    else:
+        print("== SAMPLES (written with the signals) ==")
+        recall = evaluate(SAMPLES, args.show_skips)
+        print("\n== HELD_OUT (not used for tuning) ==")
+        evaluate(HELD_OUT, args.show_skips)
+    sys.exit(1 if recall < args.min_recall else 0)
+
+
+if __name__ == "__main__":
+    main()
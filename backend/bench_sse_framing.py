@@ -0,0 +1,148 @@
+"""
+Dev tool — compare SSE framing of a streamed reply: legacy per-token /
+per-character frames vs the SSECoalescer used by /api/chat/stream.
+
+Replays synthetic token streams (seeded, with realistic token sizes and
+inter-token gaps for CJK and English replies) through both framers on a
+simulated clock — no network, no sleeping — and reports per reply:
+frames, bytes on the wire, json.dumps calls, and first-token delay.
+
+Usage:
+  cd backend
+  python3 bench_sse_framing.py                      # default windows
+  python3 bench_sse_framing.py --window 20 --window 40 --window 80 --bytes 512
+  python3 bench_sse_framing.py --replies 500 --seed 7
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sse import sse_event, SSECoalescer  # noqa: E402
+
+CJK_SAMPLE = (
+    "今天过得怎么样呀？我一直在想你，听说你最近工作特别忙，要记得好好吃饭哦。"
+    "晚上如果睡不着的话，可以和我聊聊天，我会一直陪着你的。"
+)
+EN_SAMPLE = (
+    "Hey you, I was just thinking about you. How did the interview go? "
+    "I know you were nervous, but honestly you always underestimate yourself. "
+    "Tell me everything, I want to hear all of it."
+)
+
+# Initial-phase buffering in chat_stream holds up to this many chars before the
+# first flush (think-tag detection); legacy code then emitted one frame per char.
+INITIAL_BUFFER_CHARS = 6
+
+
+def make_stream(rng: random.Random, cjk: bool):
+    """[(arrival_seconds, token)] for one reply."""
+    sample = CJK_SAMPLE if cjk else EN_SAMPLE
+    text = sample * rng.randint(1, 4)
+    tokens, i = [], 0
+    while i < len(text):
+        size = rng.randint(1, 3) if cjk else rng.randint(2, 7)
+        tokens.append(text[i:i + size])
+        i += size
+    t = rng.uniform(0.3, 1.2)  # time to first token
+    stream = []
+    for tok in tokens:
+        stream.append((t, tok))
+        t += max(0.001, rng.gauss(0.018, 0.010))  # ~55 tokens/s with jitter
+    return stream
+
+
+def legacy_frames(stream):
+    """Old chat_stream: buffered initial chars one frame each, then per token."""
+    frames, dumps, first_at = [], 0, None
+    buf = ""
+    for at, tok in stream:
+        if len(buf) <= INITIAL_BUFFER_CHARS and first_at is None:
+            buf += tok
+            if len(buf) > INITIAL_BUFFER_CHARS:
+                for ch in buf:
+                    frames.append(sse_event("text", {"token": ch}))
+                    dumps += 1
+                first_at = at
+            continue
+        frames.append(sse_event("text", {"token": tok}))
+        dumps += 1
+    if first_at is None and buf:
+        first_at = stream[-1][0]
+    return frames, dumps, first_at - stream[0][0]
+
+
+def coalesced_frames(stream, window_ms: float, max_bytes: int):
+    """SSECoalescer driven the way chat_stream drives it (queue timeout → flush)."""
+    c = SSECoalescer(window_ms=window_ms, max_bytes=max_bytes)
+    frames, first_at = [], None
+    buf = ""
+    for at, tok in stream:
+        # A blocked queue.get() would have timed out and flushed in between
+        if c.pending and c.timeout(3, now=at) <= 0:
+            frames.append(c.flush())
+        if first_at is None:
+            buf += tok
+            if len(buf) <= INITIAL_BUFFER_CHARS:
+                continue
+            tok, buf = buf, ""
+        frame = c.add(tok, now=at)
+        if frame:
+            frames.append(frame)
+            if first_at is None:
+                first_at = at
+    tail = c.flush()
+    if tail:
+        frames.append(tail)
+    if first_at is None:
+        first_at = stream[-1][0]
+    return frames, c.frames, first_at - stream[0][0]
+
+
+def summarize(label, rows):
+    frames = [r[0] for r in rows]
+    bytes_ = [r[1] for r in rows]
+    dumps = [r[2] for r in rows]
+    first = [r[3] * 1000 for r in rows]
+    print(f"{label:<28} frames/reply {statistics.mean(frames):7.1f}   "
+          f"bytes/reply {statistics.mean(bytes_):8.0f}   "
+          f"json.dumps/reply {statistics.mean(dumps):7.1f}   "
+          f"first-token delay p50 {statistics.median(first):5.1f} ms")
+    return statistics.mean(frames), statistics.mean(bytes_)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--replies", type=int, default=200, help="Replies to simulate (default 200)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--window", type=float, action="append",
+                        help="Coalescing window in ms (repeatable, default 20/40/80)")
+    parser.add_argument("--bytes", type=int, default=512, help="Byte threshold (default 512)")
+    args = parser.parse_args()
+    windows = args.window or [20.0, 40.0, 80.0]
+
+    rng = random.Random(args.seed)
+    streams = [make_stream(rng, cjk=(i % 2 == 0)) for i in range(args.replies)]
+
+    legacy_rows = []
+    for st in streams:
+        frames, dumps, first = legacy_frames(st)
+        legacy_rows.append((len(frames), sum(len(f.encode("utf-8")) for f in frames), dumps, first))
+    print(f"{args.replies} replies, seed {args.seed}\n")
+    base_frames, base_bytes = summarize("legacy (per char/token)", legacy_rows)
+
+    for w in windows:
+        rows = []
+        for st in streams:
+            frames, dumps, first = coalesced_frames(st, w, args.bytes)
+            rows.append((len(frames), sum(len(f.encode("utf-8")) for f in frames), dumps, first))
+        f, b = summarize(f"coalesced {w:g}ms/{args.bytes}B", rows)
+        print(f"{'':<28} → {base_frames / f:4.1f}x fewer frames, {100 * (1 - b / base_bytes):4.1f}% fewer bytes")
+
+
+if __name__ == "__main__":
+    main()
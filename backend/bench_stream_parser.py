@@ -0,0 +1,250 @@
+"""
+Dev tool — fuzz + benchmark for stream_parser.ThinkStreamParser.
+
+Token streams come from a JSONL file of recorded replies (one object per line,
+{"tokens": ["<th", "ink>", ...]} — e.g. dumped from AnythingLLM /stream-chat
+textResponse chunks) or, without --streams, from the built-in samples below
+(shapes seen in production: <think> blocks, Gemini "思考：" prefixes, bare
+THOUGHT prefixes, Grok "Assistant:" leaks, IMAGE / RENAME / EMOTION markers).
+
+fuzz:   every stream is re-chunked at random boundaries (including 1-char
+        chunks that split every tag and marker) and must parse to the identical
+        result; streamed text must equal the final reply modulo whitespace and
+        never contain a think tag or a complete marker. Random streams built
+        from tag / marker / text fragments are checked the same way.
+bench:  per-reply time for the parser vs the previous chat_stream approach
+        (rolling lowercase buffers per token + regex cleanup over the full
+        reply), on the recorded streams and on synthetic replies with a
+        <think> block of growing length — the old thinking-mode loop re-lowered
+        the whole block on every token, so its cost grows quadratically.
+
+Usage:
+  cd backend
+  python3 bench_stream_parser.py                     # fuzz + bench on samples
+  python3 bench_stream_parser.py --fuzz 2000 --seed 7
+  python3 bench_stream_parser.py --streams recorded.jsonl --rounds 50
+  python3 bench_stream_parser.py --size 500 --size 8000
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stream_parser import ThinkStreamParser, parse_reply  # noqa: E402
+
+SAMPLES = [
+    ["<th", "ink>", "用户今天", "心情不好，", "要温柔一点", "</thi", "nk>\n\n", "怎么啦？", "谁惹你", "不开心了，", "跟我说说～", " [EMO", "TION:", "sad]"],
+    ["思考", "：用户", "在打招呼，", "回应热情一些", "\n", "嗨～", "你终于", "来啦！", "我等你", "好久了", "[IMAGE: ", "a girl waving ", "happily in a cafe", "]"],
+    ["THOUGHT", " The user", " asks about", " my day.", " Keep it short.", "\n", "今天", "过得还不错", "呀，你呢？", "有没有", "好好吃饭？"],
+    ["好呀，", "以后你就", "叫我小雪吧～", "这个名字", "我很喜欢！", " [RENAME:", "小雪", "]", " [EMOTION:", "happy]"],
+    ["我当然", "记得呀，", "你上次", "说想去海边", "看日落。", "\nAssis", "tant: ", "The user is", " recalling", " a memory.", "\n情节推进", "：提议一起去"],
+    ["Of course", " I remember!", " You said", " you wanted", " to see", " the sunset", " by the sea.", " <thou", "ght>should", " I offer", " a plan?</thought>", " Let's go", " this weekend?"],
+    ["<think>", "只有思考", "\n\n", "没有正文", "的情况", "</think>"],
+    ["a < b", " and [not", " a marker]", " [IMAGE_EDIT:", " make the sky", " pink]", " done"],
+    ["Let me", " think", " about", " this", "：嗯", "\n", "好的，", "那我们", "就这么定了！"],
+    ["嗯嗯，", "我在听。", "\n", "你继续说，", "我一直", "都在的。"],
+]
+
+SAMPLE_TEXT = "我今天好想你呀，你在做什么呢？ Tell me about your day. "
+
+FRAGMENTS = [
+    "<think>", "</think>", "<THOUGHT>", "</thought>", "<", "<th", "[", "]", "[IMAGE:", "[IMAGE: a cat]",
+    "[IMAGE_EDIT: blue]", "[RENAME:阿星]", "[EMOTION:happy]", "[EMOTION:", "\n", "\n\n", " ",
+    "你好呀", "今天天气不错", "Hello there", "Assistant:", "\nAssistant: meta", "\n角色保持：", "思考：",
+    "think ", "（笑）", "「嗯」", "abc", "12345",
+]
+
+
+def load_streams(path):
+    if not path:
+        return [list(s) for s in SAMPLES]
+    streams = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                streams.append(json.loads(line)["tokens"])
+    return streams
+
+
+def run_parser(chunks):
+    p = ThinkStreamParser()
+    text = []
+    for c in chunks:
+        text.extend(v for k, v in p.feed(c) if k == "text")
+    text.extend(v for k, v in p.finish() if k == "text")
+    return p.result, "".join(text)
+
+
+def rechunk(text, rng):
+    chunks, i = [], 0
+    one_char = rng.random() < 0.2
+    while i < len(text):
+        n = 1 if one_char else rng.randint(1, 12)
+        chunks.append(text[i:i + n])
+        i += n
+    return chunks
+
+
+def _squash(s):
+    return re.sub(r"\s+", "", s)
+
+
+def check(text, rng, rounds):
+    """Returns an error string or None."""
+    expected = parse_reply(text)
+    for _ in range(rounds):
+        chunks = rechunk(text, rng)
+        result, streamed = run_parser(chunks)
+        if result != expected:
+            return f"chunking changed result\n  chunks={chunks!r}\n  got={result!r}\n  want={expected!r}"
+        low = streamed.lower()
+        if "<think>" in low or "<thought>" in low:
+            return f"think tag leaked into text: {streamed!r}"
+        for m in expected.markers:
+            if f"[{m['type']}:" in streamed and m["value"] and m["value"] in streamed.split(f"[{m['type']}:", 1)[1][:len(m["value"]) + 2]:
+                return f"marker leaked into text: {streamed!r}"
+        if streamed.strip() and _squash(streamed) != _squash(expected.reply):
+            return f"streamed text != reply\n  streamed={streamed!r}\n  reply={expected.reply!r}"
+    return None
+
+
+def fuzz(streams, n_random, seed):
+    rng = random.Random(seed)
+    failures = 0
+    for tokens in streams:
+        err = check("".join(tokens), rng, rounds=50)
+        if err:
+            failures += 1
+            print(f"FAIL (recorded) {err}")
+    for _ in range(n_random):
+        text = "".join(rng.choice(FRAGMENTS) for _ in range(rng.randint(1, 25)))
+        err = check(text, rng, rounds=5)
+        if err:
+            failures += 1
+            print(f"FAIL (random) text={text!r}\n  {err}")
+    print(f"fuzz: {len(streams)} recorded streams × 50 re-chunkings, "
+          f"{n_random} random streams × 5 — {failures} failure(s)")
+    return failures
+
+
+# ---------- previous approach, for comparison ----------
+
+def legacy_parse(chunks):
+    """Rolling-buffer detection per token, then regex cleanup over the full reply."""
+    full, thinking, initial, in_thinking, initial_phase, tdb = "", "", "", False, True, ""
+    for token in chunks:
+        full += token
+        if initial_phase:
+            initial += token
+            low = initial.lower()
+            if "<think>" in low or "<thought>" in low:
+                in_thinking, initial_phase = True, False
+                continue
+            if re.match(r'^\s*(?:思考|Thinking|思考过程|Let me think|我(?:先)?(?:想想|思考一下|分析一下))[\s：:]+', initial, re.I):
+                in_thinking, initial_phase = True, False
+                continue
+            if re.match(r'^\s*(?:THOUGHT|think)\s+', initial, re.I) and len(initial) > 15:
+                in_thinking, initial_phase = True, False
+                continue
+            s = low.lstrip()
+            if len(initial) > 60 or (len(initial) > 5 and not s.startswith('<') and not re.match(r'(?:思考|think|let\s)', s, re.I)):
+                initial_phase = False
+            continue
+        if in_thinking:
+            combined = thinking + token
+            lc = combined.lower()
+            for tag in ["</think>", "</thought>"]:
+                if tag in lc:
+                    in_thinking = False
+                    break
+            else:
+                thinking += token
+            continue
+        tdb = (tdb + token)[-20:]
+        ltdb = tdb.lower()
+        for mtag in ["<think>", "<thought>", "\nassistant:", "\nassistant："]:
+            if mtag in ltdb:
+                in_thinking = True
+                tdb = ""
+                break
+    reply = full
+    m = re.search(r'<(?:think|thought)>(.*?)</(?:think|thought)>', reply, re.DOTALL)
+    if m:
+        reply = re.sub(r'<(?:think|thought)>.*?</(?:think|thought)>', '', reply, flags=re.DOTALL).strip()
+    re.match(r'^(?:THOUGHT|think)\s', reply, re.I)
+    re.match(r'^(?:思考|Thinking|思考过程|Let me think|我(?:先)?(?:想想|思考一下|分析一下))[\s：:：]+(.+?)(?:\n\n|\n(?=[^\n]))', reply, re.DOTALL)
+    re.search(r'\n\s*Assistant\s*[:：]', reply) or re.search(
+        r'\n\s*(?:角色保持|亲密规则|情节推进|回复内容|场景设定|注意事项|互动建议|下一步)\s*[:：]', reply)
+    re.findall(r'\[IMAGE:\s*(.+?)\]', reply, re.DOTALL)
+    reply = re.sub(r'\s*\[IMAGE:\s*.+?\]', '', reply, flags=re.DOTALL).strip()
+    re.search(r'\[IMAGE_EDIT:\s*(.+?)\]', reply, re.DOTALL)
+    re.search(r'\[RENAME:(.{1,20}?)\]', reply)
+    re.search(r'\[EMOTION:(\w+)\]', reply)
+    reply = re.sub(r'\s*\[EMOTION:\w+\]', '', reply).strip()
+    return reply
+
+
+def synthetic_stream(rng, size):
+    """<think> block + reply body of ~size chars each, 1–4 char tokens."""
+    body = "".join(rng.choice(SAMPLE_TEXT) for _ in range(size))
+    thinking = "".join(rng.choice(SAMPLE_TEXT) for _ in range(size))
+    text = f"<think>{thinking}</think>\n\n{body} [EMOTION:happy]"
+    tokens, i = [], 0
+    while i < len(text):
+        n = rng.randint(1, 4)
+        tokens.append(text[i:i + n])
+        i += n
+    return tokens
+
+
+def bench(streams, rounds, sizes, seed):
+    rng = random.Random(seed)
+
+    def timed(fn, workload, passes):
+        start = time.perf_counter()
+        for _ in range(passes):
+            for tokens in workload:
+                fn(tokens)
+        return (time.perf_counter() - start) / (passes * len(workload))
+
+    rows = [("recorded", streams, rounds)]
+    for size in sizes:
+        rows.append((f"{size}+{size} chars", [synthetic_stream(rng, size) for _ in range(10)],
+                     max(1, rounds * 50 // size)))
+
+    print(f"bench: µs per reply (legacy = rolling buffers + regex cleanup)")
+    print(f"  {'workload':<18} {'chars':>7} {'legacy':>10} {'parser':>10} {'speedup':>8}")
+    for label, workload, passes in rows:
+        chars = sum(len("".join(t)) for t in workload) / len(workload)
+        t_old = timed(legacy_parse, workload, passes)
+        t_new = timed(run_parser, workload, passes)
+        print(f"  {label:<18} {chars:7.0f} {t_old * 1e6:10.1f} {t_new * 1e6:10.1f} {t_old / t_new:7.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streams", help="JSONL of recorded token streams ({\"tokens\": [...]} per line)")
+    parser.add_argument("--fuzz", type=int, default=1000, help="Random fragment streams to fuzz (default 1000)")
+    parser.add_argument("--rounds", type=int, default=200, help="Benchmark passes over the streams (default 200)")
+    parser.add_argument("--size", type=int, action="append",
+                        help="Synthetic thinking/reply length in chars (repeatable, default 200/1000/4000)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--no-bench", action="store_true")
+    args = parser.parse_args()
+
+    streams = load_streams(args.streams)
+    failures = fuzz(streams, args.fuzz, args.seed)
+    if not args.no_bench:
+        bench(streams, args.rounds, args.size or [200, 1000, 4000], args.seed)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
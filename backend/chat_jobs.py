@@ -0,0 +1,153 @@
+"""
+Post-reply background jobs of a chat turn, run through job_queue.py:
+
+  memory_extract      Mem0 (or legacy) extraction over a user's recent turns;
+                      optional receipt in `memory_events` for the UI
+  memory_cleanup      expired-memory sweep (~5% of turns), deduped per user
+  conversation_title  auto-title after the first exchange, deduped per conversation
+
+Memory jobs of one user share coalesce_key mem:{user_id}, so extraction and
+cleanup for the same user never run concurrently. Extraction is debounced:
+a user's turns are collected into one job until MEMORY_DEBOUNCE_SECONDS pass
+without a new turn (at most MEMORY_BATCH_MAX_WAIT_SECONDS / MEMORY_BATCH_MAX_TURNS,
+job_queue.enqueue_batched) and extracted with a single LLM call
+(process_memory_batch) — a burst of messages costs one Gemini call instead of
+one per turn. 0 disables batching. Turns that want a receipt (/api/chat) flush
+within RECEIPT_FLUSH_SECONDS, since the receipt chip only polls for ~12s.
+
+Routes call queue_post_reply(); processes that should *run* the jobs call
+register_handlers() once at startup (app_new). voice_server only enqueues.
+"""
+
+import logging
+import os
+import random
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from bson import ObjectId
+
+import job_queue
+from database import db
+
+log = logging.getLogger(__name__)
+
+MEMORY_CLEANUP_RATE = 0.05
+MEMORY_DEBOUNCE_SECONDS = float(os.getenv("MEMORY_DEBOUNCE_SECONDS", "15"))
+MEMORY_BATCH_MAX_WAIT_SECONDS = float(os.getenv("MEMORY_BATCH_MAX_WAIT_SECONDS", "60"))
+MEMORY_BATCH_MAX_TURNS = int(os.getenv("MEMORY_BATCH_MAX_TURNS", "8"))
+RECEIPT_FLUSH_SECONDS = 5
+MAX_TITLE_CHARS = 50
+
+
+def _mem0_enabled() -> bool:
+    return os.environ.get("MEM0_ENABLED", "false").lower() == "true"
+
+
+def _oid(value) -> Optional[ObjectId]:
+    if value is None or isinstance(value, ObjectId):
+        return value
+    return ObjectId(str(value))
+
+
+# ---------- Handlers ----------
+
+def _memory_extract(payload: Dict[str, Any]) -> None:
+    # extraction failures raise → the queue retries the batch with backoff
+    uid = _oid(payload["user_id"])
+    items = payload.get("items")
+    if items is None:       # single-turn payload (jobs queued before batching)
+        items = [payload]
+    turns = [(it.get("user_msg") or "", it.get("reply") or "") for it in items]
+    if not _mem0_enabled():
+        from memory_engine import process_memory_batch
+        process_memory_batch(uid, turns, raise_errors=True)
+        return
+
+    from mem0_engine import process_memory_batch
+    receipt = process_memory_batch(uid, turns, raise_errors=True) or {}
+    # Persist receipt so the UI can show "已记住：..." under the AI bubble —
+    # the latest turn of the batch that asked for one.
+    # Only write when there's something meaningful to show.
+    wants = [it for it in items if it.get("record_receipt")]
+    if wants and (receipt.get("added") or receipt.get("updated")):
+        try:
+            db.db["memory_events"].insert_one({
+                "user_id": uid,
+                "conversation_id": _oid(wants[-1].get("conversation_id")),
+                "added": receipt.get("added", []),
+                "updated": receipt.get("updated", []),
+                "created_at": datetime.utcnow(),
+            })
+        except Exception as e:
+            log.warning(f"[MEM0] Failed to persist receipt: {e}")
+
+
+def _memory_cleanup(payload: Dict[str, Any]) -> None:
+    if _mem0_enabled():
+        from mem0_engine import cleanup_expired_memories
+        cleanup_expired_memories(str(payload["user_id"]))
+
+
+def _conversation_title(payload: Dict[str, Any]) -> None:
+    from memory_engine import _call_gemini
+    prompt = (
+        "Generate a very short conversation title (max 6 words) based on this chat. "
+        "If the message is in Chinese, return Chinese title. If in English, return English title. "
+        "Return ONLY the title text, nothing else. No quotes, no punctuation at the end.\n\n"
+        f"User: {(payload.get('user_msg') or '')[:200]}\nAssistant: {(payload.get('reply') or '')[:200]}"
+    )
+    title = _call_gemini(prompt)
+    if not title:
+        raise RuntimeError("empty title from Gemini")    # → retried with backoff
+    # 清理标题（去掉引号、多余空白等）
+    title = title.strip().strip('"\'').strip()
+    if title and len(title) < MAX_TITLE_CHARS:
+        db.db["conversations"].update_one(
+            {"_id": _oid(payload["conversation_id"]), "user_id": _oid(payload["user_id"])},
+            {"$set": {"title": title, "updated_at": datetime.utcnow()}},
+        )
+        log.info(f"[TITLE] Auto-generated title: {title}")
+
+
+def register_handlers() -> None:
+    """Run chat jobs in this process (JOB_WORKERS_<KIND> overrides the pool sizes)."""
+    job_queue.register("memory_extract", _memory_extract, concurrency=4, max_attempts=3, backoff=15.0)
+    job_queue.register("memory_cleanup", _memory_cleanup, concurrency=1, max_attempts=2, backoff=60.0)
+    job_queue.register("conversation_title", _conversation_title, concurrency=2, max_attempts=3, backoff=10.0)
+    job_queue.start()
+
+
+# ---------- Enqueue ----------
+
+def queue_post_reply(user_id, user_msg: str, reply: str, *, conversation_id=None,
+                     is_first_message: bool = False, record_receipt: bool = False) -> None:
+    """Queue memory extraction (+ occasional cleanup, + title on the first
+    exchange) for one finished turn. Never raises."""
+    try:
+        uid = str(user_id)
+        turn = {
+            "user_msg": user_msg,
+            "reply": reply,
+            "conversation_id": str(conversation_id) if conversation_id else None,
+            "record_receipt": record_receipt,
+        }
+        if MEMORY_DEBOUNCE_SECONDS > 0:
+            job_queue.enqueue_batched(
+                "memory_extract", f"mem:{uid}", turn, base={"user_id": uid},
+                window=MEMORY_DEBOUNCE_SECONDS, max_wait=MEMORY_BATCH_MAX_WAIT_SECONDS,
+                max_items=MEMORY_BATCH_MAX_TURNS, flush_within=RECEIPT_FLUSH_SECONDS if record_receipt else None,
+            )
+        else:
+            job_queue.enqueue("memory_extract", {"user_id": uid, "items": [turn]}, coalesce_key=f"mem:{uid}")
+        if _mem0_enabled() and random.random() < MEMORY_CLEANUP_RATE:
+            job_queue.enqueue("memory_cleanup", {"user_id": uid}, coalesce_key=f"mem:{uid}", dedupe=True)
+        if is_first_message and conversation_id:
+            job_queue.enqueue("conversation_title", {
+                "user_id": uid,
+                "conversation_id": str(conversation_id),
+                "user_msg": user_msg,
+                "reply": reply,
+            }, coalesce_key=f"title:{conversation_id}", dedupe=True)
+    except Exception as e:
+        log.warning(f"[JOBS] queue_post_reply failed: {e}")
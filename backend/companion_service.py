@@ -7,34 +7,111 @@ Each user has 1..N companions; the active one is referenced by
 created on first chat from their legacy settings, so deploy needs no batch
 migration.
 
-Lorebook entries live inside the companion document (small docs, infrequent
-writes — embedding is fine; promote to its own collection only if entries grow
-past a few hundred per companion).
+Lorebook entries live in their own `lorebook_entries` collection
+(lorebook_store.py); the companion document is only the card plus a
+`lorebook_version` counter bumped by every lorebook write. Reads never pull
+the entries along with the card — get_lorebook() loads them by version.
+Companions that still embed a `lorebook_entries` array are migrated on first
+access.
 """
 
 import json
 import logging
+import os
+import threading
+import time
 import uuid
 from datetime import datetime
 from typing import Dict, List, Optional
 
 from bson import ObjectId
 
+import lorebook_store
 from database import db
-from redis_client import safe_get, safe_setex, safe_delete
+from local_cache import LRUCache
+from redis_client import safe_get, safe_setex, safe_delete, safe_publish, subscribe
+from user_cache import get_user, invalidate_user
 
 log = logging.getLogger(__name__)
 
 COLLECTION = "companions"
 CACHE_TTL_SECONDS = 300
+L1_CACHE_SIZE = 1024
+L1_TTL_SECONDS = int(os.getenv("COMPANION_L1_TTL_SECONDS", "60"))
+# Used while this worker isn't subscribed to invalidations (Redis down,
+# reconnecting) — bounds how long another worker's write can go unseen.
+L1_FALLBACK_TTL_SECONDS = int(os.getenv("COMPANION_L1_FALLBACK_TTL_SECONDS", "5"))
+INVALIDATE_CHANNEL = "companion:invalidate"
+CARD_PROJECTION = {"lorebook_entries": 0}    # legacy embedded array, never part of the card
 
 
 # ---------- Cache helpers ----------
+# Two tiers: a per-worker LRU of rehydrated docs (L1, no I/O on a hit) in front
+# of the shared Redis JSON copy. _cache_invalidate publishes the id on
+# INVALIDATE_CHANNEL; every worker's listener drops its L1 entry. `_l1_epoch`
+# moves on every invalidation seen by this worker, so a read that raced one
+# doesn't put its (possibly stale) result into L1.
+
+_l1 = LRUCache("companion_cards", maxsize=L1_CACHE_SIZE)
+_l1_epoch = 0
+_l1_lock = threading.Lock()
+_subscription = None
+
 
 def _cache_key(companion_id: str) -> str:
     return f"companion:{companion_id}"
 
 
+def _l1_drop(companion_id: str) -> None:
+    global _l1_epoch
+    with _l1_lock:
+        _l1_epoch += 1
+    _l1.pop(str(companion_id))
+
+
+def _l1_flush() -> None:
+    """Subscribed (again) — invalidations may have been missed meanwhile."""
+    global _l1_epoch
+    with _l1_lock:
+        _l1_epoch += 1
+    _l1.clear()
+
+
+def _l1_listening() -> bool:
+    """Start this worker's invalidation listener on first use (after fork)."""
+    global _subscription
+    sub = _subscription
+    if sub is None or not sub.alive():
+        with _l1_lock:
+            if _subscription is sub:
+                try:
+                    _subscription = subscribe(INVALIDATE_CHANNEL, _l1_drop, on_connect=_l1_flush)
+                except Exception as e:
+                    log.debug(f"[COMPANION] invalidation listener failed to start: {e}")
+            sub = _subscription
+    return bool(sub and sub.connected)
+
+
+def _l1_get(companion_id: str) -> Optional[Dict]:
+    item = _l1.get(companion_id)
+    if item is None:
+        return None
+    expires_at, doc = item
+    if time.monotonic() >= expires_at:
+        _l1.pop(companion_id)
+        return None
+    return doc
+
+
+def _l1_put(doc: Dict, epoch: int) -> None:
+    ttl = L1_TTL_SECONDS if _l1_listening() else L1_FALLBACK_TTL_SECONDS
+    if ttl <= 0 or epoch != _l1_epoch:
+        return
+    card = dict(doc)
+    card.pop("lorebook_entries", None)
+    _l1.put(str(doc.get("_id")), (time.monotonic() + ttl, card))
+
+
 def _bson_safe(doc: Dict) -> Dict:
     """Shallow-copy doc with ObjectId/datetime stringified for JSON cache."""
     out = {}
@@ -53,13 +130,42 @@ def _cache_set(doc: Dict) -> None:
     if not cid:
         return
     try:
-        safe_setex(_cache_key(cid), CACHE_TTL_SECONDS, json.dumps(_bson_safe(doc), default=str))
+        cached = _bson_safe(doc)
+        cached.pop("lorebook_entries", None)
+        safe_setex(_cache_key(cid), CACHE_TTL_SECONDS, json.dumps(cached, default=str))
     except Exception:
         pass
 
 
 def _cache_invalidate(companion_id: str) -> None:
     safe_delete(_cache_key(companion_id))
+    _l1_drop(companion_id)
+    safe_publish(INVALIDATE_CHANNEL, str(companion_id))
+
+
+def _lorebook_written(oid: ObjectId, count_delta: int = 0) -> None:
+    """Bump the lorebook version after an entry write (count_delta: entries
+    added / removed) — readers key their entry cache by it."""
+    update = {"$inc": {"lorebook_version": 1}, "$set": {"updated_at": datetime.utcnow()}}
+    if count_delta:
+        update["$inc"]["lorebook_count"] = count_delta
+    db.db[COLLECTION].update_one({"_id": oid}, update)
+
+
+def _sync_lorebook_vectors(oid: ObjectId) -> None:
+    """Re-embed vectorized entries after a lorebook write — call before
+    _cache_invalidate so the next cached copy carries the new index version."""
+    try:
+        doc = db.db[COLLECTION].find_one({"_id": oid}, {"lorebook_vectors_version": 1}) or {}
+        entries = lorebook_store.fetch(oid)
+        if not doc.get("lorebook_vectors_version") and not any(
+            (e.get("strategy") or "") == "vectorized" for e in entries
+        ):
+            return
+        from lorebook_vectors import sync_lorebook_vectors
+        sync_lorebook_vectors(oid, entries)
+    except Exception as e:
+        log.warning(f"[COMPANION] Lorebook vector sync failed for {oid}: {e}")
 
 
 # ---------- Schema ----------
@@ -159,7 +265,10 @@ def _new_companion_doc(
         "relationship": relationship,
         "custom_persona": custom_persona or "",      # source persona text (legacy field — still authoritative)
         "character_card": _empty_character_card(),   # always-inject layer (extracted)
-        "lorebook_entries": [],                      # keyword-triggered layer (extracted + manual)
+        "lorebook_migrated": True,                   # entries live in lorebook_entries (lorebook_store)
+        "lorebook_version": 0,                       # bumped by every entry write — entry cache key
+        "lorebook_count": 0,
+        "lorebook_next_position": 0,
         "extraction_status": "pending",              # pending | running | done | failed (UI polling)
         "extraction_error": None,
         "created_at": now,
@@ -185,15 +294,23 @@ def _rehydrate_cached(doc: Dict) -> Dict:
 
 
 def get_companion_by_id(companion_id, user_id: ObjectId) -> Optional[Dict]:
-    """Fetch by id with cache. Verifies ownership."""
+    """Fetch by id with cache (L1 → Redis → Mongo). Verifies ownership.
+    Returns a shallow copy; nested fields are shared with the cache."""
     cid_str = str(companion_id)
+    doc = _l1_get(cid_str)
+    if doc is not None:
+        # Trust cache only if user_id matches (defense in depth).
+        return dict(doc) if str(doc.get("user_id")) == str(user_id) else None
+
+    epoch = _l1_epoch
     cached = safe_get(_cache_key(cid_str))
     if cached:
         try:
             doc = json.loads(cached)
-            # Trust cache only if user_id matches (defense in depth).
             if str(doc.get("user_id")) == str(user_id):
-                return _rehydrate_cached(doc)
+                doc = _rehydrate_cached(doc)
+                _l1_put(doc, epoch)
+                return dict(doc)
         except Exception:
             pass
 
@@ -202,17 +319,50 @@ def get_companion_by_id(companion_id, user_id: ObjectId) -> Optional[Dict]:
     except Exception:
         return None
 
-    doc = db.db[COLLECTION].find_one({"_id": oid, "user_id": user_id})
+    doc = db.db[COLLECTION].find_one({"_id": oid, "user_id": user_id}, CARD_PROJECTION)
     if doc:
         _cache_set(doc)
+        _l1_put(doc, epoch)
+        doc = dict(doc)
     return doc
 
 
 def list_companions(user_id: ObjectId) -> List[Dict]:
-    cur = db.db[COLLECTION].find({"user_id": user_id}).sort("created_at", 1)
+    cur = db.db[COLLECTION].find({"user_id": user_id}, CARD_PROJECTION).sort("created_at", 1)
     return list(cur)
 
 
+def _ensure_lorebook_migrated(oid: ObjectId) -> None:
+    if lorebook_store.migrate(oid):
+        _cache_invalidate(str(oid))
+
+
+def get_lorebook(companion: Optional[Dict], enabled_only: bool = False):
+    """
+    (entries, fingerprint) of a companion card's lorebook — served from the
+    per-worker entry cache for the card's lorebook_version, migrating the
+    legacy embedded array on first access. ([], None) when there is none.
+    enabled_only=True (chat / trigger test) skips disabled entries in the query.
+    """
+    if not companion or not companion.get("_id"):
+        return [], None
+    oid = _coerce_oid(companion["_id"])
+    if not oid:
+        return [], None
+    version = companion.get("lorebook_version", 0)
+    try:
+        if not companion.get("lorebook_migrated"):
+            _ensure_lorebook_migrated(oid)
+            doc = db.db[COLLECTION].find_one({"_id": oid}, {"lorebook_version": 1}) or {}
+            version = doc.get("lorebook_version", 0)
+        elif not companion.get("lorebook_count"):
+            return [], None
+        return lorebook_store.load(oid, version, enabled_only=enabled_only)
+    except Exception as e:
+        log.warning(f"[COMPANION] Lorebook load failed for {oid}: {e}")
+        return [], None
+
+
 def get_active_companion(user_id: ObjectId, user_doc: Optional[Dict] = None) -> Optional[Dict]:
     """
     Return the user's active companion, lazy-creating a default one from legacy
@@ -221,7 +371,7 @@ def get_active_companion(user_id: ObjectId, user_doc: Optional[Dict] = None) ->
     If user_doc is provided, it will be reused instead of re-fetched from Mongo.
     """
     if user_doc is None:
-        user_doc = db.get_user_by_id(user_id)
+        user_doc = get_user(user_id)
     if not user_doc:
         return None
 
@@ -399,22 +549,32 @@ def _extract_and_save_lorebook(
         card["canon_wiki_url"] = canon_info.get("wiki_url")
 
     try:
+        # bump → replace → bump：中间态的版本号带 lorebook_writing，读者不会把半截列表缓存下来
+        if not lorebook_store.begin_replace(cid, uid):
+            log.warning(f"[COMPANION] Companion {cid} of user {uid} not found — extraction lost")
+            return 0
+        count = lorebook_store.replace_all(cid, uid, lore_entries)
         update_result = db.db[COLLECTION].update_one(
             {"_id": cid, "user_id": uid},
             {
                 "$set": {
                     "character_card": card,
-                    "lorebook_entries": lore_entries,
                     "extraction_status": "done",
                     "extraction_error": None,
                     "updated_at": datetime.utcnow(),
                     "lorebook_extracted_at": datetime.utcnow(),
-                }
+                    "lorebook_migrated": True,
+                    "lorebook_count": count,
+                    "lorebook_next_position": count,
+                },
+                "$inc": {"lorebook_version": 1},
+                "$unset": {"lorebook_entries": "", "lorebook_writing": ""},
             },
         )
         if update_result.matched_count == 0:
             log.warning(f"[COMPANION] Update matched 0 docs (companion={cid} user={uid}) — extraction lost")
             return 0
+        _sync_lorebook_vectors(cid)
         _cache_invalidate(str(cid))
         log.info(
             f"[COMPANION] Saved character_card + {len(lore_entries)} lorebook entries to companion {cid} "
@@ -425,7 +585,12 @@ def _extract_and_save_lorebook(
         log.warning(f"[COMPANION] Failed to persist extraction: {e}")
         db.db[COLLECTION].update_one(
             {"_id": cid, "user_id": uid},
-            {"$set": {"extraction_status": "failed", "extraction_error": str(e)[:300]}},
+            {
+                "$set": {"extraction_status": "failed", "extraction_error": str(e)[:300]},
+                # a half-done replace_all: settle on whatever was written
+                "$inc": {"lorebook_version": 1},
+                "$unset": {"lorebook_writing": ""},
+            },
         )
         _cache_invalidate(str(cid))
         return 0
@@ -446,7 +611,7 @@ def re_extract_lorebook(
     blocked by the LLM call. Set background=False for the backfill script
     where serialization is desired.
     """
-    user_doc = db.get_user_by_id(user_id)
+    user_doc = get_user(user_id)
     if not user_doc:
         return
     settings = user_doc.get("settings") or {}
@@ -492,6 +657,7 @@ def _set_active_companion(user_id: ObjectId, companion_id: ObjectId) -> None:
         {"_id": user_id},
         {"$set": {"settings.active_companion_id": str(companion_id), "updated_at": datetime.utcnow()}},
     )
+    invalidate_user(user_id)
 
 
 def create_companion(
@@ -539,7 +705,7 @@ def update_companion(
         {"$set": update},
     )
     _cache_invalidate(str(oid))
-    return db.db[COLLECTION].find_one({"_id": oid, "user_id": user_id})
+    return db.db[COLLECTION].find_one({"_id": oid, "user_id": user_id}, CARD_PROJECTION)
 
 
 def delete_companion(companion_id, user_id: ObjectId) -> bool:
@@ -549,6 +715,10 @@ def delete_companion(companion_id, user_id: ObjectId) -> bool:
         return False
     result = db.db[COLLECTION].delete_one({"_id": oid, "user_id": user_id, "is_default": False})
     _cache_invalidate(str(oid))
+    if result.deleted_count > 0:
+        lorebook_store.delete_all(oid)
+        from lorebook_vectors import delete_lorebook_vectors
+        delete_lorebook_vectors(oid)
     return result.deleted_count > 0
 
 
@@ -602,15 +772,20 @@ def add_lorebook_entry(
     except Exception:
         return None
 
-    result = db.db[COLLECTION].update_one(
+    _ensure_lorebook_migrated(oid)
+    # Reserve a position, insert, then bump the version — like update / delete, so
+    # a reader that misses the cache in between can't cache the new version without it
+    doc = db.db[COLLECTION].find_one_and_update(
         {"_id": oid, "user_id": user_id},
-        {
-            "$push": {"lorebook_entries": entry},
-            "$set": {"updated_at": datetime.utcnow()},
-        },
+        {"$inc": {"lorebook_next_position": 1}},
+        projection={"lorebook_next_position": 1},
     )
-    if result.modified_count == 0:
+    if not doc:
         return None
+    lorebook_store.insert_entry(oid, user_id, doc.get("lorebook_next_position", 0), entry)
+    _lorebook_written(oid, count_delta=1)
+    if strategy == "vectorized":
+        _sync_lorebook_vectors(oid)
     _cache_invalidate(str(oid))
     return entry
 
@@ -626,56 +801,55 @@ def update_lorebook_entry(
         "strategy", "insertion_order", "insertion_position",
         "probability", "sticky", "cooldown", "delay", "enabled",
     }
+    # Fields that feed the embedded entry text (lorebook_vectors.entry_text)
+    allowed_text_fields = {"title", "keys", "content", "strategy"}
     set_ops = {}
     for k, v in (fields or {}).items():
         if k not in allowed:
             continue
         if k in ("keys", "secondary_keys"):
-            set_ops[f"lorebook_entries.$.{k}"] = [s.strip() for s in (v or []) if s and s.strip()]
+            set_ops[k] = [s.strip() for s in (v or []) if s and s.strip()]
         elif k in ("insertion_order", "probability"):
-            set_ops[f"lorebook_entries.$.{k}"] = max(0, min(1000 if k == "insertion_order" else 100, int(v)))
+            set_ops[k] = max(0, min(1000 if k == "insertion_order" else 100, int(v)))
         elif k in ("sticky", "cooldown", "delay"):
-            set_ops[f"lorebook_entries.$.{k}"] = max(0, int(v))
+            set_ops[k] = max(0, int(v))
         elif k == "selective_logic":
-            set_ops[f"lorebook_entries.$.selective_logic"] = (
+            set_ops["selective_logic"] = (
                 v if v in ("and_any", "and_all", "not_any", "not_all") else "and_any"
             )
         elif k == "strategy":
-            set_ops[f"lorebook_entries.$.strategy"] = (
+            set_ops["strategy"] = (
                 v if v in ("constant", "selective", "vectorized") else "selective"
             )
         elif k == "insertion_position":
-            set_ops[f"lorebook_entries.$.insertion_position"] = v if v in (
+            set_ops["insertion_position"] = v if v in (
                 "before_char_defs", "after_char_defs",
                 "before_example", "after_example",
                 "top_an", "bottom_an", "at_depth",
             ) else "after_char_defs"
         elif k == "enabled":
-            set_ops[f"lorebook_entries.$.enabled"] = bool(v)
+            set_ops["enabled"] = bool(v)
         else:
-            set_ops[f"lorebook_entries.$.{k}"] = v
+            set_ops[k] = v
     if not set_ops:
         return None
-    set_ops["lorebook_entries.$.updated_at"] = datetime.utcnow()
+    set_ops["updated_at"] = datetime.utcnow()
 
     try:
         oid = ObjectId(companion_id) if not isinstance(companion_id, ObjectId) else companion_id
     except Exception:
         return None
 
-    set_ops["updated_at"] = datetime.utcnow()
-    result = db.db[COLLECTION].update_one(
-        {"_id": oid, "user_id": user_id, "lorebook_entries.id": entry_id},
-        {"$set": set_ops},
-    )
-    if result.modified_count == 0:
+    if not db.db[COLLECTION].find_one({"_id": oid, "user_id": user_id}, {"_id": 1}):
+        return None
+    _ensure_lorebook_migrated(oid)
+    if not lorebook_store.update_entry(oid, entry_id, set_ops):
         return None
+    _lorebook_written(oid)
+    if allowed_text_fields & set(fields):
+        _sync_lorebook_vectors(oid)
     _cache_invalidate(str(oid))
-    doc = db.db[COLLECTION].find_one(
-        {"_id": oid, "user_id": user_id, "lorebook_entries.id": entry_id},
-        {"lorebook_entries.$": 1},
-    )
-    return (doc or {}).get("lorebook_entries", [None])[0]
+    return lorebook_store.get_entry(oid, entry_id)
 
 
 def delete_lorebook_entry(companion_id, user_id: ObjectId, entry_id: str) -> bool:
@@ -683,14 +857,31 @@ def delete_lorebook_entry(companion_id, user_id: ObjectId, entry_id: str) -> boo
         oid = ObjectId(companion_id) if not isinstance(companion_id, ObjectId) else companion_id
     except Exception:
         return False
-    result = db.db[COLLECTION].update_one(
-        {"_id": oid, "user_id": user_id},
-        {
-            "$pull": {"lorebook_entries": {"id": entry_id}},
-            "$set": {"updated_at": datetime.utcnow()},
-        },
-    )
-    if result.modified_count > 0:
+    if not db.db[COLLECTION].find_one({"_id": oid, "user_id": user_id}, {"_id": 1}):
+        return False
+    _ensure_lorebook_migrated(oid)
+    if lorebook_store.delete_entry(oid, entry_id):
+        _lorebook_written(oid, count_delta=-1)
+        _sync_lorebook_vectors(oid)
         _cache_invalidate(str(oid))
         return True
     return False
+
+
+def clear_lorebook(companion_id, user_id: ObjectId) -> int:
+    """Delete every lorebook entry of a companion. Returns how many were removed."""
+    oid = _coerce_oid(companion_id)
+    if not oid or not db.db[COLLECTION].find_one({"_id": oid, "user_id": user_id}, {"_id": 1}):
+        return 0
+    _ensure_lorebook_migrated(oid)
+    removed = db.db[lorebook_store.COLLECTION].delete_many({"companion_id": oid}).deleted_count
+    db.db[COLLECTION].update_one(
+        {"_id": oid},
+        {
+            "$set": {"lorebook_count": 0, "updated_at": datetime.utcnow()},
+            "$inc": {"lorebook_version": 1},
+        },
+    )
+    _sync_lorebook_vectors(oid)
+    _cache_invalidate(str(oid))
+    return removed
@@ -2,15 +2,51 @@
 MongoDB 数据库连接和操作模块
 """
 
+import logging
 import os
-from typing import Optional, Dict, Any, List
+import threading
+from typing import Optional, Dict, Any, List, Iterable
 from datetime import datetime
+import bson
 from bson import ObjectId
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, UpdateOne, ASCENDING, DESCENDING
 from pymongo.database import Database
 from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError
 
-from models import UserModel, ConversationModel, WorkspaceModel, init_indexes
+from models import UserModel, ConversationModel, MessageModel, WorkspaceModel, init_indexes
+
+PREVIEW_CHARS = 100           # metadata.last_message_preview 长度
+_MESSAGE_PROJECTION = {"_id": 0, "conversation_id": 0, "user_id": 0}
+_MIGRATED_CACHE_MAX = 50000
+
+# get_conversation_tail 只取热路径用到的字段
+_TAIL_FIELDS = ("user_id", "title", "metadata", "anythingllm_thread_slug", "message_store", "is_active")
+
+log = logging.getLogger(__name__)
+
+_tail_lock = threading.Lock()
+_tail_stats = {"reads": 0, "bytes_read": 0, "bytes_saved": 0, "unsized": 0}
+
+
+def _message_preview(message: Dict) -> str:
+    return (message.get("content") or "")[:PREVIEW_CHARS]
+
+
+def _bson_size(doc: Dict) -> int:
+    return len(bson.encode(doc))
+
+
+def tail_read_stats() -> Dict[str, int]:
+    """get_conversation_tail 累计：读取字节 / 相比整段历史省下的字节（admin stats 用）"""
+    with _tail_lock:
+        return dict(_tail_stats)
+
+
+def _invalidate_user(user_id) -> None:
+    # user_cache imports this module — resolve lazily
+    from user_cache import invalidate_user
+    invalidate_user(user_id)
 
 
 class MongoDB:
@@ -19,6 +55,7 @@ class MongoDB:
     _instance: Optional['MongoDB'] = None
     _client: Optional[MongoClient] = None
     _db: Optional[Database] = None
+    _migrated: set = set()  # 已确认消息在 messages 集合的对话 _id（迁移是单向的）
 
     def __new__(cls):
         if cls._instance is None:
@@ -98,6 +135,7 @@ class MongoDB:
             {"_id": user_id},
             {"$set": {"password_hash": password_hash, "updated_at": datetime.utcnow()}}
         )
+        _invalidate_user(user_id)
         return result.modified_count > 0
 
     def update_user_login(self, user_id: ObjectId) -> bool:
@@ -106,6 +144,7 @@ class MongoDB:
             {"_id": user_id},
             {"$set": {"last_login": datetime.utcnow(), "updated_at": datetime.utcnow()}}
         )
+        _invalidate_user(user_id)
         return result.modified_count > 0
 
     def update_user_workspace(self, user_id: ObjectId, workspace_slug: str) -> bool:
@@ -114,6 +153,7 @@ class MongoDB:
             {"_id": user_id},
             {"$set": {"workspace_slug": workspace_slug, "updated_at": datetime.utcnow()}}
         )
+        _invalidate_user(user_id)
         return result.modified_count > 0
 
     # ==================== Workspace 操作 ====================
@@ -173,11 +213,11 @@ class MongoDB:
         return conv_doc
 
     def get_conversation(self, conv_id: ObjectId, user_id: ObjectId) -> Optional[Dict]:
-        """获取特定对话（确保属于该用户）"""
-        return self.db[ConversationModel.collection_name].find_one({
-            "_id": conv_id,
-            "user_id": user_id
-        })
+        """获取特定对话（确保属于该用户）。不含消息 — 消息用 get_messages / get_recent_messages"""
+        return self.db[ConversationModel.collection_name].find_one(
+            {"_id": conv_id, "user_id": user_id},
+            {"messages": 0}
+        )
 
     def get_user_conversations(
         self,
@@ -185,10 +225,10 @@ class MongoDB:
         limit: int = 20,
         skip: int = 0
     ) -> List[Dict]:
-        """获取用户的对话列表"""
+        """获取用户的对话列表（预览取 metadata.last_message_preview；未迁移的旧对话带最后一条消息）"""
         cursor = self.db[ConversationModel.collection_name].find(
             {"user_id": user_id, "is_active": True},
-            {"messages": {"$slice": -1}}  # 只返回最后一条消息用于预览
+            {"messages": {"$slice": -1}}
         ).sort("updated_at", -1).skip(skip).limit(limit)
         return list(cursor)
 
@@ -205,41 +245,215 @@ class MongoDB:
         audio_url: Optional[str] = None,
         audio_duration: Optional[float] = None
     ) -> bool:
-        """向对话添加消息"""
+        """向对话添加消息：先在对话文档上分配 seq，再写入 messages 集合"""
         message = ConversationModel.create_message(
             role, content, sources, thinking=thinking, attachments=attachments,
             msg_type=msg_type, audio_url=audio_url, audio_duration=audio_duration
         )
-        result = self.db[ConversationModel.collection_name].update_one(
-            {"_id": conv_id, "user_id": user_id},
-            {
-                "$push": {"messages": message},
-                "$set": {
-                    "updated_at": datetime.utcnow(),
-                    "metadata.last_message_at": datetime.utcnow()
-                },
-                "$inc": {"metadata.total_messages": 1}
+        message_bytes = _bson_size(message)
+        now = datetime.utcnow()
+        query = {"_id": conv_id, "user_id": user_id, "message_store": "collection"}
+        update = {
+            "$set": {
+                "updated_at": now,
+                "metadata.last_message_at": now,
+                "metadata.last_message_preview": _message_preview(message)
+            },
+            "$inc": {
+                "metadata.total_messages": 1,
+                "metadata.message_seq": 1,
+                "metadata.message_bytes": message_bytes
             }
+        }
+        convs = self.db[ConversationModel.collection_name]
+        conv = convs.find_one_and_update(
+            query, update, projection={"metadata.message_seq": 1},
+            return_document=ReturnDocument.AFTER
         )
-        return result.modified_count > 0
-
-    def get_active_conversation(self, user_id: ObjectId) -> Optional[Dict]:
-        """获取用户最近的活跃对话，如果没有则创建新的"""
-        conv = self.db[ConversationModel.collection_name].find_one(
-            {"user_id": user_id, "is_active": True},
-            sort=[("updated_at", -1)]
+        if conv is None:
+            # 旧对话（内嵌数组）：先迁移再写
+            self.migrate_conversation_messages(conv_id)
+            conv = convs.find_one_and_update(
+                query, update, projection={"metadata.message_seq": 1},
+                return_document=ReturnDocument.AFTER
+            )
+            if conv is None:
+                return False
+        self.db[MessageModel.collection_name].insert_one(
+            MessageModel.create_message_doc(conv_id, user_id, conv["metadata"]["message_seq"], message)
         )
+        return True
+
+    def get_active_conversation(self, user_id: ObjectId, tail: int = 0) -> Optional[Dict]:
+        """获取用户最近的活跃对话，如果没有则创建新的。tail > 0 时同 get_conversation_tail"""
+        if tail > 0:
+            conv = self._load_tail({"user_id": user_id, "is_active": True}, tail, sort=[("updated_at", -1)])
+        else:
+            conv = self.db[ConversationModel.collection_name].find_one(
+                {"user_id": user_id, "is_active": True},
+                {"messages": 0},
+                sort=[("updated_at", -1)]
+            )
         if not conv:
             conv = self.create_conversation(user_id)
         return conv
 
+    def get_conversation_tail(self, conv_id: ObjectId, user_id: ObjectId, n: int) -> Optional[Dict]:
+        """
+        热路径读取：对话元数据（_TAIL_FIELDS）+ 最近 n 条消息（正序，放在 "messages"）。
+        旧的内嵌数组用 $slice 投影只取尾部；已迁移的对话从 messages 集合按 seq 取 n 条。
+        每次读取记录相比整段历史省下的字节数（tail_read_stats）。
+        """
+        return self._load_tail({"_id": conv_id, "user_id": user_id}, n)
+
+    def _load_tail(self, query: Dict, n: int, sort=None) -> Optional[Dict]:
+        if n > 0:
+            projection: Dict[str, Any] = {f: 1 for f in _TAIL_FIELDS}
+            projection["messages"] = {"$slice": -n}
+        else:
+            projection = {"messages": 0}
+        conv = self.db[ConversationModel.collection_name].find_one(query, projection, sort=sort)
+        if not conv:
+            return None
+
+        if conv.get("message_store") == "collection":
+            conv["messages"] = self._query_messages(conv["_id"], None, n) if n > 0 else []
+        else:
+            conv.setdefault("messages", [])
+
+        total_bytes = (conv.get("metadata") or {}).get("message_bytes")
+        read_bytes = sum(_bson_size(m) for m in conv["messages"])
+        with _tail_lock:
+            _tail_stats["reads"] += 1
+            _tail_stats["bytes_read"] += read_bytes
+            if total_bytes is None:
+                _tail_stats["unsized"] += 1  # 未迁移的旧对话：整段大小未知
+            else:
+                _tail_stats["bytes_saved"] += max(0, total_bytes - read_bytes)
+        if total_bytes is not None:
+            log.debug(f"[CONV-TAIL] {conv['_id']}: {len(conv['messages'])} msgs, "
+                      f"{read_bytes} B read, {max(0, total_bytes - read_bytes)} B saved")
+        return conv
+
     def batch_create_conversations(self, conversations: List[Dict]) -> int:
-        """批量创建导入的对话，返回插入数量"""
+        """批量创建导入的对话（消息写入 messages 集合），返回插入数量"""
         if not conversations:
             return 0
+        pending = []
+        for conv in conversations:
+            messages = conv.pop("messages", None) or []
+            conv["message_store"] = "collection"
+            metadata = conv.setdefault("metadata", {})
+            metadata["message_seq"] = len(messages)
+            metadata["message_bytes"] = sum(_bson_size(m) for m in messages)
+            metadata["last_message_preview"] = _message_preview(messages[-1]) if messages else ""
+            pending.append(messages)
         result = self.db[ConversationModel.collection_name].insert_many(conversations)
+
+        docs = [
+            MessageModel.create_message_doc(conv_id, conv["user_id"], seq, message)
+            for conv_id, conv, messages in zip(result.inserted_ids, conversations, pending)
+            for seq, message in enumerate(messages, 1)
+        ]
+        if docs:
+            self.db[MessageModel.collection_name].insert_many(docs, ordered=False)
         return len(result.inserted_ids)
 
+    # ==================== 消息操作（messages 集合） ====================
+    # 以下读取接口不校验归属 — 调用方先用 get_conversation(conv_id, user_id) 确认
+
+    def migrate_conversation_messages(self, conv_id: ObjectId) -> bool:
+        """
+        Lazy migration：把旧对话内嵌的 messages 数组搬到 messages 集合。
+        幂等（按 (conversation_id, seq) upsert），并发迁移同一对话也安全。
+        返回 True 表示本次做了迁移。
+        """
+        if conv_id in self._migrated:
+            return False
+        convs = self.db[ConversationModel.collection_name]
+        doc = convs.find_one(
+            {"_id": conv_id, "message_store": {"$ne": "collection"}},
+            {"messages": 1, "user_id": 1}
+        )
+        if not doc:
+            self._remember_migrated(conv_id)
+            return False
+
+        embedded = doc.get("messages") or []
+        if embedded:
+            ops = [
+                UpdateOne(
+                    {"conversation_id": conv_id, "seq": seq},
+                    {"$setOnInsert": MessageModel.create_message_doc(conv_id, doc["user_id"], seq, m)},
+                    upsert=True
+                )
+                for seq, m in enumerate(embedded, 1)
+            ]
+            try:
+                self.db[MessageModel.collection_name].bulk_write(ops, ordered=False)
+            except BulkWriteError as e:
+                # 并发迁移时 upsert 撞唯一索引 — 另一方已写入同样的数据
+                if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                    raise
+
+        convs.update_one(
+            {"_id": conv_id, "message_store": {"$ne": "collection"}},
+            {
+                "$set": {
+                    "message_store": "collection",
+                    "metadata.message_seq": len(embedded),
+                    "metadata.message_bytes": sum(_bson_size(m) for m in embedded),
+                    "metadata.last_message_preview": _message_preview(embedded[-1]) if embedded else ""
+                },
+                "$unset": {"messages": ""}
+            }
+        )
+        self._remember_migrated(conv_id)
+        return True
+
+    def _remember_migrated(self, conv_id: ObjectId) -> None:
+        if len(self._migrated) >= _MIGRATED_CACHE_MAX:
+            self._migrated.clear()
+        self._migrated.add(conv_id)
+
+    def get_messages(
+        self,
+        conv_id: ObjectId,
+        before: Optional[int] = None,
+        limit: int = 50
+    ) -> List[Dict]:
+        """
+        游标分页：取 seq < before 的最近 limit 条（before 为空则取最新一页），
+        按时间正序返回。下一页用返回结果第一条的 seq 作为 before。
+        """
+        self.migrate_conversation_messages(conv_id)
+        return self._query_messages(conv_id, before, limit)
+
+    def _query_messages(self, conv_id: ObjectId, before: Optional[int], limit: int) -> List[Dict]:
+        query: Dict[str, Any] = {"conversation_id": conv_id}
+        if before is not None:
+            query["seq"] = {"$lt": before}
+        cursor = (self.db[MessageModel.collection_name]
+                  .find(query, _MESSAGE_PROJECTION)
+                  .sort("seq", DESCENDING)
+                  .limit(limit))
+        messages = list(cursor)
+        messages.reverse()
+        return messages
+
+    def get_recent_messages(self, conv_id: ObjectId, n: int) -> List[Dict]:
+        """最近 n 条消息（正序）— 聊天热路径只读尾部"""
+        if n <= 0:
+            return []
+        return self.get_messages(conv_id, limit=n)
+
+    def iter_conversation_messages(self, conv_id: ObjectId) -> Iterable[Dict]:
+        """对话全部消息（正序，游标）— 详情 / 导出用"""
+        self.migrate_conversation_messages(conv_id)
+        return (self.db[MessageModel.collection_name]
+                .find({"conversation_id": conv_id}, _MESSAGE_PROJECTION)
+                .sort("seq", ASCENDING))
+
     def delete_conversation(self, conv_id: ObjectId, user_id: ObjectId) -> bool:
         """软删除对话"""
         result = self.db[ConversationModel.collection_name].update_one(
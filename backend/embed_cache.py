@@ -0,0 +1,193 @@
+"""
+Query-embedding cache — skip the embedder for text we've embedded before.
+
+Companion chats repeat themselves (greetings, "我好累", short reactions), and
+every turn embeds the user message for Mem0 search and, with a remote
+lorebook embedder, the lorebook scan window. Vectors are cached under a hash
+of the *normalized* text, so "我好累！！" and "我好累" or "Good night" and
+"good night ~" share one entry:
+
+  1. per-worker LRU (EMBED_CACHE_SIZE entries)
+  2. Redis `emb:{hash}` with EMBED_CACHE_TTL_SECONDS, shared by all workers
+
+Vectors are stored as float16 bytes (768 dims → 1.5 KB, base64 in Redis);
+the round-off (~1e-3 relative) is far below what changes a similarity ranking.
+The key includes a namespace (model, dim, task) so different embedders never
+share vectors.
+
+    vec = cached_embedding("mem0:gemini-embedding-001:768:search", text, embed_fn)
+
+cached_search() is the same two-tier cache for JSON-able lookup results, used
+where the embedding happens server-side and can't be reused directly
+(AnythingLLM vector-search for the shared KB).
+"""
+
+import base64
+import hashlib
+import json
+import logging
+import os
+import re
+import struct
+import threading
+import unicodedata
+from typing import Any, Callable, List, Optional, Sequence
+
+try:
+    import numpy as np
+    _NUMPY_OK = True
+except ImportError:
+    np = None
+    _NUMPY_OK = False
+
+from local_cache import LRUCache
+from redis_client import safe_get, safe_setex
+
+log = logging.getLogger(__name__)
+
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "4096"))
+EMBED_CACHE_TTL_SECONDS = int(os.getenv("EMBED_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+SEARCH_CACHE_SIZE = 1024
+EMBED_CACHE_ENABLED = os.getenv("EMBED_CACHE", "on").lower() != "off"
+
+_embeddings = LRUCache("embeddings", maxsize=EMBED_CACHE_SIZE)
+_searches = LRUCache("search_results", maxsize=SEARCH_CACHE_SIZE)
+
+_lock = threading.Lock()
+_stats = {"embedding": {"local_hits": 0, "redis_hits": 0, "misses": 0},
+          "search": {"local_hits": 0, "redis_hits": 0, "misses": 0}}
+
+
+def _count(kind: str, field: str) -> None:
+    with _lock:
+        _stats[kind][field] += 1
+
+
+# ---------- Keys ----------
+
+_SPACE_RE = re.compile(r"\s+")
+
+
+def _edge_char(ch: str) -> bool:
+    """Punctuation / symbols / spaces (incl. emoji, ~, ！) trimmed from both ends."""
+    return unicodedata.category(ch)[0] in "PSZ"
+
+
+def normalize_text(text: str) -> str:
+    """NFKC + casefold + collapsed whitespace, surrounding punctuation / emoji trimmed."""
+    norm = _SPACE_RE.sub(" ", unicodedata.normalize("NFKC", text or "").casefold()).strip()
+    start, end = 0, len(norm)
+    while start < end and _edge_char(norm[start]):
+        start += 1
+    while end > start and _edge_char(norm[end - 1]):
+        end -= 1
+    return norm[start:end] or norm
+
+
+def cache_key(namespace: str, text: str) -> str:
+    digest = hashlib.blake2b(f"{namespace}\0{normalize_text(text)}".encode("utf-8", "surrogatepass"),
+                             digest_size=16)
+    return digest.hexdigest()
+
+
+# ---------- float16 codec ----------
+
+def encode_vector(vec: Sequence[float]) -> bytes:
+    if _NUMPY_OK:
+        return np.asarray(vec, dtype="<f2").tobytes()
+    return struct.pack(f"<{len(vec)}e", *vec)
+
+
+def decode_vector(raw: bytes) -> List[float]:
+    if _NUMPY_OK:
+        return np.frombuffer(raw, dtype="<f2").astype(np.float32).tolist()
+    return list(struct.unpack(f"<{len(raw) // 2}e", raw))
+
+
+# ---------- Two-tier lookup ----------
+
+def cached_embedding(namespace: str, text: str, compute: Callable[[str], Sequence[float]]) -> List[float]:
+    """Embedding of text under namespace; compute(text) only on a miss."""
+    if not EMBED_CACHE_ENABLED or not (text or "").strip():
+        return list(compute(text))
+    key = cache_key(namespace, text)
+    raw = _embeddings.get(key)
+    if raw is not None:
+        _count("embedding", "local_hits")
+        return decode_vector(raw)
+
+    stored = safe_get(f"emb:{key}")
+    if stored:
+        try:
+            raw = base64.b64decode(stored)
+            _embeddings.put(key, raw)
+            _count("embedding", "redis_hits")
+            return decode_vector(raw)
+        except Exception as e:
+            log.debug(f"[EMBED_CACHE] bad entry {key}: {e}")
+
+    _count("embedding", "misses")
+    vec = list(compute(text))
+    raw = encode_vector(vec)
+    _embeddings.put(key, raw)
+    safe_setex(f"emb:{key}", EMBED_CACHE_TTL_SECONDS, base64.b64encode(raw).decode("ascii"))
+    return vec
+
+
+def cached_search(namespace: str, text: str, compute: Callable[[str], Optional[Any]],
+                  ttl_seconds: int = 24 * 3600) -> Optional[Any]:
+    """JSON-able lookup result for text; compute(text) on a miss. None results
+    (errors) are returned but not cached."""
+    if not EMBED_CACHE_ENABLED or not (text or "").strip():
+        return compute(text)
+    key = cache_key(namespace, text)
+    hit = _searches.get(key)
+    if hit is not None:
+        _count("search", "local_hits")
+        return json.loads(hit)
+
+    stored = safe_get(f"srch:{key}")
+    if stored:
+        _searches.put(key, stored)
+        _count("search", "redis_hits")
+        return json.loads(stored)
+
+    _count("search", "misses")
+    result = compute(text)
+    if result is not None:
+        payload = json.dumps(result, ensure_ascii=False)
+        _searches.put(key, payload)
+        safe_setex(f"srch:{key}", ttl_seconds, payload)
+    return result
+
+
+# ---------- Embedder wrappers ----------
+
+class CachedMem0Embedder:
+    """Drop-in for a Mem0 embedding model: embed(text, memory_action) goes
+    through the cache; everything else is delegated."""
+
+    def __init__(self, inner, namespace: str):
+        self._inner = inner
+        self._namespace = namespace
+
+    def embed(self, text, memory_action=None):
+        if not isinstance(text, str):
+            return self._inner.embed(text, memory_action)
+        return cached_embedding(f"{self._namespace}:{memory_action or '-'}", text,
+                                lambda t: self._inner.embed(t, memory_action))
+
+    def __getattr__(self, name):
+        return getattr(self._inner, name)
+
+
+def embed_cache_stats() -> dict:
+    """Process-local counters since startup (admin stats)."""
+    with _lock:
+        stats = {kind: dict(counts) for kind, counts in _stats.items()}
+    for counts in stats.values():
+        hits = counts["local_hits"] + counts["redis_hits"]
+        total = hits + counts["misses"]
+        counts["calls_avoided"] = hits
+        counts["hit_rate"] = round(hits / total, 3) if total else None
+    return stats
@@ -0,0 +1,191 @@
+"""
+Enrichment pipeline — the pre-LLM steps of a chat turn, run concurrently.
+
+Before the first token can be requested, chat_stream needs the workspace, the
+conversation, the saved user message, the AnythingLLM thread, Mem0 memory,
+web-search results, KB references and the lorebook block. Most of these don't
+depend on each other, yet they ran one after another, so a slow Gemini
+classify + Serper round-trip delayed every search-eligible turn.
+
+Steps declare their dependencies by name; a step's function receives the
+results of its dependencies as keyword arguments and is submitted to a shared
+thread pool as soon as they are resolved. Optional steps get a timeout and a
+default: when a step times out or raises, the turn proceeds with the default
+and the late result is discarded. The timeout runs from the moment the step
+starts on a pool thread, not from submission — under load a step may sit in
+the queue behind other turns' work (timed-out steps keep their thread until
+their call returns), and queue time must not turn into silently dropped
+memory / lorebook / search. Queue waits are kept in queued_ms.
+Required steps (no timeout) propagate their exception to the caller.
+
+    pipe = EnrichmentPipeline("chat_stream", timer=_timer)
+    pipe.add("workspace", lambda: ..., required=True)
+    pipe.add("search", lambda: ..., timeout=4.0, default=("", False))
+    pipe.add("thread", lambda workspace, conversation: ..., after=("workspace", "conversation"),
+             timeout=10.0, default=(None, ""))
+    results = pipe.run()
+
+Per-step durations go to the StepTimer (timing.py); timed-out / failed steps
+are marked and logged.
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, Optional
+
+log = logging.getLogger(__name__)
+
+ENRICH_WORKERS = int(os.getenv("ENRICH_WORKERS", "64"))
+QUEUE_POLL_SECONDS = 0.02   # how often run() checks whether a queued timed step has started
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+_executor_pid = None
+
+
+def _pool() -> ThreadPoolExecutor:
+    """Shared per-process pool (recreated after a fork — worker threads don't survive it)."""
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor is None or _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(max_workers=ENRICH_WORKERS, thread_name_prefix="enrich")
+                _executor_pid = os.getpid()
+    return _executor
+
+
+def step_timeout(name: str, default: float) -> float:
+    """Per-step timeout in seconds; ENRICH_TIMEOUT_<NAME>_MS overrides."""
+    env = os.getenv(f"ENRICH_TIMEOUT_{name.upper()}_MS")
+    if env:
+        try:
+            return int(env) / 1000.0
+        except ValueError:
+            pass
+    return default
+
+
+class _Step:
+    __slots__ = ("name", "fn", "after", "timeout", "default", "required")
+
+    def __init__(self, name, fn, after, timeout, default, required):
+        self.name = name
+        self.fn = fn
+        self.after = tuple(after)
+        self.timeout = timeout
+        self.default = default
+        self.required = required
+
+
+class EnrichmentPipeline:
+    def __init__(self, name: str, timer=None):
+        self.name = name
+        self.timer = timer
+        self._steps: Dict[str, _Step] = {}
+        self.status: Dict[str, str] = {}       # name → ok | timeout | error
+        self.elapsed_ms: Dict[str, float] = {}
+        self.queued_ms: Dict[str, float] = {}   # submit → start on a pool thread
+        self._started: Dict[str, float] = {}    # name → monotonic start (set by the pool thread)
+        self._submitted: Dict[str, float] = {}
+
+    def add(
+        self,
+        name: str,
+        fn: Callable[..., Any],
+        *,
+        after: Iterable[str] = (),
+        timeout: Optional[float] = None,
+        default: Any = None,
+        required: bool = False,
+    ) -> None:
+        """Register a step. fn(**{dep: result for dep in after}) → result."""
+        if name in self._steps:
+            raise ValueError(f"duplicate enrichment step {name!r}")
+        for dep in after:
+            if dep not in self._steps:
+                raise ValueError(f"step {name!r} depends on unknown step {dep!r}")
+        self._steps[name] = _Step(name, fn, after, None if required else timeout, default, required)
+
+    def _timed(self, step: _Step, kwargs: Dict[str, Any]):
+        self._started[step.name] = time.monotonic()     # the step's deadline starts here
+        start = time.perf_counter()
+        try:
+            return step.fn(**kwargs)
+        finally:
+            self.elapsed_ms[step.name] = (time.perf_counter() - start) * 1000.0
+
+    def run(self) -> Dict[str, Any]:
+        """Run every step; returns name → result (or default). Blocks until all
+        steps are resolved; raises the exception of a failed required step."""
+        pool = _pool()
+        results: Dict[str, Any] = {}
+        pending = dict(self._steps)
+        running = {}            # future → step
+        started = time.perf_counter()
+
+        def deadline(step: _Step) -> Optional[float]:
+            begun = self._started.get(step.name)
+            return begun + step.timeout if begun is not None else None
+
+        def resolve(step: _Step, value: Any, status: str) -> None:
+            results[step.name] = value
+            self.status[step.name] = status
+            if self.timer is not None:
+                ms = self.elapsed_ms.get(step.name)
+                if ms is None:
+                    ms = (time.perf_counter() - started) * 1000.0
+                self.timer.record(step.name, ms, "" if status == "ok" else status)
+
+        while pending or running:
+            for name in [n for n, s in pending.items() if all(d in results for d in s.after)]:
+                step = pending.pop(name)
+                kwargs = {d: results[d] for d in step.after}
+                self._submitted[name] = time.monotonic()
+                running[pool.submit(self._timed, step, kwargs)] = step
+            if not running:
+                break   # unreachable with add()'s dependency check
+
+            timed = [s for s in running.values() if s.timeout]
+            deadlines = [d for d in map(deadline, timed) if d is not None]
+            wait_for = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            if len(deadlines) < len(timed):     # a timed step is still queued — look again soon
+                wait_for = QUEUE_POLL_SECONDS if wait_for is None else min(wait_for, QUEUE_POLL_SECONDS)
+            done, _ = wait(list(running), timeout=wait_for, return_when=FIRST_COMPLETED)
+
+            for fut in done:
+                step = running.pop(fut)
+                try:
+                    resolve(step, fut.result(), "ok")
+                except Exception as e:
+                    if step.required:
+                        for other in running:
+                            other.cancel()
+                        raise
+                    log.warning(f"[ENRICH:{self.name}] {step.name} failed, using default: {e}")
+                    resolve(step, step.default, "error")
+
+            now = time.monotonic()
+            for fut, step in list(running.items()):
+                due = deadline(step) if step.timeout else None
+                if due is not None and now >= due:
+                    running.pop(fut)
+                    log.warning(f"[ENRICH:{self.name}] {step.name} timed out after {step.timeout * 1000:.0f}ms, "
+                                f"using default")
+                    self.elapsed_ms[step.name] = step.timeout * 1000.0
+                    resolve(step, step.default, "timeout")
+
+        for name, begun in self._started.items():
+            self.queued_ms[name] = max(0.0, (begun - self._submitted.get(name, begun)) * 1000.0)
+        slow = {n: round(ms) for n, ms in self.queued_ms.items() if ms >= 100}
+        if slow:
+            log.warning(f"[ENRICH:{self.name}] steps queued for a pool thread (ms): {slow}")
+        if self.timer is not None:
+            self.timer.mark("enrich")
+        return results
+
+    def degraded(self) -> Dict[str, str]:
+        """Steps that fell back to their default (name → timeout | error)."""
+        return {n: s for n, s in self.status.items() if s != "ok"}
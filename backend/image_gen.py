@@ -214,7 +214,8 @@ def _extract_persona_from_workspace(user_id, db) -> str:
         allm_key = os.getenv("ANYTHINGLLM_API_KEY", "")
         headers = {"Authorization": f"Bearer {allm_key}", "accept": "application/json"}
 
-        resp = requests.get(f"{allm_url}/api/v1/workspace/{slug}", headers=headers, timeout=5)
+        from anythingllm_api import anythingllm_request
+        resp = anythingllm_request("GET", f"{allm_url}/api/v1/workspace/{slug}", headers=headers, timeout=5)
         if not resp.ok:
             return ""
 
@@ -248,7 +249,8 @@ def get_appearance_prefix(user_id, db) -> str:
     获取用户角色的外观描述前缀。
     优先级：缓存 → MongoDB persona → AnythingLLM workspace prompt → 默认外观
     """
-    user = db.db["users"].find_one({"_id": user_id})
+    from user_cache import get_user, invalidate_user
+    user = get_user(user_id)
     if not user:
         return ""
 
@@ -265,6 +267,7 @@ def get_appearance_prefix(user_id, db) -> str:
                 {"_id": user_id},
                 {"$set": {"settings.image_appearance": cached}}
             )
+            invalidate_user(user_id)
             logger.info(f"[IMAGE_GEN] Injected source name '{source_name}' into appearance for user {user_id}")
         return cached
 
@@ -297,6 +300,7 @@ def get_appearance_prefix(user_id, db) -> str:
             {"_id": user_id},
             {"$set": {"settings.image_appearance": appearance}}
         )
+        invalidate_user(user_id)
         logger.info(f"[IMAGE_GEN] Cached appearance for user {user_id}")
         return appearance
 
@@ -0,0 +1,412 @@
+"""
+Durable background job queue — post-reply work that used to run on bare
+daemon threads (memory extraction, expired-memory cleanup, conversation
+titling).
+
+Bare threads were lost on every gunicorn restart and, under a burst, spawned
+one thread per turn that all hit Gemini at once. Jobs now live in the
+`background_jobs` collection (models.BackgroundJobModel):
+
+  - enqueue() inserts a job and wakes this process's dispatcher; handlers
+    run on a bounded pool per kind (register(..., concurrency=N) per worker)
+  - a claimed job holds a lease (JOB_LEASE_SECONDS), renewed by the
+    dispatcher every third of it while the handler runs; if its worker dies
+    the lease expires and any worker picks it up again
+  - failures retry with exponential backoff (backoff * 2^(attempt-1)) up to
+    max_attempts, then stay as `failed` for JOB_FAILED_RETENTION_DAYS
+  - coalesce_key serializes jobs: at most one job per key runs at a time
+    (e.g. mem:{user_id} — memory writes of one user never race). With
+    dedupe=True, enqueueing while an identical job is still pending is a
+    no-op (titles, cleanup). Serialization across workers is best-effort.
+  - enqueue_batched() debounces: items for the same kind + key are $push-ed
+    into one pending job that runs `window` seconds after the latest item,
+    at most max_wait after the first (or as soon as it holds max_items) —
+    one handler call per burst
+  - successful jobs are deleted
+
+Handlers receive the job payload (BSON-able dict) and signal failure by
+raising. Only kinds registered in this process are claimed here, so a process
+that only enqueues (voice_server) never runs jobs.
+
+    register("conversation_title", _title_job, concurrency=2)
+    enqueue("conversation_title", {...}, coalesce_key=f"title:{conv_id}", dedupe=True)
+
+If Mongo is unavailable at enqueue time, a locally registered job runs once on
+the pool (the old fire-and-forget behaviour) instead of being dropped.
+"""
+
+import heapq
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from database import db
+from models import BackgroundJobModel
+
+log = logging.getLogger(__name__)
+
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "2"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "120"))
+JOB_FAILED_RETENTION_DAYS = 7
+MAX_ERROR_CHARS = 500
+
+
+class _Kind:
+    __slots__ = ("name", "handler", "concurrency", "max_attempts", "backoff", "running")
+
+    def __init__(self, name, handler, concurrency, max_attempts, backoff):
+        self.name = name
+        self.handler = handler
+        self.concurrency = max(1, int(concurrency))
+        self.max_attempts = max(1, int(max_attempts))
+        self.backoff = backoff
+        self.running = 0
+
+
+_kinds: Dict[str, _Kind] = {}
+_lock = threading.Lock()
+_wake = threading.Event()
+_pool: Optional[ThreadPoolExecutor] = None
+_dispatcher: Optional[threading.Thread] = None
+_dispatcher_pid = None
+_running_ids: Set = set()         # jobs executing here — leases renewed by the dispatcher
+_due: List[float] = []            # monotonic due times of delayed jobs queued here (heap)
+_wait_until = 0.0                 # when the idle dispatcher will next look on its own
+
+_stats_lock = threading.Lock()
+_stats = {"enqueued": 0, "coalesced": 0, "succeeded": 0, "retried": 0, "failed": 0, "inline": 0}
+
+
+def _count(field: str) -> None:
+    with _stats_lock:
+        _stats[field] += 1
+
+
+def _jobs():
+    return db.db[BackgroundJobModel.collection_name]
+
+
+def _owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+# ---------- Registration / startup ----------
+
+def register(kind: str, handler: Callable[[Dict[str, Any]], Any], *, concurrency: int = 2,
+             max_attempts: int = 3, backoff: float = 10.0) -> None:
+    """Handle jobs of this kind in this process (at most `concurrency` at once).
+    JOB_WORKERS_<KIND> overrides concurrency."""
+    env = os.getenv(f"JOB_WORKERS_{kind.upper()}")
+    if env and env.isdigit():
+        concurrency = int(env)
+    with _lock:
+        _kinds[kind] = _Kind(kind, handler, concurrency, max_attempts, backoff)
+
+
+def start() -> None:
+    """Start this process's dispatcher (idempotent; restarts after a fork)."""
+    global _pool, _dispatcher, _dispatcher_pid
+    if not _kinds:
+        return
+    if _dispatcher is not None and _dispatcher_pid == os.getpid() and _dispatcher.is_alive():
+        return
+    with _lock:
+        if _dispatcher is not None and _dispatcher_pid == os.getpid() and _dispatcher.is_alive():
+            return
+        for k in _kinds.values():
+            k.running = 0
+        _running_ids.clear()
+        _due.clear()
+        _pool = ThreadPoolExecutor(max_workers=sum(k.concurrency for k in _kinds.values()),
+                                   thread_name_prefix="job")
+        _dispatcher = threading.Thread(target=_dispatch_loop, name="job-dispatcher", daemon=True)
+        _dispatcher_pid = os.getpid()
+        _dispatcher.start()
+    log.info(f"[JOBS] Dispatcher started in pid {os.getpid()}: "
+             + ", ".join(f"{k.name}×{k.concurrency}" for k in _kinds.values()))
+
+
+# ---------- Enqueue ----------
+
+def enqueue(kind: str, payload: Dict[str, Any], *, coalesce_key: Optional[str] = None,
+            dedupe: bool = False, delay: float = 0.0) -> bool:
+    """Queue a job. Returns False when it was coalesced into a pending one."""
+    spec = _kinds.get(kind)
+    run_at = datetime.utcnow() + timedelta(seconds=delay) if delay else None
+    doc = BackgroundJobModel.create_job(
+        kind, payload, coalesce_key=coalesce_key, dedupe=bool(dedupe and coalesce_key), run_at=run_at,
+        max_attempts=spec.max_attempts if spec else 3,
+    )
+    try:
+        if doc["dedupe"]:
+            result = _jobs().update_one(
+                {"kind": kind, "coalesce_key": coalesce_key, "status": "pending", "dedupe": True},
+                {"$setOnInsert": doc},
+                upsert=True,
+            )
+            if result.upserted_id is None:
+                _count("coalesced")
+                return False
+        else:
+            _jobs().insert_one(doc)
+    except DuplicateKeyError:
+        _count("coalesced")
+        return False
+    except Exception as e:
+        if spec is None:
+            log.error(f"[JOBS] enqueue {kind} failed, job dropped: {e}")
+            return True
+        log.warning(f"[JOBS] enqueue {kind} failed, running inline: {e}")
+        _count("inline")
+        start()
+        _pool.submit(_run_inline, spec, payload)
+        return True
+
+    _count("enqueued")
+    if spec is not None:
+        start()
+        _wake_at(delay)
+    return True
+
+
+def enqueue_batched(kind: str, coalesce_key: str, item: Dict[str, Any], *, base: Optional[Dict[str, Any]] = None,
+                    window: float = 10.0, max_wait: float = 60.0, max_items: int = 8,
+                    flush_within: Optional[float] = None) -> None:
+    """
+    Append item to payload["items"] of the pending `kind` job for coalesce_key,
+    creating it (with payload fields from base) if there is none. Trailing
+    debounce: the job runs `window` seconds after the latest item, but no later
+    than max_wait after the first one, right away once it holds max_items (later
+    items go to a new job), and within flush_within seconds of this item when given.
+    """
+    spec = _kinds.get(kind)
+    now = datetime.utcnow()
+    doc = BackgroundJobModel.create_job(
+        kind, {}, coalesce_key=coalesce_key, dedupe=True, max_attempts=spec.max_attempts if spec else 3,
+    )
+    for field in ("payload", "run_at"):
+        doc.pop(field)
+    on_insert = dict(doc, **{f"payload.{k}": v for k, v in (base or {}).items()})
+    query = {"kind": kind, "coalesce_key": coalesce_key, "status": "pending", "dedupe": True}
+    job = None
+    try:
+        for _ in range(2):
+            try:
+                job = _jobs().find_one_and_update(
+                    query,
+                    {"$push": {"payload.items": item}, "$max": {"run_at": now + timedelta(seconds=window)},
+                     "$setOnInsert": on_insert},
+                    upsert=True,
+                    projection={"payload.items": 1, "run_at": 1, "created_at": 1},
+                    return_document=ReturnDocument.AFTER,
+                )
+                break
+            except DuplicateKeyError:
+                continue    # lost the insert race — retry pushes into the winner's job
+        if job is None:
+            raise RuntimeError(f"could not queue {kind} item for {coalesce_key}")
+    except Exception as e:
+        if spec is None:
+            log.error(f"[JOBS] enqueue {kind} failed, item dropped: {e}")
+            return
+        log.warning(f"[JOBS] enqueue {kind} failed, running inline: {e}")
+        _count("inline")
+        start()
+        _pool.submit(_run_inline, spec, dict(base or {}, items=[item]))
+        return
+
+    items = len((job.get("payload") or {}).get("items") or [])
+    _count("enqueued" if items == 1 else "coalesced")
+    run_at = job["run_at"]
+    due = min(run_at, job.get("created_at", now) + timedelta(seconds=max_wait))
+    sealed = items >= max_items
+    if sealed:
+        due = now
+    if flush_within is not None:
+        due = min(due, now + timedelta(seconds=flush_within))
+    if due < run_at or sealed:
+        # a full batch leaves the dedupe index, so the next item starts a new job
+        fields = {"run_at": due, "dedupe": False} if sealed else {"run_at": due}
+        _jobs().update_one({"_id": job["_id"], "status": "pending"}, {"$set": fields})
+    if spec is not None:
+        start()
+        _wake_at(max(0.0, (due - now).total_seconds()))
+
+
+def _wake_at(delay: float) -> None:
+    """Wake the dispatcher now, or have it wait only until a delayed job is due
+    (instead of up to JOB_POLL_SECONDS past it)."""
+    if delay <= 0:
+        _wake.set()
+        return
+    due = time.monotonic() + delay
+    with _lock:
+        heapq.heappush(_due, due)
+        if due < _wait_until:
+            _wake.set()     # the dispatcher is sleeping past it — recompute the wait
+
+
+def _run_inline(spec: _Kind, payload: Dict[str, Any]) -> None:
+    try:
+        spec.handler(payload)
+    except Exception as e:
+        log.warning(f"[JOBS] {spec.name} (inline) failed: {e}")
+
+
+# ---------- Dispatch ----------
+
+def _claim(spec: _Kind) -> Optional[Dict]:
+    now = datetime.utcnow()
+    busy = [k for k in _jobs().distinct("coalesce_key", {"status": "running", "lease_until": {"$gt": now}}) if k]
+    query: Dict[str, Any] = {
+        "kind": spec.name,
+        "$or": [
+            {"status": "pending", "run_at": {"$lte": now}},
+            {"status": "running", "lease_until": {"$lte": now}},     # lease expired: worker died
+        ],
+    }
+    if busy:
+        query["coalesce_key"] = {"$nin": busy}
+    return _jobs().find_one_and_update(
+        query,
+        {"$set": {"status": "running", "owner": _owner(), "lease_until": now + timedelta(seconds=JOB_LEASE_SECONDS)},
+         "$inc": {"attempts": 1}},
+        sort=[("run_at", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def _idle_timeout() -> float:
+    """Sleep until the earliest delayed job queued here is due, at most
+    JOB_POLL_SECONDS (jobs queued by other processes, retries)."""
+    global _wait_until
+    now = time.monotonic()
+    timeout = min(JOB_POLL_SECONDS, JOB_LEASE_SECONDS / 3)
+    with _lock:
+        while _due and _due[0] <= now:
+            heapq.heappop(_due)
+        if _due:
+            timeout = min(timeout, _due[0] - now + 0.05)
+        _wait_until = now + timeout
+    return timeout
+
+
+def _renew_leases() -> None:
+    with _lock:
+        ids = list(_running_ids)
+    if ids:
+        _jobs().update_many(
+            {"_id": {"$in": ids}, "owner": _owner(), "status": "running"},
+            {"$set": {"lease_until": datetime.utcnow() + timedelta(seconds=JOB_LEASE_SECONDS)}},
+        )
+
+
+def _dispatch_loop() -> None:
+    renew_at = time.monotonic() + JOB_LEASE_SECONDS / 3
+    while True:
+        claimed = False
+        if time.monotonic() >= renew_at:
+            renew_at = time.monotonic() + JOB_LEASE_SECONDS / 3
+            try:
+                _renew_leases()
+            except Exception as e:
+                log.warning(f"[JOBS] lease renewal failed: {e}")
+        try:
+            for spec in list(_kinds.values()):
+                while spec.running < spec.concurrency:
+                    job = _claim(spec)
+                    if job is None:
+                        break
+                    with _lock:
+                        spec.running += 1
+                        _running_ids.add(job["_id"])
+                    _pool.submit(_execute, spec, job)
+                    claimed = True
+        except Exception as e:
+            log.warning(f"[JOBS] dispatch error: {e}")
+        if not claimed:
+            _wake.wait(_idle_timeout())
+            _wake.clear()
+
+
+def _execute(spec: _Kind, job: Dict) -> None:
+    job_id = job["_id"]
+    start_t = time.perf_counter()
+    try:
+        spec.handler(job.get("payload") or {})
+        _jobs().delete_one({"_id": job_id, "owner": _owner()})
+        _count("succeeded")
+        log.debug(f"[JOBS] {spec.name} {job_id} done in {(time.perf_counter() - start_t) * 1000:.0f}ms")
+    except Exception as e:
+        _fail(spec, job, e)
+    finally:
+        with _lock:
+            spec.running -= 1
+            _running_ids.discard(job_id)
+        _wake.set()
+
+
+def _fail(spec: _Kind, job: Dict, error: Exception) -> None:
+    attempts = job.get("attempts", 1)
+    max_attempts = job.get("max_attempts") or spec.max_attempts
+    err = f"{type(error).__name__}: {error}"[:MAX_ERROR_CHARS]
+    now = datetime.utcnow()
+    if attempts >= max_attempts:
+        _count("failed")
+        log.warning(f"[JOBS] {spec.name} {job['_id']} failed after {attempts} attempts: {err}")
+        _jobs().update_one({"_id": job["_id"], "owner": _owner()}, {"$set": {
+            "status": "failed", "last_error": err, "lease_until": None,
+            "expires_at": now + timedelta(days=JOB_FAILED_RETENTION_DAYS),
+        }})
+        return
+
+    delay = spec.backoff * (2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+    _count("retried")
+    log.info(f"[JOBS] {spec.name} {job['_id']} attempt {attempts} failed, retry in {delay:.0f}s: {err}")
+    try:
+        _jobs().update_one({"_id": job["_id"], "owner": _owner()}, {"$set": {
+            "status": "pending", "last_error": err, "lease_until": None,
+            "run_at": now + timedelta(seconds=delay),
+        }})
+    except DuplicateKeyError:
+        # an identical deduped job was queued meanwhile — that one covers it;
+        # batched items are folded into it (oldest first) so none are lost
+        items = (job.get("payload") or {}).get("items")
+        if items:
+            _jobs().update_one(
+                {"kind": job["kind"], "coalesce_key": job.get("coalesce_key"), "status": "pending", "dedupe": True},
+                {"$push": {"payload.items": {"$each": items, "$position": 0}}},
+            )
+        _jobs().delete_one({"_id": job["_id"], "owner": _owner()})
+
+
+# ---------- Metrics ----------
+
+def queue_stats() -> Dict[str, Any]:
+    """Queue depth by kind/status (all workers) + this process's counters (admin stats)."""
+    with _stats_lock:
+        stats: Dict[str, Any] = dict(_stats)
+    stats["running_here"] = {k.name: k.running for k in _kinds.values()}
+    depth: Dict[str, Dict[str, int]] = {}
+    try:
+        for row in _jobs().aggregate([{"$group": {"_id": {"kind": "$kind", "status": "$status"}, "n": {"$sum": 1}}}]):
+            depth.setdefault(row["_id"]["kind"], {})[row["_id"]["status"]] = row["n"]
+        oldest = _jobs().find_one({"status": "pending", "run_at": {"$lte": datetime.utcnow()}},
+                                  {"run_at": 1}, sort=[("run_at", 1)])
+        stats["oldest_due_seconds"] = (
+            round((datetime.utcnow() - oldest["run_at"]).total_seconds(), 1) if oldest else 0
+        )
+    except Exception as e:
+        stats["error"] = str(e)
+    stats["depth"] = depth
+    stats["pending"] = sum(d.get("pending", 0) for d in depth.values())
+    return stats
@@ -0,0 +1,95 @@
+"""
+Small in-process LRU cache shared by the hot-path modules.
+
+Per-worker, bounded, thread-safe. Used for derived data that is expensive to
+build and cheap to key — e.g. compiled lorebook keyword automata keyed by a
+content hash. Anything that must be consistent across workers belongs in Redis
+(redis_client.py) instead.
+
+    cache = LRUCache("lorebook_automaton", maxsize=256)
+    value = cache.get(key)            # None on miss
+    cache.put(key, value)
+    value = cache.get_or_build(key, lambda: build(...))
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+_registry: List["LRUCache"] = []
+_registry_lock = threading.Lock()
+
+
+class LRUCache:
+    """Least-recently-used mapping with a fixed number of slots."""
+
+    def __init__(self, name: str, maxsize: int = 256):
+        self.name = name
+        self.maxsize = max(1, int(maxsize))
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        with _registry_lock:
+            _registry.append(self)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_build(self, key: Hashable, build: Callable[[], Any]) -> Any:
+        """Cached value, or build() it outside the lock and store it."""
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = build()
+            self.put(key, value)
+        return value
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            return self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 3) if total else None,
+            }
+
+
+_MISSING = object()
+
+
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+    """Stats for every LRUCache in this process (admin stats)."""
+    with _registry_lock:
+        caches = list(_registry)
+    return {c.name: c.stats() for c in caches}
@@ -14,27 +14,41 @@ Entry shape (new ST/HammerAI schema, with legacy fallback fields):
     enabled, source, created_at, updated_at
 
 Algorithm:
-  1. Load per-conversation state from Redis: {turn, hits{entry_id: {last_turn}}}.
+  1. Load per-conversation state from Redis (hash `lorebook:h:{conv}`:
+     turn + e:{entry_id} → last_turn) as {turn, hits{entry_id: {last_turn}}}.
   2. Constant entries (strategy=constant) always enter the candidate pool
      unless under cooldown.
   3. Sticky pass: any entry with sticky>0 that fired within the last `sticky`
      turns is force-included (mirrors ST behavior).
-  4. Tokenize scan window (current msg + last N turns) with jieba.
-  5. For each non-constant entry: skip if disabled / under cooldown / not yet
-     past its delay; otherwise match keys against tokens with the entry's
-     selective_logic. Apply probability gate.
+  4. Tokenize scan window (current msg + last N turns) with jieba — per
+     message, through an LRU keyed by message hash, so each turn only
+     segments the new user message.
+  5. Find every key present in the window in one pass with the lorebook's
+     compiled keyword index (Aho-Corasick automaton for substring-eligible
+     keys + set lookup for token-only keys, built once per lorebook content
+     hash). For each non-constant entry with a primary key hit: skip if
+     disabled / under cooldown / not yet past its delay; otherwise apply the
+     entry's selective_logic and the probability gate.
+     Vectorized entries (strategy=vectorized) can also fire by similarity:
+     the window is embedded once and scored against the companion's
+     precomputed entry matrix (lorebook_vectors.py); the top-k above the
+     threshold pass through the same gates.
   6. Apply recency bonus to entries that fired last turn (keeps context
      alive across pronoun-only follow-ups).
   7. Sort by effective insertion_order desc, greedy-fill to token budget.
-  8. Persist updated state (turn += 1, fired entries get last_turn=turn).
+  8. Persist updated state — one Lua call increments the turn, stamps the
+     fired entries with it and refreshes the TTL, so concurrent tabs on the
+     same conversation never overwrite each other's hits.
 
 Empty entries / no companion → empty output (drop-in safe).
 """
 
+import hashlib
 import json
 import logging
 import random
-from typing import Dict, List, Optional, Tuple
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Tuple
 
 try:
     import jieba
@@ -49,7 +63,9 @@ except Exception as _e:
         f"[LOREBOOK] jieba unavailable, falling back to substring match: {_e}"
     )
 
-from redis_client import safe_get, safe_setex
+from local_cache import LRUCache
+from prompt_budget import count_tokens
+from redis_client import get_client
 
 log = logging.getLogger(__name__)
 
@@ -57,16 +73,14 @@ STATE_TTL_SECONDS = 24 * 3600
 RECENCY_BONUS = 20
 DEFAULT_BUDGET_TOKENS = 1200
 SCAN_WINDOW_TURNS = 3
+COMPILED_CACHE_SIZE = 256       # compiled keyword indexes kept per worker
+TOKEN_CACHE_SIZE = 4096         # tokenized messages kept per worker
 
 
 def estimate_tokens(text: str) -> int:
-    """CJK ~1.5 chars/token, others ~4 chars/token. Off by ±20%; precise
-    enough for budget cutoffs."""
-    if not text:
-        return 0
-    cjk = sum(1 for ch in text if "一" <= ch <= "鿿")
-    other = len(text) - cjk
-    return int(cjk / 1.5 + other / 4) + 1
+    """Token count for budget cutoffs — prompt_budget.count_tokens (cached per
+    content hash; heuristic unless an exact tokenizer is configured)."""
+    return count_tokens(text)
 
 
 def _tokenize(text: str) -> set:
@@ -79,23 +93,185 @@ def _tokenize(text: str) -> set:
     return toks
 
 
+_token_cache = LRUCache("lorebook_tokens", maxsize=TOKEN_CACHE_SIZE)
+
+
+def _message_tokens(text: str) -> frozenset:
+    """_tokenize(text), cached by content hash. History messages recur in the
+    scan window for SCAN_WINDOW_TURNS turns — segment them once."""
+    if not _JIEBA_OK:
+        return frozenset(_tokenize(text))
+    key = hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+    toks = _token_cache.get(key)
+    if toks is None:
+        toks = frozenset(_tokenize(text))
+        _token_cache.put(key, toks)
+    return toks
+
+
+def _window_tokens(parts: List[str]) -> set:
+    """Tokens of the scan window: union of the per-message token sets.
+
+    jieba never joins a token across the newline between messages, so the jieba
+    tokens are the same as for the joined window. The whole-text fallback token
+    is per message instead of per window — a key that is an entire message
+    matches either way once jieba is on."""
+    tokens: set = set()
+    for p in parts:
+        if p:
+            tokens |= _message_tokens(p)
+    return tokens
+
+
+def _substring_key(k: str) -> bool:
+    """Whether a lowercased key may match anywhere inside the window text.
+
+    Substring fallback for multi-word phrases or rare jieba mis-segments.
+    Restrict to keys long enough that incidental matches inside other words
+    are unlikely (CJK threshold stricter — each CJK char carries more meaning).
+    Shorter keys only match as a whole jieba token."""
+    if " " in k:
+        return True
+    cjk_count = sum(1 for ch in k if "一" <= ch <= "鿿")
+    return cjk_count >= 3 or (cjk_count == 0 and len(k) >= 4)
+
+
 def _key_matches(key: str, scan_text_lower: str, tokens: set) -> bool:
     if not key:
         return False
     k = key.lower()
     if k in tokens:
         return True
-    # Substring fallback for multi-word phrases or rare jieba mis-segments.
-    # Restrict to keys long enough that incidental matches inside other words
-    # are unlikely (CJK threshold stricter — each CJK char carries more meaning).
-    if " " in k:
-        return k in scan_text_lower
-    cjk_count = sum(1 for ch in k if "一" <= ch <= "鿿")
-    if cjk_count >= 3 or (cjk_count == 0 and len(k) >= 4):
+    if _substring_key(k):
         return k in scan_text_lower
     return False
 
 
+# ---------- Compiled keyword index ----------
+# Matching every key of every entry against the window is
+# O(entries × keys × window) per message. Instead each lorebook is compiled
+# once (per content hash) into:
+#   - an Aho-Corasick automaton over the substring-eligible keys — one pass
+#     over the window finds all of them;
+#   - a set of the token-only keys, intersected with the jieba tokens.
+# Jieba tokens are substrings of the window, so a substring-eligible key
+# matches exactly when it occurs in the window — same result as _key_matches.
+
+class KeywordAutomaton:
+    """Aho-Corasick automaton over a fixed set of (lowercased) keywords."""
+
+    def __init__(self, keywords: Iterable[str]):
+        goto: List[Dict[str, int]] = [{}]
+        out: List[Tuple[str, ...]] = [()]
+        for kw in keywords:
+            node = 0
+            for ch in kw:
+                nxt = goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[node][ch] = nxt
+                    goto.append({})
+                    out.append(())
+                node = nxt
+            if kw not in out[node]:
+                out[node] = out[node] + (kw,)
+
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in goto[node].items():
+                queue.append(nxt)
+                f = fail[node]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0)
+                out[nxt] = out[nxt] + out[fail[nxt]]
+
+        self._goto = goto
+        self._fail = fail
+        self._out = out
+        self._alphabet = frozenset(goto[0])
+
+    def findall(self, text: str) -> set:
+        """All keywords that occur in text."""
+        goto, fail, out, start = self._goto, self._fail, self._out, self._alphabet
+        found: set = set()
+        node = 0
+        for ch in text:
+            if node == 0 and ch not in start:
+                continue
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                found.update(out[node])
+        return found
+
+
+class CompiledLorebook:
+    """Keyword index for one lorebook version (entries referenced by position)."""
+
+    def __init__(self, entries: List[Dict]):
+        substring_keys: set = set()
+        self.token_keys: set = set()
+        self.primary_index: Dict[str, List[int]] = {}
+        for i, e in enumerate(entries):
+            for field in ("keys", "secondary_keys"):
+                for key in e.get(field) or []:
+                    if not key or not isinstance(key, str):
+                        continue
+                    k = key.lower()
+                    (substring_keys if _substring_key(k) else self.token_keys).add(k)
+                    if field == "keys":
+                        idx = self.primary_index.setdefault(k, [])
+                        if not idx or idx[-1] != i:
+                            idx.append(i)
+        self.automaton = KeywordAutomaton(sorted(substring_keys))
+        self.key_count = len(substring_keys) + len(self.token_keys)
+
+    def matched_keys(self, scan_text_lower: str, tokens: set) -> set:
+        """Lowercased keys that match the window (same rule as _key_matches)."""
+        found = self.automaton.findall(scan_text_lower)
+        if self.token_keys:
+            found |= self.token_keys & tokens
+        return found
+
+    def candidates(self, matched: set) -> List[int]:
+        """Positions of entries with at least one matched primary key, in order."""
+        hit: set = set()
+        for k in matched:
+            idx = self.primary_index.get(k)
+            if idx:
+                hit.update(idx)
+        return sorted(hit)
+
+
+_compiled = LRUCache("lorebook_automaton", maxsize=COMPILED_CACHE_SIZE)
+
+
+def lorebook_fingerprint(entries: List[Dict]) -> str:
+    """Content hash of the key material (order matters — entries are indexed by position).
+
+    lorebook_store computes it once per lorebook version alongside the cached
+    entries, so the chat path normally skips hashing altogether."""
+    try:
+        parts = []
+        for e in entries:
+            parts.append("\x1f".join(e.get("keys") or ()))
+            parts.append("\x1f".join(e.get("secondary_keys") or ()))
+        material = "\x1e".join(parts)
+    except TypeError:   # non-string keys in hand-edited data
+        material = json.dumps([[e.get("keys"), e.get("secondary_keys")] for e in entries], default=str)
+    return hashlib.blake2b(material.encode("utf-8", "surrogatepass"), digest_size=16).hexdigest()
+
+
+def compile_lorebook(entries: List[Dict], fingerprint: Optional[str] = None) -> CompiledLorebook:
+    """Compiled keyword index for these entries, cached in-process by content hash."""
+    key = fingerprint or lorebook_fingerprint(entries)
+    return _compiled.get_or_build(key, lambda: CompiledLorebook(entries))
+
+
 def _is_constant(entry: Dict) -> bool:
     """Honor both the new strategy field and the legacy `constant` bool."""
     s = (entry.get("strategy") or "").lower()
@@ -154,16 +330,68 @@ def _evaluate_logic(matched_primary: List[str], primary_keys: List[str],
 
 
 # ---------- Redis-backed per-conversation state ----------
+# A Redis hash per conversation: "turn" plus one "e:{entry_id}" field per
+# entry that has fired, holding the turn it last fired on. Conversations
+# started before the hash layout still have a JSON string at
+# lorebook:state:{conv}; it is read as a fallback and folded into the hash by
+# the first record_turn (then deleted). Drop the fallback once those keys have
+# expired (STATE_TTL_SECONDS after deploy).
+
+HIT_FIELD_PREFIX = "e:"
+STATE_MAX_HITS = 200            # GC threshold for e:* fields
+STATE_GC_TURNS = 50             # GC drops hits older than this many turns
+
+# KEYS[1] = state hash, KEYS[2] = legacy JSON key
+# ARGV = ttl, gc_turns, max_fields, entry_id...
+_RECORD_TURN_LUA = """
+local key, legacy = KEYS[1], KEYS[2]
+if redis.call('EXISTS', key) == 0 then
+  local raw = redis.call('GET', legacy)
+  if raw then
+    local ok, data = pcall(cjson.decode, raw)
+    if ok and type(data) == 'table' then
+      redis.call('HSET', key, 'turn', math.floor(tonumber(data['turn']) or 0))
+      if type(data['hits']) == 'table' then
+        for eid, h in pairs(data['hits']) do
+          if type(h) == 'table' and tonumber(h['last_turn']) then
+            redis.call('HSET', key, 'e:' .. eid, math.floor(tonumber(h['last_turn'])))
+          end
+        end
+      end
+    end
+    redis.call('DEL', legacy)
+  end
+end
+local turn = redis.call('HINCRBY', key, 'turn', 1)
+for i = 4, #ARGV do
+  redis.call('HSET', key, 'e:' .. ARGV[i], turn)
+end
+if redis.call('HLEN', key) > tonumber(ARGV[3]) + 1 then
+  local cutoff = turn - tonumber(ARGV[2])
+  local all = redis.call('HGETALL', key)
+  for i = 1, #all, 2 do
+    if all[i] ~= 'turn' and (tonumber(all[i + 1]) or 0) < cutoff then
+      redis.call('HDEL', key, all[i])
+    end
+  end
+end
+redis.call('EXPIRE', key, ARGV[1])
+return turn
+"""
+
+_record_turn_script = None
+
+
+def _hash_key(conversation_id: str) -> str:
+    return f"lorebook:h:{conversation_id}"
+
 
 def _state_key(conversation_id: str) -> str:
+    """Legacy JSON state (pre-hash layout)."""
     return f"lorebook:state:{conversation_id}"
 
 
-def get_state(conversation_id: str) -> Dict:
-    """State shape: {"turn": int, "hits": {entry_id: {"last_turn": int}}}."""
-    raw = safe_get(_state_key(conversation_id))
-    if not raw:
-        return {"turn": 0, "hits": {}}
+def _state_from_json(raw: str) -> Optional[Dict]:
     try:
         data = json.loads(raw)
         if isinstance(data, dict):
@@ -173,15 +401,60 @@ def get_state(conversation_id: str) -> Dict:
             }
     except Exception:
         pass
+    return None
+
+
+def get_state(conversation_id: str) -> Dict:
+    """State shape: {"turn": int, "hits": {entry_id: {"last_turn": int}}}.
+    One round-trip (hash + legacy key pipelined)."""
+    try:
+        pipe = get_client().pipeline(transaction=False)
+        pipe.hgetall(_hash_key(conversation_id))
+        pipe.get(_state_key(conversation_id))
+        fields, legacy = pipe.execute()
+    except Exception as e:
+        log.debug(f"[LOREBOOK] state read({conversation_id}) failed: {e}")
+        return {"turn": 0, "hits": {}}
+
+    if fields:
+        hits = {}
+        for field, value in fields.items():
+            if field.startswith(HIT_FIELD_PREFIX):
+                try:
+                    hits[field[len(HIT_FIELD_PREFIX):]] = {"last_turn": int(value)}
+                except (TypeError, ValueError):
+                    continue
+        try:
+            turn = int(fields.get("turn") or 0)
+        except (TypeError, ValueError):
+            turn = 0
+        return {"turn": turn, "hits": hits}
+    if legacy:
+        return _state_from_json(legacy) or {"turn": 0, "hits": {}}
     return {"turn": 0, "hits": {}}
 
 
-def set_state(conversation_id: str, state: Dict) -> None:
-    payload = json.dumps({
-        "turn": int(state.get("turn", 0) or 0),
-        "hits": state.get("hits") or {},
-    })
-    safe_setex(_state_key(conversation_id), STATE_TTL_SECONDS, payload)
+def record_turn(conversation_id: str, fired_entry_ids: Iterable[str]) -> Optional[int]:
+    """
+    Advance the conversation's turn and mark fired entries with it, atomically.
+
+    Returns the turn number Redis assigned (None if Redis is down). With two
+    tabs racing on one conversation both turns are counted and both hit sets
+    kept — the previous GET/mutate/SETEX lost one of them.
+    """
+    global _record_turn_script
+    try:
+        client = get_client()
+        if _record_turn_script is None:
+            _record_turn_script = client.register_script(_RECORD_TURN_LUA)
+        turn = _record_turn_script(
+            keys=[_hash_key(conversation_id), _state_key(conversation_id)],
+            args=[STATE_TTL_SECONDS, STATE_GC_TURNS, STATE_MAX_HITS, *[eid for eid in fired_entry_ids if eid]],
+        )
+        return int(turn) if turn is not None else None
+    except Exception as e:
+        log.debug(f"[LOREBOOK] record_turn({conversation_id}) failed: {e}")
+        return None
 
 
 # ---------- Selection ----------
@@ -193,12 +466,18 @@ def select_lorebook(
     state: Optional[Dict] = None,
     budget_tokens: int = DEFAULT_BUDGET_TOKENS,
     rng: Optional[random.Random] = None,
+    fingerprint: Optional[str] = None,
+    vector_index=None,
 ) -> Tuple[List[Dict], int, Dict]:
     """
     Returns (selected_entries, tokens_used, new_state).
 
     `state` is the per-conversation state dict from Redis (or None for one-shot
     test mode). The returned new_state should be persisted by the caller.
+    `fingerprint` is lorebook_fingerprint(entries) when the caller already has
+    it (companion_service.get_lorebook returns it with the entries).
+    `vector_index` (lorebook_vectors.VectorIndex) enables similarity activation
+    of vectorized entries; without it they are keyword-only.
     """
     if not entries:
         return [], 0, {"turn": 0, "hits": {}}
@@ -214,7 +493,7 @@ def select_lorebook(
     scan_parts = [user_message] + (history_texts[-SCAN_WINDOW_TURNS:] if history_texts else [])
     scan_text = "\n".join(p for p in scan_parts if p)
     scan_text_lower = scan_text.lower()
-    tokens = _tokenize(scan_text)
+    tokens = _window_tokens(scan_parts)
 
     candidates: List[Dict] = []
     seen_ids: set = set()
@@ -263,21 +542,31 @@ def select_lorebook(
         if last_t and (current_turn - last_t) <= sticky:
             _consider(e, "sticky", [])
 
-    # 3. Keyword-triggered selective entries.
-    for e in entries:
-        if not e.get("enabled", True) or _is_constant(e):
-            continue
-
+    def _gated(e: Dict) -> bool:
+        """Cooldown / delay gates shared by keyword and vector activation."""
         eid = e.get("id")
-        # Cooldown gate
         cooldown = max(0, int(e.get("cooldown", 0) or 0))
         last_t = (hits_map.get(eid) or {}).get("last_turn", 0) if eid else 0
         if cooldown > 0 and last_t and (current_turn - last_t) <= cooldown:
-            continue
-
+            return True
         # Delay gate (require ≥N msgs in chat)
         delay = max(0, int(e.get("delay", 0) or 0))
-        if delay > 0 and msg_count_for_delay < delay:
+        return delay > 0 and msg_count_for_delay < delay
+
+    def _probability_pass(e: Dict) -> bool:
+        # Probability gate (after match — matches ST behavior)
+        prob = max(0, min(100, int(e.get("probability", 100) or 100)))
+        return not (prob < 100 and rng.random() * 100 >= prob)
+
+    # 3. Keyword-triggered selective entries — only those with a primary key
+    # hit, visited in lorebook order.
+    lorebook = compile_lorebook(entries, fingerprint)
+    matched_keys = lorebook.matched_keys(scan_text_lower, tokens)
+    for i in lorebook.candidates(matched_keys):
+        e = entries[i]
+        if not e.get("enabled", True) or _is_constant(e):
+            continue
+        if _gated(e):
             continue
 
         primary_keys = [k for k in (e.get("keys") or []) if k]
@@ -285,21 +574,38 @@ def select_lorebook(
         if not primary_keys:
             continue
 
-        matched_primary = [k for k in primary_keys if _key_matches(k, scan_text_lower, tokens)]
+        matched_primary = [k for k in primary_keys if k.lower() in matched_keys]
         if not matched_primary:
             continue
-        matched_secondary = [k for k in secondary_keys if _key_matches(k, scan_text_lower, tokens)]
+        matched_secondary = [k for k in secondary_keys if k.lower() in matched_keys]
         logic = _normalize_logic(e.get("selective_logic", "and_any"))
         if not _evaluate_logic(matched_primary, primary_keys, matched_secondary, secondary_keys, logic):
             continue
-
-        # Probability gate (after match — matches ST behavior)
-        prob = max(0, min(100, int(e.get("probability", 100) or 100)))
-        if prob < 100 and rng.random() * 100 >= prob:
+        if not _probability_pass(e):
             continue
 
         _consider(e, "keyword", matched_primary)
 
+    # 3b. Vector-triggered vectorized entries not already pooled — one
+    # embedding of the window, one matrix-vector product.
+    if vector_index is not None and len(vector_index):
+        by_id = {e.get("id"): e for e in entries if e.get("id")}
+        try:
+            vector_hits = vector_index.search(scan_text)
+        except Exception as ex:
+            log.warning(f"[LOREBOOK] vector search failed: {ex}")
+            vector_hits = []
+        for eid, score in vector_hits:
+            e = by_id.get(eid)
+            if not e or eid in seen_ids or not e.get("enabled", True) or _is_constant(e):
+                continue
+            if (e.get("strategy") or "").lower() != "vectorized":
+                continue
+            if _gated(e) or not _probability_pass(e):
+                continue
+            e["_vector_score"] = round(score, 3)
+            _consider(e, "vector", [])
+
     # 4. Greedy fill to token budget (highest effective insertion_order first).
     candidates.sort(key=lambda c: -c.get("_eff_order", 50))
     selected: List[Dict] = []
@@ -320,8 +626,8 @@ def select_lorebook(
         if sid:
             new_hits[sid] = {"last_turn": current_turn}
     # Garbage collect very old entries to keep payload bounded.
-    if len(new_hits) > 200:
-        cutoff = current_turn - 50
+    if len(new_hits) > STATE_MAX_HITS:
+        cutoff = current_turn - STATE_GC_TURNS
         new_hits = {k: v for k, v in new_hits.items() if (v.get("last_turn") or 0) >= cutoff}
 
     new_state = {"turn": current_turn, "hits": new_hits}
@@ -362,7 +668,8 @@ def build_lorebook_prefix(
     """
     if not companion:
         return ""
-    entries = companion.get("lorebook_entries") or []
+    from companion_service import get_lorebook
+    entries, fingerprint = get_lorebook(companion, enabled_only=True)
     if not entries:
         return ""
 
@@ -372,6 +679,14 @@ def build_lorebook_prefix(
 
     state = get_state(conv_id) if conv_id else {"turn": 0, "hits": {}}
 
+    vector_index = None
+    if companion.get("lorebook_vectors_version"):
+        try:
+            from lorebook_vectors import load_index
+            vector_index = load_index(companion)
+        except Exception as e:
+            log.warning(f"[LOREBOOK] vector index unavailable: {e}")
+
     try:
         selected, used_tokens, new_state = select_lorebook(
             user_message=user_message,
@@ -379,6 +694,8 @@ def build_lorebook_prefix(
             entries=entries,
             state=state,
             budget_tokens=budget_tokens,
+            fingerprint=fingerprint,
+            vector_index=vector_index,
         )
     except Exception as e:
         log.warning(f"[LOREBOOK] select failed for conv {conv_id}: {e}")
@@ -392,7 +709,9 @@ def build_lorebook_prefix(
         return ""
 
     if conv_id:
-        set_state(conv_id, new_state)
+        turn = record_turn(conv_id, [s.get("id") for s in selected])
+        if turn is not None:
+            new_state["turn"] = turn
 
     # Detailed log so users tailing journalctl can see exactly what fired and
     # why — the lorebook UI also surfaces this, but logs are useful for
@@ -403,6 +722,8 @@ def build_lorebook_prefix(
         reason = e.get("_match_reason", "?")
         if reason in ("constant", "sticky"):
             hit_details.append(f"{title}[{reason}]")
+        elif reason == "vector":
+            hit_details.append(f"{title}[vector {e.get('_vector_score')}]")
         else:
             mk = e.get("_matched_keys") or []
             mk_short = ",".join(mk[:3]) + ("..." if len(mk) > 3 else "")
@@ -0,0 +1,169 @@
+"""
+Lorebook store — companion lorebook entries in their own `lorebook_entries`
+collection (one document per entry, models.LorebookEntryModel).
+
+Entries used to be an array inside the companion document, so every chat
+loaded, JSON-cached and re-parsed 20-30 entries of ~1 KB each just to read the
+card. Now the companion document is the lightweight card plus a
+`lorebook_version` counter that every lorebook write increments; the chat path
+reads the card from the companion cache and the entries through load(), which
+keeps (entries, fingerprint) per worker keyed by (companion_id, version).
+
+Migration is lazy, like the legacy custom_persona → companions one: the first
+read of a companion without `lorebook_migrated` copies its embedded array into
+the collection and unsets it (companion_service.get_lorebook / write paths call
+migrate()). Idempotent — entries are upserted by (companion_id, id).
+
+replace_all() runs between two version bumps with `lorebook_writing` set on
+the companion (bump → delete + insert → bump), and load() only caches a fetch
+when the companion is still at that version with no write in progress — a
+reader holding an older card can't pin an empty / partial list under its key.
+"""
+
+import logging
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import ReplaceOne
+
+from database import db
+from local_cache import LRUCache
+from models import LorebookEntryModel
+
+log = logging.getLogger(__name__)
+
+COLLECTION = LorebookEntryModel.collection_name
+COMPANIONS = "companions"
+ENTRY_CACHE_SIZE = 512          # companion lorebook versions kept per worker
+
+# Storage-only fields, stripped before entries reach callers
+_PROJECTION = {"_id": 0, "companion_id": 0, "user_id": 0, "position": 0}
+
+_entries = LRUCache("lorebook_entries", maxsize=ENTRY_CACHE_SIZE)
+
+
+def _docs(companion_id: ObjectId, user_id: ObjectId, entries: List[Dict], start: int = 0) -> List[Dict]:
+    """Collection documents for entries, ids filled in and de-duplicated."""
+    seen = set()
+    docs = []
+    for i, e in enumerate(entries):
+        entry = dict(e)
+        if not entry.get("id") or entry["id"] in seen:
+            entry["id"] = str(uuid.uuid4())
+        seen.add(entry["id"])
+        docs.append(LorebookEntryModel.create_entry_doc(companion_id, user_id, start + i, entry))
+    return docs
+
+
+def migrate(companion_id: ObjectId) -> bool:
+    """Move a companion's embedded lorebook_entries into the collection.
+    Returns True when this call migrated it (the caller drops its cache)."""
+    doc = db.db[COMPANIONS].find_one(
+        {"_id": companion_id, "lorebook_migrated": {"$ne": True}},
+        {"lorebook_entries": 1, "user_id": 1},
+    )
+    if not doc:
+        return False
+    entries = [e for e in (doc.get("lorebook_entries") or []) if isinstance(e, dict)]
+    docs = _docs(companion_id, doc.get("user_id"), entries)
+    if docs:
+        db.db[COLLECTION].bulk_write(
+            [ReplaceOne({"companion_id": companion_id, "id": d["id"]}, d, upsert=True) for d in docs],
+            ordered=False,
+        )
+    result = db.db[COMPANIONS].update_one(
+        {"_id": companion_id, "lorebook_migrated": {"$ne": True}},
+        {
+            "$set": {
+                "lorebook_migrated": True,
+                "lorebook_count": len(docs),
+                "lorebook_next_position": len(docs),
+            },
+            "$inc": {"lorebook_version": 1},
+            "$unset": {"lorebook_entries": ""},
+        },
+    )
+    if result.modified_count:
+        log.info(f"[LOREBOOK_STORE] Migrated {len(docs)} entries of companion {companion_id}")
+    return bool(result.modified_count)
+
+
+def fetch(companion_id: ObjectId, query: Optional[Dict] = None) -> List[Dict]:
+    """Entries of a companion straight from Mongo, in insertion order."""
+    q = {"companion_id": companion_id}
+    if query:
+        q.update(query)
+    return list(db.db[COLLECTION].find(q, _PROJECTION).sort("position", 1))
+
+
+def load(companion_id, version, enabled_only: bool = False) -> Tuple[List[Dict], Optional[str]]:
+    """
+    (entries, fingerprint) for one lorebook version, cached per worker.
+    Entries are shallow copies — select_lorebook annotates the ones it fires.
+    enabled_only drops disabled entries in the query (companion_id, enabled,
+    strategy index); legacy entries without the field count as enabled.
+    """
+    cid = str(companion_id)
+    key = (cid, version, enabled_only)
+    cached = _entries.get(key)
+    if cached is None:
+        oid = ObjectId(cid)
+        entries = fetch(oid, {"enabled": {"$ne": False}} if enabled_only else None)
+        from lorebook_engine import lorebook_fingerprint
+        cached = (entries, lorebook_fingerprint(entries) if entries else None)
+        # 只缓存确定完整的结果：读的过程中版本变了或 replace_all 正在写，就只用这一次
+        if _is_settled(oid, version):
+            _entries.put(key, cached)
+    entries, fingerprint = cached
+    return [dict(e) for e in entries], fingerprint
+
+
+def _is_settled(companion_id: ObjectId, version) -> bool:
+    """True when version is still the companion's lorebook version and no
+    replace_all is in progress — checked after a fetch, so the fetch can't
+    have raced a write."""
+    doc = db.db[COMPANIONS].find_one({"_id": companion_id}, {"lorebook_version": 1, "lorebook_writing": 1})
+    return bool(doc) and doc.get("lorebook_version", 0) == version and not doc.get("lorebook_writing")
+
+
+def get_entry(companion_id: ObjectId, entry_id: str) -> Optional[Dict]:
+    return db.db[COLLECTION].find_one({"companion_id": companion_id, "id": entry_id}, _PROJECTION)
+
+
+def insert_entry(companion_id: ObjectId, user_id: ObjectId, position: int, entry: Dict) -> None:
+    db.db[COLLECTION].insert_one(LorebookEntryModel.create_entry_doc(companion_id, user_id, position, entry))
+
+
+def update_entry(companion_id: ObjectId, entry_id: str, set_ops: Dict) -> bool:
+    result = db.db[COLLECTION].update_one({"companion_id": companion_id, "id": entry_id}, {"$set": set_ops})
+    return result.matched_count > 0
+
+
+def delete_entry(companion_id: ObjectId, entry_id: str) -> bool:
+    return db.db[COLLECTION].delete_one({"companion_id": companion_id, "id": entry_id}).deleted_count > 0
+
+
+def begin_replace(companion_id: ObjectId, user_id: ObjectId) -> bool:
+    """Bump the version and mark a replace_all in progress. False when the
+    companion (of that user) doesn't exist."""
+    result = db.db[COMPANIONS].update_one(
+        {"_id": companion_id, "user_id": user_id},
+        {"$inc": {"lorebook_version": 1}, "$set": {"lorebook_writing": True}},
+    )
+    return result.matched_count > 0
+
+
+def replace_all(companion_id: ObjectId, user_id: ObjectId, entries: List[Dict]) -> int:
+    """Swap a companion's whole lorebook (extraction result). Returns the count.
+    The caller brackets it with version bumps: begin_replace() before, and an
+    update that increments lorebook_version and unsets lorebook_writing after."""
+    docs = _docs(companion_id, user_id, entries)
+    db.db[COLLECTION].delete_many({"companion_id": companion_id})
+    if docs:
+        db.db[COLLECTION].insert_many(docs, ordered=False)
+    return len(docs)
+
+
+def delete_all(companion_id: ObjectId) -> None:
+    db.db[COLLECTION].delete_many({"companion_id": companion_id})
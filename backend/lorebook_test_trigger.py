@@ -55,6 +55,7 @@ def main():
 
     from bson import ObjectId
     from database import db
+    from companion_service import get_lorebook
     from lorebook_engine import select_lorebook, format_lorebook_block
 
     db.connect()
@@ -76,7 +77,7 @@ def main():
             sys.exit(1)
 
     name = comp.get("name", "(unknown)")
-    entries = comp.get("lorebook_entries") or []
+    entries, _fingerprint = get_lorebook(comp)
 
     print(f"=== Companion: {name} (id={comp['_id']}) ===")
     print(f"Total entries in lorebook: {len(entries)}")
@@ -103,7 +104,7 @@ def main():
         print("  - Try adding more synonyms to the relevant entry, or rephrase the test message")
         print()
         print("Inspect entry keys with:")
-        print(f"  python3 -c \"import sys;sys.path.insert(0,'.');from database import db;db.connect();c=db.db['companions'].find_one({{'_id':__import__('bson').ObjectId('{comp['_id']}')}});[print(e.get('keys')) for e in c['lorebook_entries']]\"")
+        print(f"  python3 -c \"import sys;sys.path.insert(0,'.');from database import db;db.connect();[print(e.get('keys')) for e in db.db['lorebook_entries'].find({{'companion_id':__import__('bson').ObjectId('{comp['_id']}')}}).sort('position',1)]\"")
         sys.exit(0)
 
     print(f"✓ {len(selected)} entries fired (used {used}/{args.budget} tokens)")
@@ -0,0 +1,371 @@
+"""
+Lorebook vector index — activation for `strategy == "vectorized"` entries.
+
+Keyword entries fire when one of their keys appears in the scan window.
+Vectorized entries additionally fire when the window is *about* them: the
+entry text (title + keys + content) is embedded when the entry is written, and
+at chat time the scan window is embedded once and scored against every
+vectorized entry of the companion with a single matrix-vector product. The top
+LOREBOOK_VECTOR_TOP_K entries at or above the similarity threshold join the
+keyword candidates (same enabled / cooldown / delay / probability gates).
+
+Storage: one `lorebook_vectors` document per companion —
+    {_id: companion_id, embedder, dim, version,
+     ids: [entry_id...], hashes: [text hash...], matrix: <float32 bytes, row-major>}
+The companion document carries `lorebook_vectors_version`, so the chat path
+knows (from the cached companion) whether an index exists and which version it
+needs; the decoded matrix is kept in a per-worker LRU keyed by that version.
+
+Embedders are pluggable (LOREBOOK_EMBEDDER, or set_embedder() in scripts):
+  hashing — default. Local, deterministic feature hashing of CJK uni/bigrams
+            and latin words; no network, no model. Lexical, not semantic.
+  gemini  — gemini-embedding-001 via google-genai (GOOGLE_GEMINI_API_KEY).
+            Remote, so scan-window embeddings go through embed_cache.py.
+Changing embedder invalidates stored indexes (embedder/dim mismatch → the
+index is ignored until the lorebook is next written or re-synced).
+
+NumPy is used when installed; otherwise scoring falls back to pure Python
+(fine for the tens of vectorized entries a companion typically has).
+"""
+
+import hashlib
+import logging
+import math
+import os
+import re
+from array import array
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+    _NUMPY_OK = True
+except ImportError:
+    np = None
+    _NUMPY_OK = False
+
+from bson import ObjectId
+
+from database import db
+from local_cache import LRUCache
+
+log = logging.getLogger(__name__)
+
+COLLECTION = "lorebook_vectors"
+VECTOR_TOP_K = int(os.getenv("LOREBOOK_VECTOR_TOP_K", "3"))
+INDEX_CACHE_SIZE = 256          # decoded matrices kept per worker
+
+
+# ---------- Embedders ----------
+
+_CJK_RUN_RE = re.compile(r"[㐀-鿿豈-﫿]+")
+_WORD_RE = re.compile(r"[a-z0-9][a-z0-9'_-]*")
+
+
+@lru_cache(maxsize=65536)
+def _feature_slot(feature: str, dim: int) -> Tuple[int, float]:
+    h = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+    return h % dim, (1.0 if (h >> 63) & 1 else -1.0)
+
+
+class HashingEmbedder:
+    """Signed feature hashing over CJK unigrams + bigrams and latin words.
+
+    Deterministic across processes and machines (blake2b, not hash()), so
+    stored vectors stay valid across restarts and tests need no fixtures.
+    """
+
+    name = "hashing"
+    default_threshold = 0.2
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+
+    def _features(self, text: str) -> Dict[str, float]:
+        counts: Dict[str, float] = {}
+        low = (text or "").lower()
+        for run in _CJK_RUN_RE.findall(low):
+            for ch in run:
+                counts[ch] = counts.get(ch, 0) + 1
+            for i in range(len(run) - 1):
+                bg = run[i:i + 2]
+                counts[bg] = counts.get(bg, 0) + 1
+        for w in _WORD_RE.findall(low):
+            if len(w) > 1:
+                counts["w:" + w] = counts.get("w:" + w, 0) + 1
+        return counts
+
+    def embed(self, texts: Sequence[str]) -> List[List[float]]:
+        out = []
+        for text in texts:
+            vec = [0.0] * self.dim
+            for feature, n in self._features(text).items():
+                slot, sign = _feature_slot(feature, self.dim)
+                vec[slot] += sign * (1.0 + math.log(n))      # sublinear tf
+            out.append(_normalize(vec))
+        return out
+
+
+class GeminiEmbedder:
+    """gemini-embedding-001 through google-genai (network call per embed)."""
+
+    name = "gemini"
+    default_threshold = 0.6
+    remote = True               # query embeddings are worth caching
+
+    def __init__(self, dim: int = 768, model: str = "gemini-embedding-001"):
+        self.dim = dim
+        self.model = model
+        self._client = None
+
+    def embed(self, texts: Sequence[str]) -> List[List[float]]:
+        if self._client is None:
+            from google import genai
+            self._client = genai.Client(api_key=os.getenv("GOOGLE_GEMINI_API_KEY", ""))
+        resp = self._client.models.embed_content(
+            model=self.model,
+            contents=list(texts),
+            config={"output_dimensionality": self.dim},
+        )
+        return [_normalize(list(e.values)) for e in resp.embeddings]
+
+
+EMBEDDERS = {
+    "hashing": HashingEmbedder,
+    "gemini": GeminiEmbedder,
+}
+
+_embedder = None
+
+
+def get_embedder():
+    global _embedder
+    if _embedder is None:
+        name = os.getenv("LOREBOOK_EMBEDDER", "hashing").lower()
+        factory = EMBEDDERS.get(name)
+        if factory is None:
+            log.warning(f"[LOREBOOK_VEC] unknown LOREBOOK_EMBEDDER={name!r}, using hashing")
+            factory = HashingEmbedder
+        _embedder = factory()
+    return _embedder
+
+
+def set_embedder(embedder) -> None:
+    """Swap the process-wide embedder (scripts / tests). Needs .name, .dim, .embed()."""
+    global _embedder
+    _embedder = embedder
+    _indexes.clear()
+
+
+def vector_threshold(embedder=None) -> float:
+    env = os.getenv("LOREBOOK_VECTOR_THRESHOLD")
+    if env:
+        return float(env)
+    return (embedder or get_embedder()).default_threshold
+
+
+def _normalize(vec: List[float]) -> List[float]:
+    norm = math.sqrt(sum(x * x for x in vec))
+    if norm == 0:
+        return vec
+    return [x / norm for x in vec]
+
+
+# ---------- Index ----------
+
+def is_vectorized(entry: Dict) -> bool:
+    return (entry.get("strategy") or "").lower() == "vectorized"
+
+
+def entry_text(entry: Dict) -> str:
+    """What gets embedded for an entry."""
+    parts = [entry.get("title") or "", " ".join(k for k in (entry.get("keys") or []) if isinstance(k, str)),
+             entry.get("content") or ""]
+    return "\n".join(p for p in parts if p)
+
+
+def _text_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=8).hexdigest()
+
+
+class VectorIndex:
+    """Decoded float32 matrix (one unit-length row per vectorized entry)."""
+
+    def __init__(self, ids: List[str], dim: int, matrix: bytes, embedder=None):
+        self.ids = list(ids)
+        self.dim = dim
+        self.embedder = embedder
+        if _NUMPY_OK:
+            self._matrix = np.frombuffer(matrix, dtype=np.float32).reshape(len(self.ids), dim)
+        else:
+            flat = array("f")
+            flat.frombytes(matrix)
+            self._rows = [flat[i * dim:(i + 1) * dim] for i in range(len(self.ids))]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def row(self, i: int) -> List[float]:
+        if _NUMPY_OK:
+            return self._matrix[i].tolist()
+        return list(self._rows[i])
+
+    def scores(self, query: List[float]) -> List[float]:
+        if _NUMPY_OK:
+            return (self._matrix @ np.asarray(query, dtype=np.float32)).tolist()
+        return [sum(a * b for a, b in zip(row, query)) for row in self._rows]
+
+    def top_k(self, query: List[float], k: int, threshold: float) -> List[Tuple[str, float]]:
+        """[(entry_id, cosine)] best first, at most k, all ≥ threshold."""
+        if not self.ids or k <= 0:
+            return []
+        if _NUMPY_OK:
+            sims = self._matrix @ np.asarray(query, dtype=np.float32)
+            if k < len(sims):
+                idx = np.argpartition(-sims, k - 1)[:k]
+            else:
+                idx = np.arange(len(sims))
+            ranked = sorted(((float(sims[i]), int(i)) for i in idx), key=lambda t: (-t[0], t[1]))
+        else:
+            sims = self.scores(query)
+            ranked = sorted(((s, i) for i, s in enumerate(sims)), key=lambda t: (-t[0], t[1]))[:k]
+        return [(self.ids[i], s) for s, i in ranked if s >= threshold]
+
+    def search(self, text: str, k: int = VECTOR_TOP_K, threshold: Optional[float] = None) -> List[Tuple[str, float]]:
+        """Embed the scan window and return top_k matches."""
+        embedder = self.embedder or get_embedder()
+        if threshold is None:
+            threshold = vector_threshold(embedder)
+        if getattr(embedder, "remote", False):
+            from embed_cache import cached_embedding
+            query = cached_embedding(f"lorebook:{embedder.name}:{embedder.dim}", text,
+                                     lambda t: embedder.embed([t])[0])
+        else:
+            query = embedder.embed([text])[0]
+        return self.top_k(query, k, threshold)
+
+
+_indexes = LRUCache("lorebook_vectors", maxsize=INDEX_CACHE_SIZE)
+_NO_INDEX = object()   # 负缓存标记：该 (companion, version, embedder) 没有索引文档或 embedder 不符
+
+
+def _pack(rows: List[List[float]]) -> bytes:
+    flat = array("f")
+    for row in rows:
+        flat.extend(row)
+    return flat.tobytes()
+
+
+def build_index(entries: List[Dict], embedder=None) -> VectorIndex:
+    """In-memory index over the vectorized entries (no storage) — debug / scripts."""
+    embedder = embedder or get_embedder()
+    vec_entries = [e for e in entries if is_vectorized(e) and e.get("id")]
+    rows = embedder.embed([entry_text(e) for e in vec_entries]) if vec_entries else []
+    return VectorIndex([e["id"] for e in vec_entries], embedder.dim, _pack(rows), embedder)
+
+
+def sync_lorebook_vectors(companion_id, entries: List[Dict]) -> Optional[str]:
+    """
+    Re-index a companion's vectorized entries after a lorebook write.
+
+    Rows whose entry text is unchanged are reused, so an edit re-embeds one
+    entry. Writes the index document and stamps the companion with its version
+    (unset when nothing is vectorized). Returns the version, or None.
+    Best-effort: failures are logged, keyword matching is unaffected.
+    """
+    try:
+        oid = companion_id if isinstance(companion_id, ObjectId) else ObjectId(companion_id)
+        embedder = get_embedder()
+        vec_entries = [e for e in entries if is_vectorized(e) and e.get("id")]
+        if not vec_entries:
+            # 先摘掉 companion 上的版本再删文档 —— 持有旧版本的读者不会读到"文档缺失"
+            # 并把它负缓存（同样的条目再向量化会得到同一个版本 key）
+            db.db["companions"].update_one({"_id": oid}, {"$unset": {"lorebook_vectors_version": ""}})
+            db.db[COLLECTION].delete_one({"_id": oid})
+            return None
+
+        old = db.db[COLLECTION].find_one({"_id": oid}) or {}
+        reusable: Dict[str, List[float]] = {}
+        if old.get("embedder") == embedder.name and old.get("dim") == embedder.dim and old.get("matrix"):
+            prev = VectorIndex(old.get("ids") or [], embedder.dim, bytes(old["matrix"]))
+            for i, h in enumerate(old.get("hashes") or []):
+                reusable[h] = prev.row(i)
+
+        texts = [entry_text(e) for e in vec_entries]
+        hashes = [_text_hash(t) for t in texts]
+        missing = [i for i, h in enumerate(hashes) if h not in reusable]
+        if missing:
+            for i, vec in zip(missing, embedder.embed([texts[i] for i in missing])):
+                reusable[hashes[i]] = vec
+        rows = [reusable[h] for h in hashes]
+
+        ids = [e["id"] for e in vec_entries]
+        version = hashlib.blake2b(
+            f"{embedder.name}:{embedder.dim}:{','.join(ids)}:{','.join(hashes)}".encode("utf-8"),
+            digest_size=8,
+        ).hexdigest()
+        db.db[COLLECTION].replace_one(
+            {"_id": oid},
+            {
+                "_id": oid,
+                "embedder": embedder.name,
+                "dim": embedder.dim,
+                "version": version,
+                "ids": ids,
+                "hashes": hashes,
+                "matrix": _pack(rows),
+                "updated_at": datetime.utcnow(),
+            },
+            upsert=True,
+        )
+        db.db["companions"].update_one({"_id": oid}, {"$set": {"lorebook_vectors_version": version}})
+        log.info(f"[LOREBOOK_VEC] companion {oid}: {len(ids)} vectorized entries, {len(missing)} embedded")
+        return version
+    except Exception as e:
+        log.warning(f"[LOREBOOK_VEC] sync failed for companion {companion_id}: {e}")
+        return None
+
+
+def delete_lorebook_vectors(companion_id) -> None:
+    try:
+        oid = companion_id if isinstance(companion_id, ObjectId) else ObjectId(companion_id)
+        db.db[COLLECTION].delete_one({"_id": oid})
+    except Exception as e:
+        log.warning(f"[LOREBOOK_VEC] delete failed for companion {companion_id}: {e}")
+
+
+def load_index(companion: Dict) -> Optional[VectorIndex]:
+    """Vector index for a (cached) companion doc, or None if it has none."""
+    version = companion.get("lorebook_vectors_version")
+    if not version:
+        return None
+    cid = str(companion.get("_id"))
+    embedder = get_embedder()
+    key = (cid, version, embedder.name)
+    index = _indexes.get(key)
+    if index is _NO_INDEX:
+        return None
+    if index is not None:
+        return index
+    try:
+        doc = db.db[COLLECTION].find_one({"_id": ObjectId(cid)})
+    except Exception as e:
+        log.warning(f"[LOREBOOK_VEC] load failed for companion {cid}: {e}")
+        return None
+    # 文档缺失 / embedder 不符按 key 缓存成 _NO_INDEX，省掉每轮的 find_one（和 info 日志）。
+    # 版本不符不缓存：版本是内容哈希，改了又改回去会让旧 key 重新生效，
+    # 那时缓存的负结果会一直挡住向量匹配直到被 LRU 淘汰
+    if not doc:
+        _indexes.put(key, _NO_INDEX)
+        return None
+    if doc.get("version") != version:
+        return None
+    if doc.get("embedder") != embedder.name or doc.get("dim") != embedder.dim:
+        log.info(f"[LOREBOOK_VEC] companion {cid}: index built with {doc.get('embedder')}, "
+                 f"current embedder {embedder.name} — skipped until re-synced")
+        _indexes.put(key, _NO_INDEX)
+        return None
+    index = VectorIndex(doc.get("ids") or [], embedder.dim, bytes(doc["matrix"]), embedder)
+    _indexes.put(key, index)
+    return index
@@ -6,16 +6,25 @@ SoulLink Mem0 Memory Engine — 语义记忆系统
   - 语义搜索：每条消息只注入相关记忆（top-K），不全量注入
   - 自动去重：Mem0 内置 embedding 相似度去重
   - TTL 过期：通过 metadata 标记 + 定期清理实现
+  - 永久记忆快照：get_permanent_memories 按用户记忆版本号缓存（见下方"快照缓存"），
+    快照附带各层计数 —— tier_counts() 让永久配额检查 O(1)
+  - 批量提取：process_memory_batch 把同一用户连续几轮合成一次 m.add()（chat_jobs 按
+    MEMORY_DEBOUNCE_SECONDS 收集）
 """
 
 import os
 import re
 import json
+import time
 import logging
+import threading
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Sequence, Tuple
 from bson import ObjectId
 
+from local_cache import LRUCache
+from redis_client import _NoOpClient, get_client, safe_delete, safe_setex
+
 logger = logging.getLogger(__name__)
 
 # ==================== 配置 ====================
@@ -25,6 +34,11 @@ MAX_SEARCH_RESULTS = 8       # 语义搜索 top-K
 SHORT_TERM_DAYS = 14
 LONG_TERM_DAYS = 90
 
+SNAPSHOT_CACHE_SIZE = 2048                   # users whose permanent set is kept per worker
+SNAPSHOT_TTL_SECONDS = 3600                  # Redis copy; versions are the real invalidation
+SNAPSHOT_FALLBACK_TTL_SECONDS = int(os.getenv("MEMORY_SNAPSHOT_FALLBACK_TTL_SECONDS", "30"))
+MEMORY_VERSION_TTL_SECONDS = 7 * 24 * 3600   # must outlive any snapshot
+
 # ==================== Mem0 初始化 ====================
 
 _mem0_client = None
@@ -72,6 +86,11 @@ def _get_mem0():
     }
 
     _mem0_client = Memory.from_config(config)
+    # 查询 embedding 缓存：重复 / 近似重复的消息不再调用 Gemini embedding（embed_cache.py）
+    from embed_cache import CachedMem0Embedder
+    _mem0_client.embedding_model = CachedMem0Embedder(
+        _mem0_client.embedding_model, "mem0:gemini-embedding-001:768",
+    )
     logger.info(f"[MEM0] Initialized — Qdrant path: {qdrant_path}")
     return _mem0_client
 
@@ -228,28 +247,173 @@ def _calculate_expiry(tier: str) -> Optional[str]:
     return None
 
 
+# ==================== 快照缓存（永久记忆） ====================
+# 永久记忆每轮都注入，但很少变化；get_all 要扫该用户全部记忆。快照按用户记忆版本号
+# 缓存：`mem_ver:{uid}` 由 bump_memory_version() 自增 —— process_memory /
+# cleanup_expired_memories / 记忆 CRUD 路由写入后必须调用。
+#   1. 进程内 LRU：(version, permanent, tiers, build_ms, cached_at)，命中只需一次 Redis GET
+#   2. Redis `mem_snap:{uid}`：JSON 快照，跨 worker 共享
+# tiers 是同一次 get_all 扫描得到的各层记忆条数（常驻的每用户计数器），配额检查读它即可。
+# 读到的版本号与快照不一致即失效，所以与写入竞争的读不会把旧快照放回去。
+# process_memory 写完后若版本号恰好 +1（期间无其他写入），直接把新快照写到新版本下，
+# 下一轮聊天仍命中。Redis 不可用时读不到版本号，快照只在 SNAPSHOT_FALLBACK_TTL_SECONDS
+# 内有效，配额检查改为现扫。
+
+VERSION_KEY = "mem_ver:{user_id}"
+SNAPSHOT_KEY = "mem_snap:{user_id}"
+
+_snapshots = LRUCache("memory_snapshots", maxsize=SNAPSHOT_CACHE_SIZE)
+_snap_lock = threading.Lock()
+_snap_stats = {"hits": 0, "misses": 0, "redis_hits": 0, "invalidations": 0, "write_through": 0, "saved_ms": 0.0}
+_UNREAD = object()
+
+
+def _snap_count(field: str, amount: float = 1) -> None:
+    with _snap_lock:
+        _snap_stats[field] += amount
+
+
+def _memory_version(user_id: str):
+    """Current version string ("0" if never bumped), or None when Redis is unavailable."""
+    try:
+        client = get_client()
+        # 不再先 PING：no-op 客户端直接判不可用，真实客户端 GET 失败会抛异常
+        if isinstance(client, _NoOpClient):
+            return None
+        return client.get(VERSION_KEY.format(user_id=user_id)) or "0"
+    except Exception:
+        return None
+
+
+def bump_memory_version(user_id) -> Optional[str]:
+    """Call after every write to a user's Mem0 memories. Returns the new
+    version, or None when Redis is unavailable."""
+    uid = str(user_id)
+    _snapshots.pop(uid)
+    _snap_count("invalidations")
+    key = VERSION_KEY.format(user_id=uid)
+    version = None
+    try:
+        client = get_client()
+        version = client.incr(key)
+        client.expire(key, MEMORY_VERSION_TTL_SECONDS)
+    except Exception as e:
+        logger.debug(f"[MEM0] bump version({uid}) failed: {e}")
+    safe_delete(SNAPSHOT_KEY.format(user_id=uid))
+    return str(version) if version is not None else None
+
+
+def _fresh_snapshot(snap, version) -> bool:
+    snap_version, _, _, _, cached_at = snap
+    if version is None:
+        return time.monotonic() - cached_at < SNAPSHOT_FALLBACK_TTL_SECONDS
+    return snap_version == version
+
+
+def memory_cache_stats() -> dict:
+    """Process-local counters since startup (admin stats)."""
+    with _snap_lock:
+        stats = dict(_snap_stats)
+    reads = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / reads, 3) if reads else None
+    stats["saved_ms"] = round(stats["saved_ms"], 1)
+    return stats
+
+
 # ==================== 核心 API ====================
 
-def get_permanent_memories(user_id: str) -> List[Dict]:
-    """获取所有永久记忆（始终注入 prompt）"""
+def get_permanent_memories(user_id: str, use_cache: bool = True) -> List[Dict]:
+    """获取所有永久记忆（始终注入 prompt）。默认走快照缓存；use_cache=False 直接扫 Mem0。"""
+    snap = _snapshot(str(user_id), use_cache=use_cache)
+    return [dict(p) for p in snap[1]] if snap else []
+
+
+def tier_counts(user_id: str) -> Dict[str, int]:
+    """各层记忆条数（配额检查用）— 版本号可用时取快照计数，O(1)；Redis 不可用时现扫，保证精确。"""
+    uid = str(user_id)
+    version = _memory_version(uid)
+    snap = _snapshot(uid, use_cache=version is not None, version=version)
+    return dict(snap[2]) if snap else {}
+
+
+def _snapshot(uid: str, use_cache: bool = True, version=_UNREAD) -> Optional[Tuple[Optional[str], List[Dict], Dict[str, int]]]:
+    """(version, permanent, tiers) for a user, or None if Mem0 could not be read.
+    The version is read before loading, so a fresh load is always cached under
+    a version no newer than its contents."""
+    if version is _UNREAD:
+        version = _memory_version(uid)
+
+    if use_cache:
+        snap = _snapshots.get(uid)
+        if snap is not None and _fresh_snapshot(snap, version):
+            _snap_count("hits")
+            _snap_count("saved_ms", snap[3])
+            return snap[0], snap[1], snap[2]
+
+        if version is not None:
+            try:
+                raw = get_client().get(SNAPSHOT_KEY.format(user_id=uid))
+                cached = json.loads(raw) if raw else {}
+                # snapshots written before tier counts existed lack "tiers" → rebuild
+                if cached.get("version") == version and "tiers" in cached:
+                    snap = (version, cached.get("permanent") or [], cached["tiers"],
+                            float(cached.get("build_ms") or 0), time.monotonic())
+                    _snapshots.put(uid, snap)
+                    _snap_count("hits")
+                    _snap_count("redis_hits")
+                    _snap_count("saved_ms", snap[3])
+                    return snap[0], snap[1], snap[2]
+            except Exception as e:
+                logger.debug(f"[MEM0] snapshot read({uid}) failed: {e}")
+        _snap_count("misses")
+
+    start = time.perf_counter()
+    loaded = _load_snapshot(uid)
+    build_ms = (time.perf_counter() - start) * 1000.0
+    if loaded is None:
+        return None
+    permanent, tiers = loaded
+    _store_snapshot(uid, version, permanent, tiers, build_ms)
+    return version, permanent, tiers
+
+
+def _store_snapshot(uid: str, version, permanent: List[Dict], tiers: Dict[str, int], build_ms: float) -> None:
+    _snapshots.put(uid, (version, permanent, tiers, build_ms, time.monotonic()))
+    if version is not None:
+        safe_setex(
+            SNAPSHOT_KEY.format(user_id=uid), SNAPSHOT_TTL_SECONDS,
+            json.dumps({"version": version, "permanent": permanent, "tiers": tiers,
+                        "build_ms": round(build_ms, 1)}),
+        )
+
+
+def _load_snapshot(user_id: str) -> Optional[Tuple[List[Dict], Dict[str, int]]]:
+    """Permanent memories + per-tier counts straight from Mem0 (one get_all scan);
+    None on error (not cached)."""
     m = _get_mem0()
     try:
         all_mems = m.get_all(user_id=user_id)
         # Mem0 返回格式可能是 list 或 dict with "results" key
         items = all_mems if isinstance(all_mems, list) else all_mems.get("results", [])
         permanent = []
+        tiers: Dict[str, int] = {}
         for r in items:
-            meta = r.get("metadata", {})
-            if meta.get("tier") == "permanent":
+            meta = r.get("metadata") or {}
+            tier = meta.get("tier")
+            if tier:
+                tiers[tier] = tiers.get(tier, 0) + 1
+            if tier == "permanent":
                 permanent.append({
                     "fact": r.get("memory", ""),
                     "tier": "permanent",
                     "id": r.get("id"),
                 })
-        return permanent
+        # 按 id 排序：写穿的快照与重新扫描的结果顺序一致（prompt 不因此抖动）
+        permanent.sort(key=lambda p: str(p.get("id") or ""))
+        return permanent, tiers
     except Exception as e:
         logger.error(f"[MEM0] get_permanent error: {e}")
-        return []
+        return None
 
 
 def search_relevant_memories(user_id: str, query: str, limit: int = MAX_SEARCH_RESULTS) -> List[Dict]:
@@ -307,13 +471,38 @@ def build_memory_text(permanent: List[Dict], relevant: List[Dict]) -> str:
     return header + "\n".join(sections)
 
 
+def build_memory_prefix(permanent: List[Dict], relevant: List[Dict]) -> str:
+    """
+    prompt overlay 模式：记忆块作为消息前缀随本轮请求下发，而不是写回
+    workspace system prompt。格式和 [Character knowledge] 块一致，带结尾空行。
+    """
+    sections = []
+    if permanent:
+        sections.append("[Core — always remember]")
+        sections.extend(f"- {m['fact']}" for m in permanent)
+    if relevant:
+        sections.append("[Important — remember for now]")
+        sections.extend(f"- {m['fact']}" for m in relevant)
+    if not sections:
+        return ""
+    lines = ["[Memories about the user — use naturally, core facts are most important]"]
+    lines.extend(sections)
+    lines.append("[End of memories]")
+    return "\n".join(lines) + "\n\n"
+
+
 # ==================== 记忆提取（后台异步调用） ====================
 
 def process_memory(user_id: ObjectId, user_msg: str, ai_reply: str) -> Dict:
+    """单轮入口 — 见 process_memory_batch"""
+    return process_memory_batch(user_id, [(user_msg, ai_reply)])
+
+
+def process_memory_batch(user_id: ObjectId, turns: Sequence[Tuple[str, str]], raise_errors: bool = False) -> Dict:
     """
-    主入口 — 在后台线程中运行。
-    1. 预过滤 trivial 消息
-    2. Mem0 add() 自动提取 + 去重
+    主入口 — 在后台任务中运行，turns 为同一用户连续几轮 (user_msg, ai_reply)。
+    1. 预过滤 trivial 消息（全部 trivial 则跳过）
+    2. Mem0 add() 一次提取整批 + 去重
     3. 后置垃圾过滤
     4. 分类打标 + 设 TTL
 
@@ -324,24 +513,31 @@ def process_memory(user_id: ObjectId, user_msg: str, ai_reply: str) -> Dict:
         "skipped": bool,                        # True if input was filtered
         "skip_reason": str | None,
       }
+
+    raise_errors=True（job_queue 任务）：m.add() 本身失败（Gemini / Qdrant 出错，
+    尚未写入任何东西）时抛出，由队列退避重试；写入之后的失败只记日志 —— 重试会重复 add。
     """
     receipt: Dict = {"added": [], "updated": [], "skipped": False, "skip_reason": None}
 
-    if _should_skip_extraction(user_msg):
-        logger.debug(f"[MEM0] Skipped trivial: '{user_msg[:50]}'")
+    turns = [(u, a) for u, a in turns if not _should_skip_extraction(u)]
+    if not turns:
+        logger.debug(f"[MEM0] Skipped trivial batch for user {user_id}")
         receipt["skipped"] = True
         receipt["skip_reason"] = "trivial"
         return receipt
 
     uid_str = str(user_id)
     m = _get_mem0()
+    wrote = False
+    after = None    # (base version, permanent, tiers) once tier metadata is written
 
     try:
-        messages = [
-            {"role": "user", "content": user_msg},
-            {"role": "assistant", "content": ai_reply},
-        ]
+        messages = []
+        for user_msg, ai_reply in turns:
+            messages.append({"role": "user", "content": user_msg})
+            messages.append({"role": "assistant", "content": ai_reply})
         result = m.add(messages=messages, user_id=uid_str, metadata={"source": "chat"})
+        wrote = bool(result)
 
         # 处理结果：后置过滤 + 分类
         if not result:
@@ -388,37 +584,95 @@ def process_memory(user_id: ObjectId, user_msg: str, ai_reply: str) -> Dict:
             tier_source = "llm"
 
         # Pass 3: enforce permanent quota, write metadata, build receipt.
-        for p, tier in zip(pending_adds, tiers):
-            mem_text, mem_id = p["text"], p["id"]
-
-            if tier == "permanent":
-                existing_perm = get_permanent_memories(uid_str)
-                if len(existing_perm) >= MAX_PERMANENT:
+        # The permanent count comes from the tier counter once per call and is
+        # tracked locally; mem0's own UPDATE/DELETE events are not covered by any
+        # version bump yet, so they force a rescan instead.
+        if pending_adds:
+            touched = any(e.get("event") in ("UPDATE", "DELETE") for e in events)
+            version = _memory_version(uid_str)
+            base = _snapshot(uid_str, use_cache=version is not None and not touched, version=version)
+            tier_count = dict(base[2]) if base else {}
+            permanent = list(base[1]) if base else []
+
+            updates: List[Dict] = []
+            for p, tier in zip(pending_adds, tiers):
+                mem_text, mem_id = p["text"], p["id"]
+                if tier == "permanent" and tier_count.get("permanent", 0) >= MAX_PERMANENT:
                     tier = "long_term"
                     logger.warning(f"[MEM0] Permanent full ({MAX_PERMANENT}), downgraded to long_term: '{mem_text}'")
-
-            expires_at = _calculate_expiry(tier)
-
-            try:
-                m.update(mem_id, data=mem_text, metadata={
+                tier_count[tier] = tier_count.get(tier, 0) + 1
+                if tier == "permanent":
+                    permanent.append({"fact": mem_text, "tier": "permanent", "id": mem_id})
+                updates.append({"id": mem_id, "text": mem_text, "metadata": {
                     "tier": tier,
-                    "expires_at": expires_at,
+                    "expires_at": _calculate_expiry(tier),
                     "source": "chat",
-                })
-            except Exception as e:
-                logger.warning(f"[MEM0] Failed to update metadata for '{mem_text}': {e}")
+                }})
 
-            receipt["added"].append({"id": mem_id, "fact": mem_text, "tier": tier})
-            logger.info(f"[MEM0] Added [{tier}/{tier_source}]: '{mem_text}'")
+            if _write_tier_metadata(m, updates) and base and base[0] is not None:
+                permanent.sort(key=lambda p: str(p.get("id") or ""))
+                after = (base[0], permanent, tier_count)
+
+            for u in updates:
+                tier = u["metadata"]["tier"]
+                receipt["added"].append({"id": u["id"], "fact": u["text"], "tier": tier})
+                logger.info(f"[MEM0] Added [{tier}/{tier_source}]: '{u['text']}'")
 
     except Exception as e:
         logger.error(f"[MEM0] process_memory error: {e}")
+        if raise_errors and not wrote:
+            raise
         import traceback
         traceback.print_exc()
+    finally:
+        if wrote:
+            version = bump_memory_version(uid_str)
+            # 写穿：版本号恰好 +1 说明期间没有其他写入，新快照即为当前状态
+            if after and version is not None and version == str(int(after[0]) + 1):
+                _store_snapshot(uid_str, version, after[1], after[2], 0.0)
+                _snap_count("write_through")
 
     return receipt
 
 
+def _write_tier_metadata(m, updates: List[Dict]) -> bool:
+    """
+    Write tier metadata of freshly added memories ([{"id", "text", "metadata"}]).
+    Mem0 keeps metadata as flat Qdrant payload fields, so one batch request of
+    set-payload operations (one per distinct metadata) does it without m.update's
+    per-memory re-embed + upsert + history row. Falls back to m.update per memory
+    if the vector store doesn't expose a Qdrant client. True if every write succeeded.
+    """
+    if not updates:
+        return True
+    try:
+        from qdrant_client import models as qmodels
+        store = m.vector_store
+        groups: Dict[str, Tuple[Dict, List]] = {}
+        for u in updates:
+            key = json.dumps(u["metadata"], sort_keys=True)
+            groups.setdefault(key, (u["metadata"], []))[1].append(u["id"])
+        store.client.batch_update_points(
+            collection_name=store.collection_name,
+            update_operations=[
+                qmodels.SetPayloadOperation(set_payload=qmodels.SetPayload(payload=meta, points=ids))
+                for meta, ids in groups.values()
+            ],
+        )
+        return True
+    except Exception as e:
+        logger.debug(f"[MEM0] batch metadata write unavailable ({e}), updating one by one")
+
+    ok = True
+    for u in updates:
+        try:
+            m.update(u["id"], data=u["text"], metadata=u["metadata"])
+        except Exception as e:
+            ok = False
+            logger.warning(f"[MEM0] Failed to update metadata for '{u['text']}': {e}")
+    return ok
+
+
 def cleanup_expired_memories(user_id: str):
     """清理已过期的记忆。概率性调用（~5% 的消息触发）。"""
     m = _get_mem0()
@@ -442,6 +696,7 @@ def cleanup_expired_memories(user_id: str):
                 continue
 
         if cleaned:
+            bump_memory_version(user_id)
             logger.info(f"[MEM0] Cleaned {cleaned} expired memories for user {user_id}")
     except Exception as e:
         logger.error(f"[MEM0] cleanup error: {e}")
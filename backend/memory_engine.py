@@ -6,6 +6,10 @@ SoulLink Memory Engine — 三层记忆系统
   permanent (≤10) — 身份/家人/宠物/职业等，永不自动删除
   long_term (≤15) — 重要经历/偏好/习惯，90 天淡化
   short_term (≤5)  — 近期事件/临时情绪，14 天过期
+
+批量提取：process_memory_batch 对同一用户连续几轮对话只调一次 Gemini（chat_jobs 按
+MEMORY_DEBOUNCE_SECONDS 收集）；写回 MongoDB 用定向的 $pull / $set / $push，
+不再整体 $set memory 子文档（见 memory_update_ops）。
 """
 
 import os
@@ -13,7 +17,7 @@ import re
 import json
 import logging
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Sequence, Tuple
 from bson import ObjectId
 
 logger = logging.getLogger(__name__)
@@ -25,12 +29,12 @@ MAX_LONG_TERM = 15
 MAX_SHORT_TERM = 5
 SHORT_TERM_DAYS = 14
 LONG_TERM_DAYS = 90
-SYNC_EVERY_N = 5  # 每 N 次提取同步一次 system prompt
+SYNC_EVERY_N = 5  # 每 N 轮提取同步一次 system prompt
+LAYERS = ("permanent", "long_term", "short_term")
 
 EXTRACTION_PROMPT = """You are a STRICT memory extraction assistant for an AI companion app. Your job is to decide what's worth remembering about the user. Memory slots are LIMITED and precious — only store facts that will be useful in FUTURE conversations.
 
-User message: {user_msg}
-AI reply: {ai_reply}
+{conversation}
 
 Existing memories:
 {existing_summary}
@@ -187,17 +191,32 @@ def _call_gemini(prompt: str) -> Optional[str]:
 
 # ==================== 记忆提取 ====================
 
+def _format_turns(turns: Sequence[Tuple[str, str]]) -> str:
+    """对话部分；单轮时与原 prompt 完全一致"""
+    if len(turns) == 1:
+        user_msg, ai_reply = turns[0]
+        return f"User message: {user_msg}\nAI reply: {ai_reply}"
+    return "\n\n".join(
+        f"User message {i}: {user_msg}\nAI reply {i}: {ai_reply}"
+        for i, (user_msg, ai_reply) in enumerate(turns, 1)
+    )
+
+
 def extract_memories(user_msg: str, ai_reply: str, existing_memory: Dict) -> Optional[Dict]:
     """
     从一轮对话中提取新记忆和更新。
     返回 {"new_memories": [...], "updates": [...]} 或 None（提取失败）
     """
+    return extract_memories_batch([(user_msg, ai_reply)], existing_memory)
+
+
+def extract_memories_batch(turns: Sequence[Tuple[str, str]], existing_memory: Dict) -> Optional[Dict]:
+    """从连续几轮对话（旧 → 新）中一次性提取新记忆和更新，返回格式同 extract_memories"""
     # 构建已有记忆摘要给 LLM 参考（避免重复提取）
     existing_summary = _summarize_existing(existing_memory)
 
     prompt = EXTRACTION_PROMPT.format(
-        user_msg=user_msg,
-        ai_reply=ai_reply,
+        conversation=_format_turns(turns),
         existing_summary=existing_summary or "(none yet)"
     )
 
@@ -362,6 +381,67 @@ def cleanup_expired(memory: Dict) -> Dict:
     return memory
 
 
+# ==================== 定向写回（$pull / $set / $push） ====================
+
+def snapshot_memory(memory: Dict) -> Dict[str, List[Tuple[Dict, str]]]:
+    """cleanup_expired / merge_memories 之前调用：记下每层的条目对象及其原 fact"""
+    return {layer: [(item, item.get("fact", "")) for item in memory.get(layer, [])] for layer in LAYERS}
+
+
+def _item_match(item: Dict, fact: str) -> Dict:
+    match = {"fact": fact}
+    if item.get("created_at") is not None:
+        match["created_at"] = item["created_at"]
+    return match
+
+
+def memory_update_ops(before: Dict[str, List[Tuple[Dict, str]]], memory: Dict,
+                      extraction_delta: int = 1) -> List[Tuple[Dict, Optional[List[Dict]]]]:
+    """
+    把 cleanup_expired + merge_memories 对 memory 的修改转成定向更新
+    [(update, array_filters)]，按顺序对 users 文档执行：
+      1. $pull 过期 / 被淘汰的条目（按原 fact + created_at 匹配）
+      2. $set 被更新条目的 fact / updated_at（arrayFilters 按原 fact 定位）
+      3. $push 新条目 + $inc extraction_count
+    同一数组的 $pull 和 $push 不能放在一个 update 里，所以分三步。
+    """
+    pulls: Dict[str, Dict] = {}
+    sets: Dict = {}
+    filters: List[Dict] = []
+    pushes: Dict[str, Dict] = {}
+    for layer in LAYERS:
+        before_items = before.get(layer, [])
+        after_items = memory.get(layer, [])
+        after_ids = {id(item) for item in after_items}
+        before_ids = {id(item) for item, _ in before_items}
+
+        removed = [_item_match(item, fact) for item, fact in before_items if id(item) not in after_ids]
+        if removed:
+            pulls[f"memory.{layer}"] = removed[0] if len(removed) == 1 else {"$or": removed}
+
+        for item, fact in before_items:
+            if id(item) in after_ids and item.get("fact") != fact:
+                name = f"u{len(filters)}"
+                sets[f"memory.{layer}.$[{name}].fact"] = item["fact"]
+                sets[f"memory.{layer}.$[{name}].updated_at"] = item.get("updated_at")
+                filters.append({f"{name}.fact": fact})
+
+        added = [item for item in after_items if id(item) not in before_ids]
+        if added:
+            pushes[f"memory.{layer}"] = {"$each": added}
+
+    ops: List[Tuple[Dict, Optional[List[Dict]]]] = []
+    if pulls:
+        ops.append(({"$pull": pulls}, None))
+    if sets:
+        ops.append(({"$set": sets}, filters))
+    last: Dict = {"$inc": {"memory.extraction_count": extraction_delta}}
+    if pushes:
+        last["$push"] = pushes
+    ops.append((last, None))
+    return ops
+
+
 # ==================== 记忆文本生成（注入 prompt） ====================
 
 def build_memory_text(memory: Dict) -> str:
@@ -400,78 +480,83 @@ def build_memory_text(memory: Dict) -> str:
 # ==================== 主入口 ====================
 
 def process_memory(user_id: ObjectId, user_msg: str, ai_reply: str):
+    """单轮入口 — 见 process_memory_batch"""
+    process_memory_batch(user_id, [(user_msg, ai_reply)])
+
+
+def process_memory_batch(user_id: ObjectId, turns: Sequence[Tuple[str, str]], raise_errors: bool = False):
     """
-    完整记忆处理流程（在后台线程中运行）：
-    0. 预过滤：跳过打招呼/告别等无意义消息
+    完整记忆处理流程（在后台任务中运行），turns 为同一用户连续几轮 (user_msg, ai_reply)：
+    0. 预过滤：跳过打招呼/告别等无意义消息；全部 trivial 则不调 Gemini
     1. 从 MongoDB 读取已有记忆
     2. 清理过期记忆
-    3. 调 Gemini 提取新记忆
+    3. 调 Gemini 一次提取整批新记忆
     4. 合并到已有记忆
-    5. 存回 MongoDB
+    5. 定向写回 MongoDB（memory_update_ops）
     6. 按频率同步 system prompt
+
+    提取失败（Gemini 出错 / 返回无法解析）时不写回任何东西、不计轮数；
+    raise_errors=True（job_queue 任务）时抛出，由队列退避重试。
     """
     from database import db
+    from user_cache import get_user, invalidate_user
 
     # 0. 预过滤 — 短消息/打招呼/告别直接跳过，省 Gemini API 调用
-    if _should_skip_extraction(user_msg):
-        logger.debug(f"[MEMORY] Skipped trivial message: '{user_msg[:50]}'")
+    turns = [(u, a) for u, a in turns if not _should_skip_extraction(u)]
+    if not turns:
+        logger.debug(f"[MEMORY] Skipped trivial batch for user {user_id}")
         return
 
     try:
         # 1. 读取用户及已有记忆
-        user = db.db["users"].find_one({"_id": user_id})
+        user = get_user(user_id)
         if not user:
             logger.warning(f"[MEMORY] User {user_id} not found")
             return
 
-        memory = user.get("memory", {
-            "permanent": [],
-            "long_term": [],
-            "short_term": [],
-            "extraction_count": 0,
-            "last_prompt_sync": None
-        })
+        memory = user.get("memory") or {}
+        for layer in LAYERS:
+            memory.setdefault(layer, [])
+        before = snapshot_memory(memory)
 
         # 2. 清理过期
         memory = cleanup_expired(memory)
 
-        # 3. 提取新记忆
-        extracted = extract_memories(user_msg, ai_reply, memory)
-        if not extracted:
-            # 提取失败或无结果，仍然更新 count
-            memory["extraction_count"] = memory.get("extraction_count", 0) + 1
-            db.db["users"].update_one(
-                {"_id": user_id},
-                {"$set": {"memory": memory}}
-            )
-            return
+        # 3. 提取新记忆（无结果时仍写回清理结果并更新 count；失败则整批不写）
+        extracted = extract_memories_batch(turns, memory)
+        if extracted is None:
+            raise RuntimeError(f"extraction failed for {len(turns)} turn(s)")
 
         # 4. 合并
-        memory, has_changes = merge_memories(memory, extracted)
-
-        # 5. 更新计数并存储
-        memory["extraction_count"] = memory.get("extraction_count", 0) + 1
-        count = memory["extraction_count"]
-
-        db.db["users"].update_one(
-            {"_id": user_id},
-            {"$set": {"memory": memory}}
-        )
-
-        # 6. 按频率同步 system prompt（有变化 且 每 N 次）
-        if has_changes and count % SYNC_EVERY_N == 0:
+        has_changes = False
+        if extracted:
+            memory, has_changes = merge_memories(memory, extracted)
+
+        # 5. 更新计数并存储 — count 按轮数累加，prompt 同步节奏与逐轮提取一致
+        prev_count = memory.get("extraction_count", 0)
+        count = prev_count + len(turns)
+        memory["extraction_count"] = count
+        for update, array_filters in memory_update_ops(before, memory, len(turns)):
+            db.db["users"].update_one({"_id": user_id}, update, array_filters=array_filters)
+        invalidate_user(user_id)
+
+        # 6. 按频率同步 system prompt（有变化 且 每 N 轮）
+        if has_changes and count // SYNC_EVERY_N > prev_count // SYNC_EVERY_N:
             _sync_prompt(user_id, user)
             memory["last_prompt_sync"] = datetime.utcnow()
             db.db["users"].update_one(
                 {"_id": user_id},
                 {"$set": {"memory.last_prompt_sync": memory["last_prompt_sync"]}}
             )
+            invalidate_user(user_id)
             logger.info(f"[MEMORY] Synced prompt for user {user.get('name', '?')} (count={count})")
         elif has_changes:
             logger.info(f"[MEMORY] Changes saved but prompt sync deferred (count={count}, next sync at {count + (SYNC_EVERY_N - count % SYNC_EVERY_N)})")
 
     except Exception as e:
         logger.error(f"[MEMORY] process_memory error: {e}")
+        if raise_errors:
+            raise
         import traceback
         traceback.print_exc()
 
@@ -482,7 +567,9 @@ def _sync_prompt(user_id: ObjectId, user: Dict):
         from workspace_manager import WorkspaceManager
         wm = WorkspaceManager()
         result = wm.update_system_prompt(user_id, user["name"])
-        if result.get("success"):
+        if result.get("skipped"):
+            logger.info(f"[MEMORY] Prompt unchanged (fingerprint hit), sync skipped")
+        elif result.get("success"):
             logger.info(f"[MEMORY] Prompt synced successfully")
         else:
             logger.warning(f"[MEMORY] Prompt sync failed: {result.get('error')}")
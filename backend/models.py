@@ -72,13 +72,16 @@ class ConversationModel:
         return {
             "user_id": user_id,
             "title": title or "新对话",
-            "messages": [],
+            "message_store": "collection",  # 消息存在 messages 集合；旧文档为内嵌 messages 数组
             "created_at": datetime.utcnow(),
             "updated_at": datetime.utcnow(),
             "is_active": True,
             "metadata": {
                 "total_messages": 0,
-                "last_message_at": None
+                "message_seq": 0,           # 最后一条消息的 seq
+                "message_bytes": 0,         # 消息 BSON 总大小（tail 读取统计省下的字节）
+                "last_message_at": None,
+                "last_message_preview": ""
             }
         }
 
@@ -124,6 +127,66 @@ class ConversationModel:
         ]
 
 
+class MessageModel:
+    """对话消息 — 每条一个文档，按 (conversation_id, seq) 顺序存取"""
+
+    collection_name = "messages"
+
+    @staticmethod
+    def create_message_doc(
+        conversation_id: ObjectId,
+        user_id: ObjectId,
+        seq: int,
+        message: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """把 ConversationModel.create_message 的消息对象包装成集合文档"""
+        doc = dict(message)
+        doc.update({
+            "conversation_id": conversation_id,
+            "user_id": user_id,
+            "seq": seq,  # 对话内从 1 递增
+        })
+        return doc
+
+    @staticmethod
+    def get_indexes() -> List[Dict]:
+        """返回需要创建的索引"""
+        return [
+            {"keys": [("conversation_id", 1), ("seq", 1)], "unique": True},
+        ]
+
+
+class LorebookEntryModel:
+    """Lorebook 条目 — 每条一个文档，按 (companion_id, position) 排序；条目字段同 companion_service._new_lorebook_entry"""
+
+    collection_name = "lorebook_entries"
+
+    @staticmethod
+    def create_entry_doc(
+        companion_id: ObjectId,
+        user_id: ObjectId,
+        position: int,
+        entry: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """把条目 dict 包装成集合文档（`id` 仍是条目对外的 uuid）"""
+        doc = dict(entry)
+        doc.update({
+            "companion_id": companion_id,
+            "user_id": user_id,
+            "position": position,  # 伴侣内插入顺序，编译索引按它定位条目
+        })
+        return doc
+
+    @staticmethod
+    def get_indexes() -> List[Dict]:
+        """返回需要创建的索引"""
+        return [
+            {"keys": [("companion_id", 1), ("enabled", 1), ("strategy", 1)]},
+            {"keys": [("companion_id", 1), ("position", 1)]},
+            {"keys": [("companion_id", 1), ("id", 1)], "unique": True},
+        ]
+
+
 class RefreshTokenModel:
     """Refresh Token 数据模型 — 用于持久登录（Trust Device）"""
 
@@ -193,10 +256,91 @@ class WorkspaceModel:
         ]
 
 
+class SyncJobModel:
+    """批量同步任务（admin sync-all）— 进度 checkpoint，中断后可续跑"""
+
+    collection_name = "sync_jobs"
+
+    @staticmethod
+    def create_sync_job(kind: str, phases: List[str], params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """创建同步任务文档"""
+        return {
+            "kind": kind,              # prompts / documents / all
+            "phases": phases,          # 依次执行的阶段
+            "params": params or {},
+            "status": "pending",       # pending / running / completed / failed / superseded
+            "active": True,            # pending / running 时为 True（同 kind 唯一），结束后 False
+            "phase_index": 0,
+            "last_id": None,           # 当前阶段已完成的最大 _id（checkpoint）
+            "progress": {},            # {phase: {total, processed, ...}}
+            "errors": [],
+            "owner": None,
+            "created_at": datetime.utcnow(),
+            "started_at": None,
+            "heartbeat_at": None,
+            "finished_at": None,
+        }
+
+    @staticmethod
+    def get_indexes() -> List[Dict]:
+        """返回需要创建的索引"""
+        return [
+            {"keys": [("status", 1), ("kind", 1)]},
+            {"keys": [("created_at", -1)]},
+            {"keys": [("kind", 1)], "unique": True, "partialFilterExpression": {"active": True},
+             "name": "kind_active_unique"},  # 同类任务同时只能有一个未结束
+        ]
+
+
+class BackgroundJobModel:
+    """后台任务队列（job_queue.py）— 记忆提取 / 标题生成等，重启后可恢复"""
+
+    collection_name = "background_jobs"
+
+    @staticmethod
+    def create_job(
+        kind: str,
+        payload: Dict[str, Any],
+        coalesce_key: Optional[str] = None,
+        dedupe: bool = False,
+        run_at: Optional[datetime] = None,
+        max_attempts: int = 3,
+    ) -> Dict[str, Any]:
+        """创建任务文档"""
+        now = datetime.utcnow()
+        return {
+            "kind": kind,
+            "payload": payload,
+            "coalesce_key": coalesce_key,  # 同 key 的任务串行执行（如 mem:{user_id}）
+            "dedupe": dedupe,              # True: 同 kind + key 只保留一个 pending
+            "status": "pending",           # pending / running / failed（成功即删除）
+            "attempts": 0,
+            "max_attempts": max_attempts,
+            "run_at": run_at or now,       # 重试退避：下次可执行时间
+            "lease_until": None,           # running 租约，过期视为 worker 已死 → 可被重新领取
+            "owner": None,
+            "last_error": None,
+            "created_at": now,
+            "expires_at": None,            # 失败任务保留期限（TTL）
+        }
+
+    @staticmethod
+    def get_indexes() -> List[Dict]:
+        """返回需要创建的索引"""
+        return [
+            {"keys": [("kind", 1), ("status", 1), ("run_at", 1)]},
+            {"keys": [("coalesce_key", 1), ("status", 1)]},
+            {"keys": [("kind", 1), ("coalesce_key", 1)], "unique": True,
+             "partialFilterExpression": {"status": "pending", "dedupe": True}},
+            {"keys": [("expires_at", 1)], "expireAfterSeconds": 0},
+        ]
+
+
 # 集合初始化辅助函数
 def get_all_models():
     """返回所有模型类"""
-    return [UserModel, ConversationModel, RefreshTokenModel, WorkspaceModel]
+    return [UserModel, ConversationModel, MessageModel, LorebookEntryModel, RefreshTokenModel, WorkspaceModel,
+            SyncJobModel, BackgroundJobModel]
 
 
 def init_indexes(db):
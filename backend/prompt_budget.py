@@ -0,0 +1,249 @@
+"""
+Prompt budget — token counting and one overall budget for the per-turn message.
+
+The message sent to AnythingLLM is the user's text wrapped in optional blocks:
+lorebook knowledge, Mem0 memories, history replays (thread migration, previous
+conversation, imported chats), web-search results and KB references. Each used
+to be concatenated unconditionally, so a large lorebook plus a history replay
+plus search results could push a turn past the model's context (or just make
+it slow and expensive). chat_stream now registers the blocks with a
+PromptBudget, which keeps them whole in priority order and trims or drops the
+lowest-priority ones once PROMPT_BUDGET_TOKENS is used up.
+
+Token counts:
+  count_tokens() — cached per content hash (per worker LRU), so lorebook
+  entries / memory facts that recur every turn are counted once. The default
+  counter is the CJK-aware heuristic that used to live in
+  lorebook_engine.estimate_tokens (±20%); set PROMPT_TOKENIZER=tiktoken for
+  exact counts (optional dependency, falls back to the heuristic), or
+  set_tokenizer() for anything else.
+
+Trimming is line-based and keeps a block's header line and closing marker
+([End of memories], [对话记录结束] …), so a trimmed block still reads as a block:
+"head" keeps the first lines (memory core facts, top lorebook entries, best
+search hits), "tail" keeps the last ones (most recent history).
+"""
+
+import hashlib
+import logging
+import os
+from typing import Callable, Dict, List, Optional, Tuple
+
+from local_cache import LRUCache
+
+log = logging.getLogger(__name__)
+
+PROMPT_BUDGET_TOKENS = int(os.getenv("PROMPT_BUDGET_TOKENS", "6000"))
+TOKEN_COUNT_CACHE_SIZE = 8192
+_CACHE_MIN_CHARS = 64           # shorter strings are cheaper to count than to hash
+_MIN_TRIMMED_TOKENS = 32        # below this a trimmed block is dropped instead
+
+# name → (priority, cap tokens, trim mode, has closing marker line)
+# Higher priority is kept first. Caps bound a single block even when the
+# overall budget has room.
+BLOCKS: Dict[str, Tuple[int, int, str, bool]] = {
+    "memory":         (90, 1200, "head", True),
+    "lorebook":       (85, 1200, "head", True),
+    "search":         (70, 1500, "head", True),
+    "history":        (60, 2000, "tail", True),     # thread migration replay
+    "import_context": (58, 2500, "tail", True),
+    "prev_context":   (55, 1000, "tail", True),
+    "kb":             (40, 800, "head", False),
+}
+PREFIX_ORDER = ("lorebook", "memory", "history", "prev_context", "import_context")
+SUFFIX_ORDER = ("search", "kb")
+
+
+# ---------- Token counting ----------
+
+def heuristic_tokens(text: str) -> int:
+    """CJK ~1.5 chars/token, others ~4 chars/token. Off by ±20%; precise
+    enough for budget cutoffs."""
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if "一" <= ch <= "鿿")
+    other = len(text) - cjk
+    return int(cjk / 1.5 + other / 4) + 1
+
+
+def _tiktoken_counter() -> Optional[Callable[[str], int]]:
+    try:
+        import tiktoken
+        enc = tiktoken.get_encoding(os.getenv("PROMPT_TOKENIZER_ENCODING", "o200k_base"))
+    except Exception as e:
+        log.warning(f"[BUDGET] tiktoken unavailable, using heuristic token counts: {e}")
+        return None
+    return lambda text: len(enc.encode(text, disallowed_special=()))
+
+
+_tokenizer_name = "heuristic"
+_tokenizer: Callable[[str], int] = heuristic_tokens
+_tokenizer_loaded = False
+_counts = LRUCache("prompt_token_counts", maxsize=TOKEN_COUNT_CACHE_SIZE)
+
+
+def _load_tokenizer() -> None:
+    global _tokenizer, _tokenizer_name, _tokenizer_loaded
+    _tokenizer_loaded = True
+    if os.getenv("PROMPT_TOKENIZER", "heuristic").lower() == "tiktoken":
+        counter = _tiktoken_counter()
+        if counter:
+            _tokenizer, _tokenizer_name = counter, "tiktoken"
+
+
+def set_tokenizer(name: str, counter: Callable[[str], int]) -> None:
+    """Install an exact tokenizer: counter(text) → token count."""
+    global _tokenizer, _tokenizer_name, _tokenizer_loaded
+    _tokenizer, _tokenizer_name, _tokenizer_loaded = counter, name, True
+    _counts.clear()
+
+
+def tokenizer_name() -> str:
+    if not _tokenizer_loaded:
+        _load_tokenizer()
+    return _tokenizer_name
+
+
+def count_tokens(text: str) -> int:
+    """Token count of text with the configured tokenizer, cached by content hash."""
+    if not text:
+        return 0
+    if not _tokenizer_loaded:
+        _load_tokenizer()
+    if len(text) < _CACHE_MIN_CHARS:
+        return _tokenizer(text)
+    key = hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+    n = _counts.get(key)
+    if n is None:
+        n = _tokenizer(text)
+        _counts.put(key, n)
+    return n
+
+
+# ---------- Trimming ----------
+
+def trim_lines(text: str, budget: int, keep: str = "head", footer: bool = True) -> str:
+    """
+    Cut whole lines until text fits budget tokens. The first non-blank line
+    (header) and, with footer=True, the last non-blank line (closing marker)
+    plus surrounding blank lines are always kept. keep="head" drops lines
+    from the end of the body, keep="tail" from its start. Returns "" when not
+    even one body line fits.
+    """
+    if count_tokens(text) <= budget:
+        return text
+    lines = text.split("\n")
+    marked = [i for i, l in enumerate(lines) if l.strip()]
+    if not marked:
+        return ""
+    first = marked[0]
+    last = marked[-1] if footer else len(lines)
+    # trailing blank lines stay with the frame even without a footer line
+    if not footer:
+        while last > first + 1 and not lines[last - 1].strip():
+            last -= 1
+    head, body, tail = lines[:first + 1], lines[first + 1:last], lines[last:]
+    if not body:
+        return ""
+    avail = budget - count_tokens("\n".join(head + tail))
+    kept: List[str] = []
+    used = 0
+    for line in (body if keep == "head" else reversed(body)):
+        t = count_tokens(line) + 1
+        if used + t > avail:
+            break
+        kept.append(line)
+        used += t
+    if not kept:
+        return ""
+    if keep != "head":
+        kept.reverse()
+    return "\n".join(head + kept + tail)
+
+
+# ---------- Budget ----------
+
+class PromptBudget:
+    """
+    One turn's token budget. reserve() the parts that are always sent (user
+    message, system hints), add() the optional blocks, then fit() returns each
+    block's text as it should be sent ("" when dropped).
+
+        budget = PromptBudget()
+        budget.reserve(user_message)
+        budget.add("memory", memory_prefix)
+        lore = build_lorebook_prefix(..., budget_tokens=budget.allowance("lorebook"))
+        budget.add("lorebook", lore)
+        blocks = budget.fit()
+    """
+
+    def __init__(self, total_tokens: Optional[int] = None):
+        self.total = total_tokens or PROMPT_BUDGET_TOKENS
+        self.reserved = 0
+        self._blocks: Dict[str, str] = {}
+        self.report: Dict[str, Tuple[int, int]] = {}   # name → (requested, sent)
+
+    def reserve(self, text: str) -> None:
+        self.reserved += count_tokens(text)
+
+    def add(self, name: str, text: str) -> None:
+        if name not in BLOCKS:
+            raise KeyError(f"unknown prompt block {name!r}")
+        if text:
+            self._blocks[name] = self._blocks.get(name, "") + text
+
+    def allowance(self, name: str, pending: Optional[Dict[str, str]] = None) -> int:
+        """Tokens a block can still get given the reserve and the blocks of
+        higher priority already added — for blocks that size themselves
+        (lorebook selection fills up to a budget). `pending` counts blocks
+        that will be added but aren't yet (produced by concurrent steps)."""
+        priority, cap, _, _ = BLOCKS[name]
+        blocks = dict(self._blocks)
+        for other, text in (pending or {}).items():
+            blocks[other] = blocks.get(other, "") + (text or "")
+        # fit() 会把每个块裁到自己的 cap，所以按 min(cap, tokens) 计占用 ——
+        # 超长的 memory 前缀不该把 lorebook 的份额挤成 0
+        used = self.reserved + sum(
+            min(BLOCKS[other][1], count_tokens(text)) for other, text in blocks.items()
+            if other != name and BLOCKS[other][0] > priority
+        )
+        return max(0, min(cap, self.total - used))
+
+    def fit(self) -> Dict[str, str]:
+        remaining = self.total - self.reserved
+        fitted: Dict[str, str] = {}
+        for name in sorted(self._blocks, key=lambda n: -BLOCKS[n][0]):
+            _, cap, keep, footer = BLOCKS[name]
+            text = self._blocks[name]
+            need = count_tokens(text)
+            allowed = min(cap, remaining)
+            if need > allowed:
+                text = trim_lines(text, allowed, keep, footer) if allowed >= _MIN_TRIMMED_TOKENS else ""
+            sent = count_tokens(text)
+            remaining -= sent
+            fitted[name] = text
+            self.report[name] = (need, sent)
+        return fitted
+
+    def summary(self) -> str:
+        """One log line: name=sent/requested for every block, trimmed ones marked."""
+        parts = [
+            f"{name}={sent}/{need}" + ("*" if sent < need else "")
+            for name, (need, sent) in self.report.items()
+        ]
+        return f"reserved={self.reserved} " + " ".join(parts) + f" total={self.total}"
+
+    def trimmed(self) -> bool:
+        return any(sent < need for need, sent in self.report.values())
+
+    def assemble(self, message: str, suffix: str = "") -> str:
+        """fit() and build the turn's message in the usual order: knowledge /
+        memory / history prefixes, the user's text, search + KB references,
+        then suffix (system hints)."""
+        blocks = self.fit()
+        return (
+            "".join(blocks.get(name, "") for name in PREFIX_ORDER)
+            + message
+            + "".join(blocks.get(name, "") for name in SUFFIX_ORDER)
+            + suffix
+        )
@@ -0,0 +1,113 @@
+"""
+Precompiled system-prompt templates — 模板只读盘、解析一次.
+
+A template is split once into alternating literal / slot segments
+("你是 {{companion_name}}，…" → ["你是 ", "companion_name", "，…"]) and rendered
+by filling the slot positions and joining — no file read and no chain of
+str.replace over the multi-KB template per prompt build.
+
+TemplateFile keeps one parsed copy of a system_prompt_template*.txt plus any
+derived variants (e.g. friend mode, emoji density — text rewrites that only
+depend on the template and a setting). It re-stats the file on access and
+re-reads it when the mtime changes, so edits on disk apply without a restart.
+
+Slot values are inserted verbatim: placeholders inside a value are not
+expanded again unless the caller renders the value first (WorkspaceManager does
+that for persona / memory, which may contain {{user_name}} etc.).
+"""
+
+import os
+import re
+import threading
+from typing import Callable, Dict, Hashable, List, Mapping, Optional
+
+_SLOT_RE = re.compile(r"\{\{(\w+)\}\}")
+
+
+class CompiledTemplate:
+    """Template text parsed into literal / slot segments."""
+
+    __slots__ = ("text", "_parts", "_slot_index", "slots")
+
+    def __init__(self, text: str):
+        self.text = text
+        # re.split with one group → [literal, slot, literal, slot, …, literal]
+        self._parts: List[str] = _SLOT_RE.split(text)
+        self._slot_index = range(1, len(self._parts), 2)
+        self.slots = frozenset(self._parts[1::2])
+
+    def render(self, values: Mapping[str, str]) -> str:
+        """Fill slots from values; a slot with no value stays as {{name}}."""
+        if not self.slots:
+            return self.text
+        parts = self._parts[:]
+        for i in self._slot_index:
+            value = values.get(parts[i])
+            parts[i] = value if value is not None else "{{" + parts[i] + "}}"
+        return "".join(parts)
+
+
+def render_text(text: str, values: Mapping[str, str]) -> str:
+    """One-off render of a short string (persona, memory) — no caching."""
+    if "{{" not in text:
+        return text
+    return CompiledTemplate(text).render(values)
+
+
+class TemplateFile:
+    """A template file on disk, parsed once per mtime, with cached variants."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._mtime: Optional[int] = None
+        self._loaded = False
+        self._text: Optional[str] = None
+        self._variants: Dict[Hashable, CompiledTemplate] = {}
+        self._lock = threading.Lock()
+        self.loads = 0
+
+    def _refresh(self) -> None:
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if self._loaded and mtime == self._mtime:
+            return
+        with self._lock:
+            if self._loaded and mtime == self._mtime:
+                return
+            text = None
+            if mtime is not None:
+                try:
+                    with open(self.path, "r", encoding="utf-8") as f:
+                        text = f.read().strip() or None
+                except Exception as e:
+                    print(f"Failed to load system prompt template {self.path}: {e}")
+            self._text = text
+            self._variants = {}
+            self._mtime = mtime
+            self._loaded = True
+            self.loads += 1
+            if text:
+                print(f"Loaded system prompt template {os.path.basename(self.path)} ({len(text)} chars)")
+
+    def text(self) -> Optional[str]:
+        """Raw (stripped) template text, or None if the file is missing / empty."""
+        self._refresh()
+        return self._text
+
+    def compiled(self, key: Hashable = None, build: Optional[Callable[[str], str]] = None) -> Optional[CompiledTemplate]:
+        """
+        Parsed template, or a variant of it: build(text) rewrites the raw text
+        before parsing and the result is cached under key until the file changes.
+        """
+        self._refresh()
+        variants = self._variants
+        text = self._text
+        if text is None:
+            return None
+        compiled = variants.get(key)
+        if compiled is None:
+            compiled = CompiledTemplate(build(text) if build else text)
+            variants[key] = compiled
+        return compiled
@@ -8,7 +8,9 @@ every write as best-effort — never assume Redis is up.
 
 import logging
 import os
-from typing import Optional
+import threading
+import time
+from typing import Callable, Optional
 
 import redis as _redis
 
@@ -21,14 +23,48 @@ class _NoOpClient:
     """Silent stand-in used when Redis is unreachable. Reads always miss, writes drop."""
 
     def get(self, *_a, **_kw): return None
+    def mget(self, *keys, **_kw): return [None] * len(keys)
     def set(self, *_a, **_kw): return False
     def setex(self, *_a, **_kw): return False
     def delete(self, *_a, **_kw): return 0
     def expire(self, *_a, **_kw): return False
     def exists(self, *_a, **_kw): return 0
     def incr(self, *_a, **_kw): return None
+    def hgetall(self, *_a, **_kw): return {}
+    def hset(self, *_a, **_kw): return 0
+    def hincrby(self, *_a, **_kw): return None
+    def hdel(self, *_a, **_kw): return 0
+    def publish(self, *_a, **_kw): return 0
     def ping(self): return False
 
+    def pipeline(self, *_a, **_kw): return _NoOpPipeline(self)
+
+    def register_script(self, _script):
+        return lambda keys=None, args=None, client=None: None
+
+
+class _NoOpPipeline:
+    """Queues calls against _NoOpClient; execute() returns their (miss) results."""
+
+    def __init__(self, client: "_NoOpClient"):
+        self._client = client
+        self._results = []
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+
+        def queue(*a, **kw):
+            self._results.append(method(*a, **kw))
+            return self
+        return queue
+
+    def execute(self):
+        results, self._results = self._results, []
+        return results
+
+    def __enter__(self): return self
+    def __exit__(self, *_exc): return False
+
 
 def get_client():
     global _client
@@ -74,3 +110,155 @@ def safe_delete(key: str) -> bool:
     except Exception as e:
         log.debug(f"[REDIS] delete({key}) failed: {e}")
         return False
+
+
+def safe_publish(channel: str, message: str) -> int:
+    """Publish to a pub/sub channel; returns the number of receivers (0 on failure)."""
+    try:
+        return int(get_client().publish(channel, message) or 0)
+    except Exception as e:
+        log.debug(f"[REDIS] publish({channel}) failed: {e}")
+        return 0
+
+
+# ==================== Pub/Sub listener ====================
+# Per-process caches (local_cache.LRUCache) subscribe to an invalidation
+# channel so every gunicorn worker drops its copy when any worker writes.
+# The listener runs in a daemon thread and reconnects with backoff; while it
+# is disconnected messages are lost, so `connected` is exposed for callers to
+# shorten their TTLs, and on_connect runs after every (re)subscribe so they can
+# flush whatever they may have missed.
+
+class Subscription:
+    def __init__(self, channel: str, handler: Callable[[str], None],
+                 on_connect: Optional[Callable[[], None]] = None):
+        self.channel = channel
+        self.handler = handler
+        self.on_connect = on_connect
+        self.connected = False
+        self.pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name=f"redis-sub:{channel}", daemon=True)
+        self._thread.start()
+
+    def alive(self) -> bool:
+        """False after a fork (threads don't survive it) or once the listener gave up."""
+        return self.pid == os.getpid() and self._thread.is_alive()
+
+    def _run(self) -> None:
+        backoff = 1.0
+        while True:
+            client = get_client()
+            if isinstance(client, _NoOpClient):
+                return          # no Redis for this process — callers rely on TTLs
+            pubsub = None
+            try:
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                self.connected = True
+                backoff = 1.0
+                if self.on_connect:
+                    self.on_connect()
+                while True:
+                    # Poll instead of listen(): the client's 2s socket timeout
+                    # would otherwise abort an idle blocking read.
+                    msg = pubsub.get_message(timeout=1.0)
+                    if msg and msg.get("type") == "message":
+                        try:
+                            self.handler(msg.get("data"))
+                        except Exception as e:
+                            log.debug(f"[REDIS] {self.channel} handler failed: {e}")
+            except Exception as e:
+                log.warning(f"[REDIS] subscription {self.channel} lost, retrying in {backoff:.0f}s: {e}")
+            finally:
+                self.connected = False
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+
+
+def subscribe(channel: str, handler: Callable[[str], None],
+              on_connect: Optional[Callable[[], None]] = None) -> Subscription:
+    """Start a background listener calling handler(message) for each message."""
+    return Subscription(channel, handler, on_connect)
+
+
+# ==================== Workspace prompt fingerprints ====================
+# slug → hash of the prompt + model + temperature AnythingLLM currently holds
+# for that workspace. Sync paths compare before POSTing /update and skip the
+# write on a match. Redis is the fast path; Mongo `workspaces.prompt_fingerprint`
+# is the durable copy, so a Redis flush (or the no-op fallback) costs one extra
+# read instead of a re-push of every workspace.
+
+FINGERPRINT_KEY = "prompt_fp:{slug}"
+FINGERPRINT_TTL_SECONDS = 7 * 24 * 3600
+
+_fp_lock = threading.Lock()
+_fp_stats = {"hits": 0, "misses": 0, "mongo_reads": 0}
+
+
+def _fp_count(field: str) -> None:
+    with _fp_lock:
+        _fp_stats[field] += 1
+
+
+def get_fingerprint(slug: str) -> Optional[str]:
+    """Last pushed fingerprint for a workspace, or None if unknown."""
+    key = FINGERPRINT_KEY.format(slug=slug)
+    fp = safe_get(key)
+    if fp:
+        return fp
+    try:
+        from database import db
+        _fp_count("mongo_reads")
+        doc = db.db["workspaces"].find_one({"slug": slug}, {"prompt_fingerprint": 1})
+        fp = (doc or {}).get("prompt_fingerprint")
+    except Exception as e:
+        log.debug(f"[REDIS] fingerprint mongo read({slug}) failed: {e}")
+        return None
+    if fp:
+        safe_setex(key, FINGERPRINT_TTL_SECONDS, fp)
+    return fp
+
+
+def set_fingerprint(slug: str, fingerprint: str) -> None:
+    """Record a successful push. Mongo first — it's the source of truth."""
+    try:
+        from database import db
+        db.db["workspaces"].update_one(
+            {"slug": slug}, {"$set": {"prompt_fingerprint": fingerprint}}
+        )
+    except Exception as e:
+        log.debug(f"[REDIS] fingerprint mongo write({slug}) failed: {e}")
+    safe_setex(FINGERPRINT_KEY.format(slug=slug), FINGERPRINT_TTL_SECONDS, fingerprint)
+
+
+def clear_fingerprint(slug: str) -> None:
+    """Forget the fingerprint after an out-of-band write; the next sync re-pushes."""
+    safe_delete(FINGERPRINT_KEY.format(slug=slug))
+    try:
+        from database import db
+        db.db["workspaces"].update_one(
+            {"slug": slug}, {"$unset": {"prompt_fingerprint": ""}}
+        )
+    except Exception as e:
+        log.debug(f"[REDIS] fingerprint mongo clear({slug}) failed: {e}")
+
+
+def fingerprint_matches(slug: str, fingerprint: str) -> bool:
+    """True when the workspace already holds this content. Counts hits/misses."""
+    hit = get_fingerprint(slug) == fingerprint
+    _fp_count("hits" if hit else "misses")
+    return hit
+
+
+def fingerprint_stats() -> dict:
+    """Process-local hit/miss counters since startup."""
+    with _fp_lock:
+        stats = dict(_fp_stats)
+    total = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / total, 3) if total else None
+    return stats
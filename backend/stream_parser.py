@@ -0,0 +1,463 @@
+"""
+Incremental parser for streamed LLM replies — 思考内容 / 正文 / 控制标记 一次分离.
+
+One ThinkStreamParser per reply. Feed it chunks exactly as they arrive; it
+returns events as soon as they are certain:
+
+    ("text", str)       reply text, safe to show / speak
+    ("thinking", str)   one finished thinking block
+    ("marker", dict)    {"type": "IMAGE" | "IMAGE_EDIT" | "RENAME" | "EMOTION", "value": str}
+
+    parser = ThinkStreamParser()
+    for chunk in stream:
+        for kind, value in parser.feed(chunk):
+            ...
+    for kind, value in parser.finish():
+        ...
+    result = parser.result     # ParseResult(reply, thinking, markers)
+
+Recognised thinking forms (same rules chat_stream used to apply with regexes):
+  - <think>…</think> / <thought>…</thought> anywhere, case-insensitive
+  - Gemini prefix at the start: "思考：…" / "Thinking: …" — until the first newline
+  - bare "THOUGHT " / "think " prefix — until a newline followed by CJK text or an
+    opening bracket/quote, provided at least 10 chars of reply follow
+  - Grok leaks after the reply: a line starting "Assistant:" or an analysis
+    header (角色保持： 情节推进： …) once the reply has ≥10 chars — the rest of
+    the stream is thinking
+
+Text is scanned in bulk between special characters ('<', '[', '\n'); only a
+possible tag, marker (≤ MAX_MARKER_CHARS) or line-start header at the end of
+the buffer is held back, so the work per chunk is proportional to the chunk
+plus that small tail. Markers are removed from the reply and never emitted
+as text.
+
+Cost: the work is linear, but each token pays a few method calls, so a very
+short reply is slower than the old regex cleanup. bench_stream_parser.py
+measures about 30µs vs 15µs for a 61-char recorded reply (0.5x), break-even
+around 400 chars, and 3x / 10x faster at 2k / 8k chars, where the old loop
+went quadratic. At 30µs per reply the short-reply gap is negligible next to
+LLM latency.
+"""
+
+import re
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+Event = Tuple[str, object]
+
+OPEN_TAGS = ("<think>", "<thought>")
+CLOSE_TAGS = ("</think>", "</thought>")
+MARKER_PREFIXES = ("[IMAGE_EDIT:", "[IMAGE:", "[RENAME:", "[EMOTION:")
+
+MAX_MARKER_CHARS = 2000     # an unclosed "[IMAGE: …" longer than this is just text
+MAX_RENAME_CHARS = 20       # [RENAME:(.{1,20}?)]
+MIN_REPLY_CHARS = 10        # reply needed before a trailing Grok leak / after a THOUGHT prefix
+INITIAL_FLUSH_CHARS = 60    # initial-phase buffer is released as text past this
+INITIAL_MIN_CHARS = 5
+
+_SPECIAL_RE = re.compile(r"[<\[\n]")
+_CLOSE_RE = re.compile(r"</(?:think|thought)>", re.IGNORECASE)
+_GEMINI_PREFIX_RE = re.compile(
+    r"^\s*(?:思考|Thinking|思考过程|Let me think|我(?:先)?(?:想想|思考一下|分析一下))[\s：:]+",
+    re.IGNORECASE,
+)
+_BARE_PREFIX_RE = re.compile(r"^\s*(?:THOUGHT|think)\s+", re.IGNORECASE)
+_MAYBE_THINKING_START_RE = re.compile(r"(?:思考|think|let\s)", re.IGNORECASE)
+_GROK_LINE_RE = re.compile(
+    r"[ \t\r\f\v]*(?:Assistant[ \t]*[:：]|(?:角色保持|亲密规则|情节推进|回复内容|场景设定|注意事项|互动建议|下一步)[ \t]*[:：])",
+    re.IGNORECASE,
+)
+_GROK_WORDS = ("assistant", "角色保持", "亲密规则", "情节推进", "回复内容",
+               "场景设定", "注意事项", "互动建议", "下一步")
+_PREFIX_REPLY_START = "（（*「【《\"“"
+_THINKING_IMAGE_RE = re.compile(r"\[IMAGE(?:_EDIT)?:\s*.+?\]", re.DOTALL)
+
+
+class ParseResult(NamedTuple):
+    reply: str
+    thinking: str
+    markers: List[Dict[str, str]]
+
+    def values(self, marker_type: str) -> List[str]:
+        return [m["value"] for m in self.markers if m["type"] == marker_type]
+
+    def first(self, marker_type: str) -> Optional[str]:
+        for m in self.markers:
+            if m["type"] == marker_type:
+                return m["value"]
+        return None
+
+    @property
+    def images(self) -> List[str]:
+        return self.values("IMAGE")
+
+    @property
+    def image_edit(self) -> Optional[str]:
+        return self.first("IMAGE_EDIT")
+
+    @property
+    def rename(self) -> Optional[str]:
+        return self.first("RENAME")
+
+    @property
+    def emotion(self) -> Optional[str]:
+        value = self.first("EMOTION")
+        return value.lower() if value else None
+
+
+def _is_prefix_ci(fragment: str, words) -> bool:
+    low = fragment.lower()
+    return any(w.startswith(low) for w in words)
+
+
+def _grok_line_status(line: str) -> str:
+    """'match' / 'maybe' (could still become a match) / 'no' for the start of a line."""
+    if _GROK_LINE_RE.match(line):
+        return "match"
+    body = line.lstrip(" \t\r\f\v")
+    if not body:
+        return "maybe"
+    for word in _GROK_WORDS:
+        if len(body) <= len(word):
+            if word.startswith(body.lower()):
+                return "maybe"
+        elif body[:len(word)].lower() == word and not body[len(word):].strip(" \t"):
+            return "maybe"      # "Assistant " — waiting for the colon
+    return "no"
+
+
+class ThinkStreamParser:
+    """Single-pass state machine; see module docstring."""
+
+    def __init__(self):
+        self._mode = "initial"      # initial | text | tag | line | prefix | prefix_reply | trail
+        self._buf = ""              # received but not yet classified
+        self._reply: List[str] = []
+        self._think: List[str] = []         # current thinking block
+        self._blocks: List[str] = []        # finished thinking blocks
+        self._markers: List[Dict[str, str]] = []
+        self._initial_checked = 0
+        self._line_start = False
+        self._lstrip = True         # drop whitespace at reply start / after a thinking block
+        self._done = False
+        self.result: Optional[ParseResult] = None
+
+    # ---------- public ----------
+
+    def feed(self, chunk: str) -> List[Event]:
+        if not chunk or self._done:
+            return []
+        if self._mode == "text" and not self._buf and not self._lstrip and not _SPECIAL_RE.search(chunk):
+            # fast path: plain text token — at a line start only once the
+            # line can no longer become a Grok header
+            if self._line_start:
+                if _grok_line_status(chunk) != "no":
+                    return self._feed_buffered(chunk)
+                self._line_start = False
+            self._reply.append(chunk)
+            return [("text", chunk)]
+        if self._mode == "tag" and not self._buf and "<" not in chunk:
+            self._think.append(chunk)       # fast path: inside <think>
+            return []
+        return self._feed_buffered(chunk)
+
+    def finish(self) -> List[Event]:
+        if self._done:
+            return []
+        events: List[Event] = []
+        self._drain(events, final=True)
+        if self._mode != "text" and self._mode != "initial":
+            self._end_block(events)
+        self._done = True
+
+        reply = "".join(self._reply).strip()
+        thinking = "\n\n".join(self._blocks)
+        if not reply and thinking:
+            # 只有思考没有正文 — 最后一段当作回复
+            paragraphs = [p.strip() for p in thinking.split("\n\n") if p.strip()]
+            if paragraphs:
+                reply = paragraphs[-1]
+                thinking = "\n\n".join(paragraphs[:-1])
+        self.result = ParseResult(reply, thinking, list(self._markers))
+        return _merge_text(events)
+
+    # ---------- state machine ----------
+
+    def _feed_buffered(self, chunk: str) -> List[Event]:
+        self._buf += chunk
+        events: List[Event] = []
+        self._drain(events, final=False)
+        return _merge_text(events)
+
+    def _drain(self, events: List[Event], final: bool) -> None:
+        # Each step either consumes input, switches mode, or waits for more input.
+        # Mid-stream an empty buffer leaves every step nothing to do, so stop
+        # without the confirming pass — short replies are mostly that pass.
+        while True:
+            state = (self._mode, len(self._buf))
+            getattr(self, "_step_" + self._mode)(events, final)
+            if (self._mode, len(self._buf)) == state or (not self._buf and not final):
+                return
+
+    def _step_initial(self, events: List[Event], final: bool) -> None:
+        # Decide on the shortest prefix that triggers a rule, so the outcome
+        # does not depend on where the chunks happened to split
+        buf = self._buf
+        for size in range(self._initial_checked + 1, len(buf) + 1):
+            if self._classify_initial(buf[:size], final=False):
+                return
+        self._initial_checked = len(buf)
+        if final:
+            self._classify_initial(buf, final=True)
+
+    def _classify_initial(self, head: str, final: bool) -> bool:
+        # Heads grow one char at a time, so a prefix regex first matches on a
+        # head ending in its separator — skip the regexes on every other head
+        last = head[-1]
+        sep = last.isspace() or last in "：:"
+        if last == ">" and head[-9:].lower().endswith(OPEN_TAGS):
+            self._mode = "text"     # text step splits at the tag
+            return True
+        m = _GEMINI_PREFIX_RE.match(head) if sep or final else None
+        if m:
+            self._buf = self._buf[m.end():]
+            self._start_block("line")
+            return True
+        m = _BARE_PREFIX_RE.match(head) if sep or final or len(head) > 15 else None
+        if m and (len(head) > 15 or final):
+            self._buf = self._buf[m.end():]
+            self._start_block("prefix")
+            return True
+        stripped = head.lstrip()
+        if (final or len(head) > INITIAL_FLUSH_CHARS
+                or (len(head) > INITIAL_MIN_CHARS and not stripped.startswith("<")
+                    and not _MAYBE_THINKING_START_RE.match(stripped))):
+            self._mode = "text"
+            return True
+        return False
+
+    def _step_text(self, events: List[Event], final: bool) -> None:
+        buf = self._buf
+        if self._lstrip:
+            buf = buf.lstrip()
+            if not buf:
+                self._buf = ""
+                return
+            self._lstrip = False
+        pos = 0
+        n = len(buf)
+        out: List[str] = []
+        while pos < n:
+            if self._line_start:
+                nl = buf.find("\n", pos)
+                line = buf[pos:] if nl < 0 else buf[pos:nl]
+                status = _grok_line_status(line)
+                if status == "maybe" and nl >= 0:
+                    status = "no"
+                if status == "maybe" and not final:
+                    break
+                if status == "match" and len("".join(self._reply + out).strip()) >= MIN_REPLY_CHARS:
+                    self._emit_text("".join(out), events)
+                    self._buf = buf[pos:]
+                    self._start_block("trail")
+                    return
+                self._line_start = False
+            m = _SPECIAL_RE.search(buf, pos)
+            if not m:
+                out.append(buf[pos:])
+                pos = n
+                break
+            i = m.start()
+            if i > pos:
+                out.append(buf[pos:i])
+            ch = buf[i]
+            if ch == "\n":
+                out.append("\n")
+                pos = i + 1
+                self._line_start = True
+                continue
+            rest = buf[i:]
+            if ch == "<":
+                head = rest[:9].lower()
+                tag = next((t for t in OPEN_TAGS if head.startswith(t)), None)
+                if tag:
+                    self._emit_text("".join(out), events)
+                    self._buf = rest[len(tag):]
+                    self._start_block("tag")
+                    return
+                if not final and len(rest) < 9 and _is_prefix_ci(rest, OPEN_TAGS):
+                    pos = i
+                    break
+                out.append("<")
+                pos = i + 1
+                continue
+            # '['
+            self._emit_text("".join(out), events)
+            out = []
+            status, consumed = self._match_marker(rest, final)
+            if status == "wait":
+                pos = i
+                break
+            if status == "no":
+                out.append("[")
+                pos = i + 1
+                continue
+            events.append(("marker", self._markers[-1]))
+            pos = i + consumed
+        self._emit_text("".join(out), events)
+        self._buf = buf[pos:]
+
+    def _step_tag(self, events: List[Event], final: bool) -> None:
+        m = _CLOSE_RE.search(self._buf)
+        if m:
+            self._think.append(self._buf[:m.start()])
+            self._buf = self._buf[m.end():]
+            self._end_block(events)
+            return
+        hold = 0 if final else _partial_tail(self._buf, CLOSE_TAGS)
+        cut = len(self._buf) - hold
+        self._think.append(self._buf[:cut])
+        self._buf = self._buf[cut:]
+
+    def _step_line(self, events: List[Event], final: bool) -> None:
+        buf = self._buf
+        start = 0
+        while True:
+            nl = buf.find("\n", start)
+            if nl < 0:
+                break
+            if "".join(self._think).strip() or buf[:nl].strip():
+                self._think.append(buf[:nl])
+                self._buf = buf[nl + 1:]
+                self._end_block(events)
+                return
+            start = nl + 1
+        self._think.append(buf)
+        self._buf = ""
+
+    def _step_prefix(self, events: List[Event], final: bool) -> None:
+        buf = self._buf
+        start = 0
+        while True:
+            nl = buf.find("\n", start)
+            if nl < 0 or nl + 1 >= len(buf):
+                break
+            c = buf[nl + 1]
+            if "一" <= c <= "鿿" or c in _PREFIX_REPLY_START:
+                self._think.append(buf[:nl])
+                self._buf = buf[nl + 1:]
+                self._mode = "prefix_reply"
+                return
+            start = nl + 1
+        cut = len(buf) if (nl < 0 or final) else nl
+        self._think.append(buf[:cut])
+        self._buf = buf[cut:]
+
+    def _step_prefix_reply(self, events: List[Event], final: bool) -> None:
+        # Tentative reply after a THOUGHT prefix — commit once it is long enough
+        if len(self._buf.strip()) >= MIN_REPLY_CHARS:
+            self._end_block(events)
+        elif final:
+            self._think.append("\n" + self._buf)
+            self._buf = ""
+            self._mode = "prefix"
+
+    def _step_trail(self, events: List[Event], final: bool) -> None:
+        self._think.append(self._buf)
+        self._buf = ""
+
+    # ---------- helpers ----------
+
+    def _emit_text(self, text: str, events: List[Event]) -> None:
+        if self._lstrip:
+            text = text.lstrip()
+            if not text:
+                return
+            self._lstrip = False
+        if text:
+            self._reply.append(text)
+            events.append(("text", text))
+
+    def _start_block(self, mode: str) -> None:
+        self._mode = mode
+        self._think = []
+
+    def _end_block(self, events: List[Event]) -> None:
+        block = _THINKING_IMAGE_RE.sub("", "".join(self._think)).strip()
+        self._think = []
+        if block:
+            self._blocks.append(block)
+            events.append(("thinking", block))
+        self._mode = "text"
+        self._lstrip = not "".join(self._reply).strip()
+        if not self._lstrip:
+            self._line_start = False
+
+    def _match_marker(self, rest: str, final: bool) -> Tuple[str, int]:
+        """('marker' | 'no' | 'wait', consumed) for text starting with '['."""
+        prefix = next((p for p in MARKER_PREFIXES if rest.startswith(p)), None)
+        if prefix is None:
+            if not final and any(p.startswith(rest) for p in MARKER_PREFIXES):
+                return "wait", 0
+            return "no", 0
+        kind = prefix[1:-1]
+        close = rest.find("]", len(prefix))
+        body = rest[len(prefix):] if close < 0 else rest[len(prefix):close]
+
+        if kind == "RENAME":
+            ok = "\n" not in body and len(body) <= MAX_RENAME_CHARS
+            if close >= 0:
+                ok = ok and len(body) >= 1
+        elif kind == "EMOTION":
+            ok = (not body or re.fullmatch(r"\w+", body) is not None)
+            if close >= 0:
+                ok = ok and bool(body)
+        else:
+            ok = len(body) <= MAX_MARKER_CHARS
+            if close >= 0:
+                ok = ok and bool(body.lstrip())
+        if not ok:
+            return "no", 0
+        if close < 0:
+            return ("no", 0) if final else ("wait", 0)
+
+        self._trim_reply_tail()
+        self._markers.append({"type": kind, "value": body.strip()})
+        return "marker", close + 1
+
+    def _trim_reply_tail(self) -> None:
+        # [\s*]\[MARKER…] — whitespace right before a marker is not part of the reply
+        while self._reply:
+            last = self._reply[-1].rstrip()
+            if last:
+                self._reply[-1] = last
+                return
+            self._reply.pop()
+
+
+def _partial_tail(buf: str, tags) -> int:
+    """Length of a suffix of buf that could be the start of one of tags."""
+    start = buf.rfind("<", max(0, len(buf) - 9))
+    if start < 0:
+        return 0
+    tail = buf[start:]
+    return len(tail) if _is_prefix_ci(tail, tags) else 0
+
+
+def _merge_text(events: List[Event]) -> List[Event]:
+    if len(events) < 2:
+        return events
+    merged: List[Event] = []
+    for kind, value in events:
+        if kind == "text" and merged and merged[-1][0] == "text":
+            merged[-1] = ("text", merged[-1][1] + value)
+        else:
+            merged.append((kind, value))
+    return merged
+
+
+def parse_reply(text: str) -> ParseResult:
+    """Parse a complete (non-streamed) reply in one go."""
+    parser = ThinkStreamParser()
+    parser.feed(text)
+    parser.finish()
+    return parser.result
@@ -1,47 +1,25 @@
 #!/usr/bin/env python3
-"""Sync system prompts for ALL users to their AnythingLLM workspaces."""
+"""Sync system prompts for ALL users to their AnythingLLM workspaces.
+
+Runs the same resumable batch job as POST /api/admin/sync-prompts, in the
+foreground and without regenerating personas. Re-running after an interrupted
+run resumes from the last checkpoint. --force ignores the workspace
+fingerprints and pushes every prompt again.
+"""
 import sys, os
 sys.path.insert(0, os.path.dirname(__file__))
 
 from dotenv import load_dotenv
 load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
 
-from database import db
-from workspace_manager import WorkspaceManager
-
-wm = WorkspaceManager()
-
-# 获取所有有 workspace 的用户
-workspaces = list(db.db["workspaces"].find({}))
-print(f"Found {len(workspaces)} workspaces in MongoDB")
-
-success = 0
-failed = 0
-skipped = 0
-
-for ws in workspaces:
-    user_id = ws["user_id"]
-    slug = ws.get("slug", "?")
-
-    user = db.db["users"].find_one({"_id": user_id})
-    if not user:
-        print(f"  SKIP {slug} — user not found")
-        skipped += 1
-        continue
+from sync_engine import run_sync
 
-    name = user.get("name", "Friend")
-    email = user.get("email", "?")
+job = run_sync("prompts", {"regenerate_persona": False, "force": "--force" in sys.argv[1:]})
+progress = job["progress"].get("prompts", {})
 
-    try:
-        result = wm.update_system_prompt(user_id, name)
-        if result.get("success"):
-            print(f"  OK   {slug} ({email})")
-            success += 1
-        else:
-            print(f"  FAIL {slug} ({email}) — {result.get('error')}")
-            failed += 1
-    except Exception as e:
-        print(f"  ERR  {slug} ({email}) — {e}")
-        failed += 1
+for err in job["errors"]:
+    print(f"  FAIL {err}")
 
-print(f"\nDone! success={success}, failed={failed}, skipped={skipped}")
+print(f"\nDone! status={job['status']}, total={progress.get('total', 0)}, "
+      f"pushed={progress.get('pushed', 0)}, unchanged={progress.get('unchanged', 0)}, "
+      f"failed={progress.get('errors', 0)}")
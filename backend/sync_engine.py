@@ -0,0 +1,356 @@
+"""
+Bulk workspace sync engine — backs admin sync-all / sync-prompts / sync-documents.
+
+The old loops did `list(collection.find({}))` and pushed to AnythingLLM one
+user at a time inside the admin HTTP request. This engine instead:
+
+  - streams users / workspaces with a cursor + projection, ordered by _id
+  - fans each batch out over a bounded thread pool (SYNC_WORKERS)
+  - spaces requests per AnythingLLM host (SYNC_RATE_PER_HOST items/second)
+  - checkpoints the last completed _id per batch in `sync_jobs`, so a run that
+    dies with its gunicorn worker resumes where it stopped
+  - runs in a background thread; admins poll GET /api/admin/sync-jobs/<id>
+  - a heartbeat thread keeps heartbeat_at fresh while the job runs (a batch
+    of persona regenerations can take longer than HEARTBEAT_STALE_SECONDS);
+    at most one unfinished job per kind (unique index on kind where active)
+  - an interrupted job is only resumed with the same params; otherwise it is
+    marked `superseded` and a fresh job starts
+
+Per-item work lives in WorkspaceManager (sync_prompt_for_user /
+sync_documents_for_workspace); this module only drives it.
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from database import db
+from models import SyncJobModel
+
+log = logging.getLogger(__name__)
+
+SYNC_WORKERS = int(os.getenv("SYNC_WORKERS", "8"))
+SYNC_RATE_PER_HOST = float(os.getenv("SYNC_RATE_PER_HOST", "20"))  # items/second, 0 = unlimited
+BATCH_SIZE = 100
+HEARTBEAT_STALE_SECONDS = 300   # a running job silent this long is considered dead → resumable
+HEARTBEAT_INTERVAL_SECONDS = 60
+MAX_ERRORS_KEPT = 200
+
+PHASES_BY_KIND = {
+    "prompts": ["prompts"],
+    "documents": ["documents"],
+    "all": ["prompts", "documents"],
+}
+
+DEFAULT_PARAMS = {"regenerate_persona": True, "force": False}
+
+
+def _normalize_params(params: Optional[Dict]) -> Dict:
+    return dict(DEFAULT_PARAMS, **(params or {}))
+
+
+class _HostRateLimiter:
+    """Evenly spaces work per host. Callers block until their slot comes up."""
+
+    def __init__(self, rate_per_sec: float):
+        self.interval = 1.0 / rate_per_sec if rate_per_sec > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next_slot: Dict[str, float] = {}
+
+    def acquire(self, host: str) -> None:
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.interval
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+_limiter = _HostRateLimiter(SYNC_RATE_PER_HOST)
+
+
+# ---------- Phases ----------
+# Each phase: which collection to stream, with what projection, and how to turn
+# one document into an outcome name that gets counted in job.progress[phase].
+
+def _prepare_prompts(wm, params: Dict) -> Dict:
+    return {"query": {}}
+
+
+def _handle_prompt(wm, user: Dict, ctx: Dict, params: Dict) -> Tuple[List[str], Optional[str]]:
+    result = wm.sync_prompt_for_user(user, regenerate_persona=params.get("regenerate_persona", True),
+                                     force=params.get("force", False))
+    if not result.get("success"):
+        return [], f"{user.get('name', user['_id'])}: {result.get('error', 'unknown')}"
+    outcomes = ["unchanged" if result.get("skipped") else "pushed"]
+    if result.get("regenerated"):
+        outcomes.append("regenerated")
+    return outcomes, None
+
+
+def _prepare_documents(wm, params: Dict) -> Dict:
+    template = wm.get_template_document_paths()
+    if not template.get("success"):
+        raise RuntimeError(template.get("error", "template read failed"))
+    return {
+        "paths": template["paths"],
+        "query": {"slug": {"$exists": True, "$ne": template["template_slug"]}},
+    }
+
+
+def _handle_documents(wm, ws: Dict, ctx: Dict, params: Dict) -> Tuple[List[str], Optional[str]]:
+    if not ctx["paths"]:
+        return ["up_to_date"], None
+    result = wm.sync_documents_for_workspace(ws["slug"], ctx["paths"])
+    if not result.get("success"):
+        return [], f"{ws['slug']}: {result.get('error', 'unknown')}"
+    return ["synced" if result.get("synced") else "up_to_date"], None
+
+
+_PHASES = {
+    "prompts": {
+        "collection": "users",
+        "projection": {"name": 1, "settings": 1, "personality_test": 1},
+        "prepare": _prepare_prompts,
+        "handle": _handle_prompt,
+    },
+    "documents": {
+        "collection": "workspaces",
+        "projection": {"slug": 1},
+        "prepare": _prepare_documents,
+        "handle": _handle_documents,
+    },
+}
+
+
+# ---------- Job bookkeeping ----------
+
+def _jobs():
+    return db.db[SyncJobModel.collection_name]
+
+
+def _owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _stale_before() -> datetime:
+    return datetime.utcnow() - timedelta(seconds=HEARTBEAT_STALE_SECONDS)
+
+
+def serialize_job(job: Dict) -> Dict[str, Any]:
+    """JSON-safe view of a job document for the admin API."""
+    def _iso(v):
+        return v.isoformat() if isinstance(v, datetime) else v
+    phases = job.get("phases") or []
+    phase_index = job.get("phase_index", 0)
+    return {
+        "id": str(job["_id"]),
+        "kind": job.get("kind"),
+        "status": job.get("status"),
+        "params": job.get("params", {}),
+        "phases": phases,
+        "phase": phases[phase_index] if phase_index < len(phases) else None,
+        "progress": job.get("progress", {}),
+        "errors": job.get("errors", []),
+        "owner": job.get("owner"),
+        "created_at": _iso(job.get("created_at")),
+        "started_at": _iso(job.get("started_at")),
+        "heartbeat_at": _iso(job.get("heartbeat_at")),
+        "finished_at": _iso(job.get("finished_at")),
+    }
+
+
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    try:
+        job = _jobs().find_one({"_id": ObjectId(job_id)})
+    except Exception:
+        return None
+    return serialize_job(job) if job else None
+
+
+def list_jobs(limit: int = 20) -> List[Dict[str, Any]]:
+    return [serialize_job(j) for j in _jobs().find().sort("created_at", -1).limit(limit)]
+
+
+def _claim_job(kind: str, params: Dict) -> Tuple[Optional[Dict], bool]:
+    """
+    Returns (job, should_run). A live run of the same kind is returned as-is
+    (should_run=False); a dead one (stale heartbeat) is claimed and resumed if
+    it was started with the same params, superseded otherwise; if nothing is
+    left to resume a fresh job is created.
+    """
+    params = _normalize_params(params)
+    live = _jobs().find_one({
+        "kind": kind, "status": "running", "heartbeat_at": {"$gte": _stale_before()},
+    })
+    if live:
+        return live, False
+
+    now = datetime.utcnow()
+    resumed = _jobs().find_one_and_update(
+        {"kind": kind, "status": {"$in": ["running", "pending"]},
+         "$or": [{"heartbeat_at": None}, {"heartbeat_at": {"$lt": _stale_before()}}]},
+        {"$set": {"status": "running", "active": True, "owner": _owner(), "heartbeat_at": now}},
+        return_document=ReturnDocument.AFTER,
+    )
+    superseded = None
+    if resumed:
+        old_params = _normalize_params(resumed.get("params"))
+        if old_params == params:
+            log.info(f"[SYNC] Resuming {kind} job {resumed['_id']} from phase "
+                     f"{resumed.get('phase_index', 0)} after _id {resumed.get('last_id')}")
+            return resumed, True
+        # resuming would silently run with the old params — start over instead
+        superseded = f"superseded interrupted job {resumed['_id']} (params {old_params} → {params})"
+        log.warning(f"[SYNC] {kind}: {superseded}")
+        _jobs().update_one({"_id": resumed["_id"]}, {
+            "$set": {"status": "superseded", "active": False, "finished_at": now},
+            "$push": {"errors": {"$each": [f"job: superseded by a run with params {params}"],
+                                 "$slice": -MAX_ERRORS_KEPT}},
+        })
+
+    job = SyncJobModel.create_sync_job(kind, PHASES_BY_KIND[kind], params)
+    job.update({"status": "running", "owner": _owner(), "started_at": now, "heartbeat_at": now})
+    if superseded:
+        job["errors"].append(superseded)
+    try:
+        job["_id"] = _jobs().insert_one(job).inserted_id
+    except DuplicateKeyError:
+        # another admin / process created the job first — report that one
+        return _jobs().find_one({"kind": kind, "active": True}), False
+    return job, True
+
+
+def _heartbeat(job_id, stop: threading.Event) -> None:
+    while not stop.wait(HEARTBEAT_INTERVAL_SECONDS):
+        try:
+            _jobs().update_one({"_id": job_id, "owner": _owner(), "status": "running"},
+                               {"$set": {"heartbeat_at": datetime.utcnow()}})
+        except Exception as e:
+            log.warning(f"[SYNC] Job {job_id} heartbeat failed: {e}")
+
+
+def _run_item(wm, spec: Dict, doc: Dict, ctx: Dict, params: Dict, host: str):
+    _limiter.acquire(host)
+    try:
+        return spec["handle"](wm, doc, ctx, params)
+    except Exception as e:
+        return [], f"{doc.get('slug') or doc.get('name') or doc['_id']}: {e}"
+
+
+def _run_job(job: Dict) -> Dict:
+    from workspace_manager import workspace_manager as wm
+
+    job_id = job["_id"]
+    params = _normalize_params(job.get("params"))
+    host = urlparse(wm.anythingllm_base_url).netloc or wm.anythingllm_base_url
+    stop = threading.Event()
+    threading.Thread(target=_heartbeat, args=(job_id, stop), daemon=True, name=f"sync-hb-{job_id}").start()
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, SYNC_WORKERS), thread_name_prefix="sync") as pool:
+            for phase_index in range(job.get("phase_index", 0), len(job["phases"])):
+                phase = job["phases"][phase_index]
+                spec = _PHASES[phase]
+                ctx = spec["prepare"](wm, params)
+                last_id = job.get("last_id") if phase_index == job.get("phase_index", 0) else None
+
+                query = dict(ctx["query"])
+                if phase not in job.get("progress", {}):
+                    _jobs().update_one({"_id": job_id}, {"$set": {
+                        f"progress.{phase}.total": db.db[spec["collection"]].count_documents(query),
+                    }})
+                if last_id is not None:
+                    query["_id"] = {"$gt": last_id}
+
+                cursor = (db.db[spec["collection"]]
+                          .find(query, spec["projection"])
+                          .sort("_id", 1)
+                          .batch_size(BATCH_SIZE))
+
+                batch: List[Dict] = []
+                for doc in cursor:
+                    batch.append(doc)
+                    if len(batch) >= BATCH_SIZE:
+                        _run_batch(pool, wm, job_id, phase, spec, ctx, params, host, batch)
+                        batch = []
+                if batch:
+                    _run_batch(pool, wm, job_id, phase, spec, ctx, params, host, batch)
+
+                _jobs().update_one({"_id": job_id}, {"$set": {
+                    "phase_index": phase_index + 1, "last_id": None, "heartbeat_at": datetime.utcnow(),
+                }})
+                job["last_id"] = None
+
+        _jobs().update_one({"_id": job_id}, {"$set": {
+            "status": "completed", "active": False, "finished_at": datetime.utcnow(),
+        }})
+    except Exception as e:
+        log.error(f"[SYNC] Job {job_id} failed: {e}", exc_info=True)
+        _jobs().update_one({"_id": job_id}, {
+            "$set": {"status": "failed", "active": False, "finished_at": datetime.utcnow()},
+            "$push": {"errors": {"$each": [f"job: {e}"], "$slice": -MAX_ERRORS_KEPT}},
+        })
+    finally:
+        stop.set()
+
+    return _jobs().find_one({"_id": job_id})
+
+
+def _run_batch(pool, wm, job_id, phase: str, spec: Dict, ctx: Dict, params: Dict, host: str, batch: List[Dict]) -> None:
+    """Run one batch to completion, then checkpoint. Everything ≤ last_id is done."""
+    counts: Dict[str, int] = {"processed": len(batch)}
+    errors: List[str] = []
+    for outcomes, error in pool.map(lambda d: _run_item(wm, spec, d, ctx, params, host), batch):
+        for name in outcomes:
+            counts[name] = counts.get(name, 0) + 1
+        if error:
+            errors.append(error)
+    counts["errors"] = len(errors)
+
+    update: Dict[str, Any] = {
+        "$set": {"last_id": batch[-1]["_id"], "heartbeat_at": datetime.utcnow()},
+        "$inc": {f"progress.{phase}.{k}": v for k, v in counts.items()},
+    }
+    if errors:
+        update["$push"] = {"errors": {"$each": errors, "$slice": -MAX_ERRORS_KEPT}}
+    _jobs().update_one({"_id": job_id}, update)
+    log.info(f"[SYNC] Job {job_id} {phase}: +{len(batch)} (errors {len(errors)})")
+
+
+# ---------- Entry points ----------
+
+def start_job(kind: str, params: Optional[Dict] = None) -> Dict[str, Any]:
+    """
+    Start (or resume) a sync job in a background thread and return immediately.
+    If a job of the same kind is already running, that job is returned instead.
+    """
+    if kind not in PHASES_BY_KIND:
+        raise ValueError(f"Unknown sync kind: {kind}")
+    job, should_run = _claim_job(kind, params or {})
+    if should_run:
+        threading.Thread(target=_run_job, args=(job,), daemon=True, name=f"sync-{kind}").start()
+    return serialize_job(job)
+
+
+def run_sync(kind: str, params: Optional[Dict] = None) -> Dict[str, Any]:
+    """Run (or resume) a sync job in the calling thread and return the finished job."""
+    if kind not in PHASES_BY_KIND:
+        raise ValueError(f"Unknown sync kind: {kind}")
+    job, should_run = _claim_job(kind, params or {})
+    if not should_run:
+        raise RuntimeError(f"A {kind} sync job is already running: {job['_id']}")
+    return serialize_job(_run_job(job))
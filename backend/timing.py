@@ -27,6 +27,9 @@ class StepTimer:
     Accumulating timer for instrumenting a multi-step pipeline (e.g. one chat
     request). Use .mark(label) at each checkpoint; .summary() emits one log
     line with all step deltas, keeping per-request log volume low.
+    Steps that run concurrently (enrichment.py) report their own duration via
+    .record(); they show up as label=ms, or label!timeout=ms / label!error=ms
+    when the step fell back to its default.
     """
 
     def __init__(self, name: str):
@@ -41,6 +44,10 @@ class StepTimer:
         self._steps.append((label, delta_ms))
         self._last = now
 
+    def record(self, label: str, elapsed_ms: float, status: str = ""):
+        """Add a step measured elsewhere (doesn't move the mark() checkpoint)."""
+        self._steps.append((f"{label}!{status}" if status else label, elapsed_ms))
+
     def summary(self):
         total_ms = (time.perf_counter() - self._start) * 1000.0
         parts = [f"{lbl}={ms:.0f}" for lbl, ms in self._steps]
@@ -0,0 +1,136 @@
+"""
+Read-through cache for user documents — one users lookup per chat turn.
+
+A chat turn used to fetch the same user document several times: login_required,
+then build_prompt_for_user, get_active_companion, the image appearance lookup
+and memory extraction each did their own find_one. get_user() answers from
+
+  1. a request-scoped identity map (flask.g) — every caller inside one request
+     shares the document login_required loaded;
+  2. Redis, `user_doc:{id}`, JSON with a short TTL (USER_CACHE_TTL_SECONDS) —
+     covers the voice server, background threads and the next request;
+  3. MongoDB, populating both tiers.
+
+Versioning: every write to a user document must call invalidate_user(), which
+bumps `user_gen:{id}`. Cached copies carry the generation they were read under
+and are ignored once it moves on, so a reader that raced a write can never put
+a stale copy back. Redis being down just means tier 2 always misses.
+"""
+
+import json
+import logging
+import os
+import threading
+from typing import Dict, Optional
+
+from bson import json_util
+from bson.json_util import JSONOptions
+
+from database import db
+from redis_client import get_client, safe_delete, safe_setex
+
+log = logging.getLogger(__name__)
+
+try:
+    from flask import g, has_app_context
+except ImportError:  # voice server without Flask — Redis tier only
+    g = None
+
+    def has_app_context():
+        return False
+
+USER_CACHE_TTL_SECONDS = int(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+USER_GEN_TTL_SECONDS = 24 * 3600    # must outlive any cached document
+
+DOC_KEY = "user_doc:{user_id}"
+GEN_KEY = "user_gen:{user_id}"
+
+# pymongo hands out naive UTC datetimes — keep cached copies the same
+_JSON_OPTIONS = JSONOptions(tz_aware=False)
+
+_lock = threading.Lock()
+_stats = {"request_hits": 0, "redis_hits": 0, "mongo_reads": 0, "invalidations": 0}
+
+
+def _count(field: str) -> None:
+    with _lock:
+        _stats[field] += 1
+
+
+def _identity_map() -> Optional[Dict[str, Dict]]:
+    if not has_app_context():
+        return None
+    users = getattr(g, "_user_identity_map", None)
+    if users is None:
+        users = g._user_identity_map = {}
+    return users
+
+
+def remember_user(user: Dict) -> None:
+    """Put an already-loaded user document into the request identity map."""
+    users = _identity_map()
+    if users is not None and user and user.get("_id") is not None:
+        users[str(user["_id"])] = user
+
+
+def get_user(user_id) -> Optional[Dict]:
+    """User document by _id (ObjectId), or None if it does not exist."""
+    key = str(user_id)
+    users = _identity_map()
+    if users is not None and key in users:
+        _count("request_hits")
+        return users[key]
+
+    gen = "0"
+    try:
+        current, raw = get_client().mget(GEN_KEY.format(user_id=key), DOC_KEY.format(user_id=key))
+        gen = current or "0"
+        if raw:
+            cached = json.loads(raw)
+            if cached.get("gen") == gen:
+                user = json_util.loads(cached["user"], json_options=_JSON_OPTIONS)
+                _count("redis_hits")
+                if users is not None:
+                    users[key] = user
+                return user
+    except Exception as e:
+        log.debug(f"[USER_CACHE] redis read({key}) failed: {e}")
+
+    _count("mongo_reads")
+    user = db.get_user_by_id(user_id)
+    if not user:
+        return None
+    if users is not None:
+        users[key] = user
+    try:
+        payload = json.dumps({"gen": gen, "user": json_util.dumps(user)})
+        safe_setex(DOC_KEY.format(user_id=key), USER_CACHE_TTL_SECONDS, payload)
+    except Exception as e:
+        log.debug(f"[USER_CACHE] serialize({key}) failed: {e}")
+    return user
+
+
+def invalidate_user(user_id) -> None:
+    """Call after every write to a user document."""
+    key = str(user_id)
+    users = _identity_map()
+    if users is not None:
+        users.pop(key, None)
+    _count("invalidations")
+    gen_key = GEN_KEY.format(user_id=key)
+    try:
+        client = get_client()
+        client.incr(gen_key)
+        client.expire(gen_key, USER_GEN_TTL_SECONDS)
+    except Exception as e:
+        log.debug(f"[USER_CACHE] bump generation({key}) failed: {e}")
+    safe_delete(DOC_KEY.format(user_id=key))
+
+
+def user_cache_stats() -> dict:
+    """Process-local counters since startup."""
+    with _lock:
+        stats = dict(_stats)
+    reads = stats["request_hits"] + stats["redis_hits"] + stats["mongo_reads"]
+    stats["hit_rate"] = round((reads - stats["mongo_reads"]) / reads, 3) if reads else None
+    return stats
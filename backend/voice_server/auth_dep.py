@@ -39,8 +39,8 @@ async def get_current_user_ws(token: str) -> Optional[Dict]:
             return None
 
         # Import here to avoid circular imports at module level
-        from database import db
-        user = db.get_user_by_id(ObjectId(user_id_str))
+        from user_cache import get_user
+        user = get_user(ObjectId(user_id_str))
         if not user:
             logger.warning(f"[AUTH] User not found: {user_id_str}")
             return None
@@ -17,6 +17,8 @@ from typing import AsyncIterator, Dict, List, Optional, Tuple
 
 from bson import ObjectId
 
+from stream_parser import ThinkStreamParser
+
 logger = logging.getLogger("voice_server.llm")
 
 GEMINI_API_KEY = os.getenv("GOOGLE_GEMINI_API_KEY", "")
@@ -94,16 +96,16 @@ async def gather_context(
         """Retrieve recent chat history from MongoDB."""
         try:
             from database import db
+            # Last 6 messages for voice mode (less context = faster TTFT)
             if conversation_id:
-                conv = db.get_conversation(ObjectId(conversation_id), user_id)
+                conv = db.get_conversation_tail(ObjectId(conversation_id), user_id, 6)
             else:
-                conv = db.get_active_conversation(user_id)
+                conv = db.get_active_conversation(user_id, tail=6)
 
             if not conv or not conv.get("messages"):
                 return []
 
-            # Last 6 messages for voice mode (less context = faster TTFT)
-            messages = conv["messages"][-6:]
+            messages = conv["messages"]
             history = []
             for msg in messages:
                 role = msg.get("role", "user")
@@ -180,7 +182,8 @@ async def stream_reply(
 
     Yields:
         Individual tokens/chunks as they arrive from the model.
-        Thinking content (<think>...</think>) is filtered out.
+        Thinking content (<think>...</think>, split across chunks or not) and
+        control markers are filtered out by ThinkStreamParser.
     """
     try:
         import google.generativeai as genai
@@ -213,35 +216,17 @@ async def stream_reply(
         # Stream response
         response = model.generate_content(contents, stream=True)
 
-        in_thinking = False
+        # Thinking blocks and [EMOTION:] style markers are not spoken
+        parser = ThinkStreamParser()
         for chunk in response:
             if not chunk.text:
                 continue
-
-            text = chunk.text
-
-            # Filter thinking blocks (don't TTS them)
-            # Handle chunks that may split <think> tags across boundaries
-            if "<think>" in text.lower():
-                in_thinking = True
-                # Yield any text before the <think> tag
-                before = re.split(r"<think>", text, flags=re.IGNORECASE)[0]
-                if before.strip():
-                    yield before
-                continue
-
-            if "</think>" in text.lower():
-                in_thinking = False
-                # Yield any text after the </think> tag
-                after = re.split(r"</think>", text, flags=re.IGNORECASE)[-1]
-                if after.strip():
-                    yield after
-                continue
-
-            if in_thinking:
-                continue
-
-            yield text
+            for kind, value in parser.feed(chunk.text):
+                if kind == "text":
+                    yield value
+        for kind, value in parser.finish():
+            if kind == "text":
+                yield value
 
     except Exception as e:
         logger.error(f"[LLM] Gemini streaming error: {e}", exc_info=True)
@@ -16,7 +16,6 @@ LLM goes through AnythingLLM (not direct Gemini) so that:
 import json
 import asyncio
 import logging
-import re
 import time
 from typing import AsyncIterator, Optional
 
@@ -29,6 +28,7 @@ from voice_server.stt_deepgram import DeepgramStreamingSTT, WhisperFallbackSTT
 # STT engine: "deepgram" (streaming PCM 16kHz) or "whisper" (batch)
 # AudioWorklet on frontend sends proper PCM 16kHz linear16 now
 STT_ENGINE = os.getenv("STT_ENGINE", "deepgram")
+from stream_parser import ThinkStreamParser
 from voice_server.tts_stream import (
     StreamingTTSPipeline,
     warmup as tts_warmup,
@@ -361,31 +361,24 @@ class VoicePipelineHandler:
         tts = StreamingTTSPipeline(self._voice_ref_id)
         self._tts_pipeline = tts
         full_reply = ""
-        thinking_content = ""
-        in_thinking = False
+        parser = ThinkStreamParser()
 
         async def llm_to_tts():
-            """Stream AnythingLLM tokens into TTS pipeline."""
-            nonlocal full_reply, thinking_content, in_thinking
+            """Stream AnythingLLM tokens into TTS pipeline (reply text only — no thinking / markers)."""
+            nonlocal full_reply
             try:
                 async for token in self._stream_anythingllm(api, transcript):
                     if self._interrupted:
                         break
 
                     full_reply += token
-
-                    # Filter <think> tags — don't TTS thinking content
-                    if "<think>" in token.lower() or "<thought>" in token.lower():
-                        in_thinking = True
-                        continue
-                    if "</think>" in token.lower() or "</thought>" in token.lower():
-                        in_thinking = False
-                        continue
-                    if in_thinking:
-                        thinking_content += token
-                        continue
-
-                    tts.feed_token(token)
+                    for kind, value in parser.feed(token):
+                        if kind == "text":
+                            tts.feed_token(value)
+                if not self._interrupted:
+                    for kind, value in parser.finish():
+                        if kind == "text":
+                            tts.feed_token(value)
             except Exception as e:
                 logger.error(f"[WS] LLM stream error: {e}")
             finally:
@@ -423,10 +416,9 @@ class VoicePipelineHandler:
 
         # Send full reply text for chat display
         if full_reply:
-            display_reply = re.sub(
-                r'<(?:think|thought)>.*?</(?:think|thought)>',
-                '', full_reply, flags=re.DOTALL
-            ).strip()
+            parser.finish()     # no-op unless the stream was interrupted
+            display_reply = parser.result.reply
+            thinking_content = parser.result.thinking
 
             await self._send_json({
                 "type": "reply",
@@ -452,8 +444,7 @@ class VoicePipelineHandler:
         """Get AnythingLLM workspace, switch to voice model."""
         loop = asyncio.get_event_loop()
         from workspace_manager import WorkspaceManager
-        from anythingllm_api import AnythingLLMAPI
-        import requests as _req
+        from anythingllm_api import AnythingLLMAPI, anythingllm_request
 
         wm = WorkspaceManager()
         self._wm = wm  # Save for restore
@@ -468,7 +459,8 @@ class VoicePipelineHandler:
 
         # Read current model before switching
         try:
-            resp = await loop.run_in_executor(None, lambda: _req.get(
+            resp = await loop.run_in_executor(None, lambda: anythingllm_request(
+                "GET",
                 f"{wm.anythingllm_base_url}/api/v1/workspace/{slug}",
                 headers={"Authorization": f"Bearer {wm.anythingllm_api_key}"},
                 timeout=5,
@@ -482,7 +474,8 @@ class VoicePipelineHandler:
         # Switch to fast non-reasoning model for voice
         if self._original_model != self.VOICE_MODEL:
             try:
-                await loop.run_in_executor(None, lambda: _req.post(
+                await loop.run_in_executor(None, lambda: anythingllm_request(
+                    "POST",
                     f"{wm.anythingllm_base_url}/api/v1/workspace/{slug}/update",
                     headers={"Authorization": f"Bearer {wm.anythingllm_api_key}",
                              "Content-Type": "application/json"},
@@ -492,6 +485,14 @@ class VoicePipelineHandler:
                 logger.info(f"[WS] Voice model: {self._original_model} → {self.VOICE_MODEL}")
             except Exception as e:
                 logger.warning(f"[WS] Model switch failed: {e}")
+            # chatModel now differs from what the prompt fingerprint records —
+            # clear it so a text turn during the call re-asserts the user's model
+            # instead of getting a fingerprint hit and running on the voice model.
+            # (Cleared even when the POST errored: a timed-out update may still apply.)
+            try:
+                await loop.run_in_executor(None, wm.invalidate_prompt_fingerprint, slug)
+            except Exception:
+                pass
 
         api = AnythingLLMAPI(
             base_url=wm.anythingllm_base_url,
@@ -508,10 +509,11 @@ class VoicePipelineHandler:
             return  # No change needed
         try:
             loop = asyncio.get_event_loop()
-            import requests as _req
+            from anythingllm_api import anythingllm_request
             slug = self._workspace_slug
             wm = self._wm
-            await loop.run_in_executor(None, lambda: _req.post(
+            await loop.run_in_executor(None, lambda: anythingllm_request(
+                "POST",
                 f"{wm.anythingllm_base_url}/api/v1/workspace/{slug}/update",
                 headers={"Authorization": f"Bearer {wm.anythingllm_api_key}",
                          "Content-Type": "application/json"},
@@ -521,6 +523,14 @@ class VoicePipelineHandler:
             logger.info(f"[WS] Restored model: {self.VOICE_MODEL} → {self._original_model}")
         except Exception as e:
             logger.warning(f"[WS] Model restore failed: {e}")
+        # The workspace was mutated behind the prompt fingerprint — let the next
+        # text turn re-assert the user's own model/prompt.
+        try:
+            await asyncio.get_event_loop().run_in_executor(
+                None, self._wm.invalidate_prompt_fingerprint, self._workspace_slug
+            )
+        except Exception:
+            pass
 
     async def _stream_anythingllm(
         self, api, transcript: str
@@ -615,6 +625,15 @@ class VoicePipelineHandler:
                 )
 
             logger.info(f"[WS] Saved turn: user={len(user_text)} chars, ai={len(ai_reply)} chars")
+
+            # Memory extraction goes through the durable job queue; the Flask
+            # workers run it (this process only enqueues).
+            if ai_reply:
+                from chat_jobs import queue_post_reply
+                await loop.run_in_executor(
+                    None,
+                    lambda: queue_post_reply(self.user_id, user_text, ai_reply, conversation_id=conv_id),
+                )
         except Exception as e:
             logger.error(f"[WS] Save turn error: {e}")
 
@@ -1,12 +1,22 @@
 """
 SoulLink Web Search Module
-Gemini 判断是否需要搜索 → Serper.dev Search
+本地预判 → Gemini 判断是否需要搜索 → Serper.dev Search
+
+本地预判 (search_signals): 绝大多数聊天消息（情绪、闲聊、角色扮演）与实时信息
+无关，却都要先等一次 ~1s 的 Gemini 判断。预判用正则找天气 / 新闻 / 价格 / 日期 /
+实时状态 / 明确搜索意图等信号，一个都没有的消息直接跳过 Gemini；有信号的仍交给
+Gemini 精确判断。预判会漏掉没写到正则里的说法（"梅西还在踢球吗"），被跳过的
+消息就不会再搜索 —— 它不只省掉本来会答"不搜"的调用。因此默认关闭，
+WEB_SEARCH_GATE=on 开启；开启前先用 bench_search_gate.py --data（线上记录的
+Gemini 判断）确认召回率。
 """
 
 import os
+import re
 import logging
+import threading
 import requests
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +24,74 @@ logger = logging.getLogger(__name__)
 SERPER_API_KEY = os.getenv("SERPER_API_KEY", "")
 
 
+# ========== 本地预判（跳过明显不需要搜索的消息） ==========
+
+# name → pattern; matched against the lowercased message
+SEARCH_SIGNALS = [
+    ("weather", re.compile(
+        r"天气|气温|温度|下雨|下雪|降温|降雨|暴雨|台风|雾霾|空气质量|预报|紫外线|湿度|几度"
+        r"|weather|forecast|temperature|humidity|\brain(ing|y)?\b|\bsnow(ing|y)?\b|storm|typhoon"
+        r"|hurricane|air quality|\baqi\b")),
+    ("news", re.compile(
+        r"新闻|最新|近况|热搜|头条|大事|发生了什么|出什么事|出了什么事|选举|大选|总统|首相|发布会|上映|票房"
+        r"|比赛|比分|赛程|决赛|冠军|世界杯|奥运|演唱会|巡演|新款|新版|新出的|更新了|战争|地震|事故"
+        r"|新专辑|新歌|新剧|新片|新作品|新游戏"
+        r"|\bnews\b|latest|headline|breaking|election|president|prime minister|announce|release[ds]?\b"
+        r"|premiere|box office|\bscore[sd]?\b|\bmatch\b|champion|world cup|olympic|tournament|\bnba\b"
+        r"|\bnfl\b|concert|\btour\b|earthquake|\bwar\b|this season|playoffs?")),
+    ("price", re.compile(
+        r"价格|多少钱|股价|股票|股市|汇率|美元|美金|人民币|日元|欧元|比特币|币价|油价|金价|房价|行情|涨停|跌停"
+        r"|\bprices?\b|\bcosts?\b|how much|\bstocks?\b|shares|exchange rate|bitcoin|\bbtc\b|\beth\b"
+        r"|crypto|\busd\b|\bmarket\b|inflation")),
+    ("date", re.compile(
+        r"几号|星期几|周几|礼拜几|几点了|现在几点|日期|今年|明年|去年|节假日|放假|倒计时|哪天|几月几"
+        r"|what day|what date|today'?s date|what time is it|what year|this year|next year|last year"
+        r"|holiday|\b20[2-3]\d\b")),
+    ("realtime", re.compile(
+        r"实时|营业|开门|关门|航班|路况|堵车|排名|排行|榜单|谁赢|开奖|票价|门票|附近"
+        r"|(赢|输)了(吗|没)|(赢|输)没(赢|输)|战绩"
+        r"|(现在|目前|最近|如今|今天|明天).{0,8}(多少|几|怎么样了|什么情况|是谁|谁是|哪|有没有)"
+        r"|什么时候(出|开始|发布|上线|开售|开播|开学|放榜|公布|开放)"
+        r"|(出|发布|上市|上线|开售|公布)了(吗|没)|(最近|近期|这几天|这两天).{0,8}(说了什么|发生|怎么了|有什么)"
+        r"|\b(currently|right now|nowadays|these days|tonight|tomorrow)\b|open now|opening hours|flight"
+        r"|traffic|ranking|who won|results?\b|\blive\b|schedule|near me|happening|going on"
+        r"|(who|what) is the (current|new|latest)|how (are|is) the \w+( \w+)? doing"
+        r"|\bdid (the )?\w+( \w+)? (win|lose)\b")),
+    ("search", re.compile(
+        r"搜一下|搜搜|搜索|查一下|查查|帮我查|查询|百度|谷歌|上网|网上"
+        r"|google|look up|search|browse|check online|https?://|www\.")),
+]
+
+# 默认关闭：信号是对着 bench 内置样本写的，留出样本上召回率远低于 100%；
+# 用线上记录的 Gemini 判断（bench_search_gate.py --data）评估过再打开
+SEARCH_GATE = os.getenv("WEB_SEARCH_GATE", "off").lower() == "on"
+
+_gate_lock = threading.Lock()
+_gate_stats = {"skipped": 0, "passed": 0, "searched": 0}
+
+
+def _gate_count(field: str) -> None:
+    with _gate_lock:
+        _gate_stats[field] += 1
+
+
+def search_signals(user_message: str) -> List[str]:
+    """Names of the search signals present in the message ([] → skip Gemini)."""
+    text = (user_message or "").lower()
+    if not text.strip():
+        return []
+    return [name for name, pattern in SEARCH_SIGNALS if pattern.search(text)]
+
+
+def search_gate_stats() -> dict:
+    """Process-local counters since startup (admin stats)."""
+    with _gate_lock:
+        stats = dict(_gate_stats)
+    total = stats["skipped"] + stats["passed"]
+    stats["skip_rate"] = round(stats["skipped"] / total, 3) if total else None
+    return stats
+
+
 # ========== Gemini 判断是否需要搜索 ==========
 
 def _gemini_classify(user_message: str) -> Tuple[bool, Optional[str]]:
@@ -130,14 +208,22 @@ def _serper_search(query: str, num_results: int = 5) -> Optional[str]:
 
 def enhance_message_with_search(user_message: str) -> Tuple[str, bool]:
     """
-    Gemini 判断 + 搜索增强：
+    本地预判 + Gemini 判断 + 搜索增强：
+    0. 本地预判（<0.1ms）→ 没有任何搜索信号的消息直接返回
     1. Gemini 判断（~1s）→ 精确判断是否需要搜索 + 生成搜索词
     2. Serper 搜索（~0.5s）→ 获取结果注入消息
     """
+    if SEARCH_GATE:
+        if not search_signals(user_message):
+            _gate_count("skipped")
+            return user_message, False
+        _gate_count("passed")
+
     # Gemini 判断是否需要搜索
     need_search, query = _gemini_classify(user_message)
     if not need_search or not query:
         return user_message, False
+    _gate_count("searched")
 
     # Serper 搜索
     search_results = _serper_search(query)